@@ -0,0 +1,312 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import llm
+import utils
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from flights_db import FlightsDB
+from flights_db_filler import generate_random_flights
+from llm import LlamaCPPLLM
+from models import registry
+from seat_inventory import SeatInventory
+from session import BookingSession
+from stubs import StubEmbedder, StubLlama, StubNER
+from tickets_db import TicketsDB
+
+# Scripted conversations, one message per turn; {ticket_id} is taken from the
+# flights offered on the previous turn
+CONVERSATIONS = {
+    "buy": [
+        "BUY a ticket",
+        "Kazan, something cheap",
+        "{ticket_id}",
+        "business",
+        "My name is John Smith",
+        "1234 567890",
+        "male",
+        "01-01-1990",
+        "john.smith@example.com",
+    ],
+    # Exact lookup by email, then vector search
+    "show": [
+        "SHOW my ticket, my email is john.smith@example.com",
+        "SHOW my ticket to Kazan",
+    ],
+}
+
+EXTRACTORS = [
+    "extract_slots",
+    "extract_flight_filters",
+    "extract_city",
+    "extract_value",
+    "extract_name",
+    "extract_email",
+    "extract_numbers",
+]
+FLIGHTS_DB_CALLS = ["search_flights", "get_cities", "get_ticket"]
+TICKETS_DB_CALLS = ["add", "add_ticket", "lookup", "query", "flush"]
+
+
+class StageTimer:
+    # Latencies in ms by stage name, from wrapped callables and streams
+    def __init__(self) -> None:
+        self.times: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.times.setdefault(stage, []).append(seconds * 1000)
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        return timed
+
+    def wrap_methods(self, prefix: str, obj: Any, names: List[str]) -> None:
+        for name in names:
+            setattr(obj, name, self.wrap(f"{prefix}.{name}", getattr(obj, name)))
+
+    def stream(self, stage: str, chunks: Iterator[Any]) -> Iterator[Any]:
+        # llama.cpp evaluates the prompt before the first chunk, then decodes
+        # one token per chunk
+        start = time.perf_counter()
+        first = None
+        n_tokens = 0
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+                self.record(f"{stage}.prompt_eval", first - start)
+            n_tokens += 1
+            yield chunk
+        if first is not None and n_tokens > 1:
+            decode = time.perf_counter() - first
+            self.record(f"{stage}.decode", decode)
+            self.record(f"{stage}.decode_per_token", decode / (n_tokens - 1))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                "calls": len(times),
+                "mean_ms": float(np.mean(times)),
+                "p50_ms": float(np.percentile(times, 50)),
+                "p95_ms": float(np.percentile(times, 95)),
+                "p99_ms": float(np.percentile(times, 99)),
+                "max_ms": float(np.max(times)),
+                "total_ms": float(np.sum(times)),
+            }
+            for stage, times in sorted(self.times.items())
+        }
+
+
+class TimedLLM(LlamaCPPLLM):
+    timer: StageTimer
+
+    def extract_contexts(self, request: str) -> Any:
+        with self.timed("extract_contexts"):
+            return super().extract_contexts(request)
+
+    def prompt(self, context_key: str, *args: Any, **kwargs: Any) -> List[int]:
+        with self.timed(f"prompt_build.{context_key}"):
+            return super().prompt(context_key, *args, **kwargs)
+
+    def create_completion(
+        self, prompt: Any, stream: bool, context_key: Optional[str] = None, **kwargs
+    ) -> Any:
+        if not stream:
+            with self.timed(f"llm.{context_key}.completion"):
+                return super().create_completion(prompt, stream, context_key, **kwargs)
+        return self.timer.stream(
+            f"llm.{context_key}",
+            super().create_completion(prompt, stream, context_key, **kwargs),
+        )
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timer.record(stage, time.perf_counter() - start)
+
+
+def instrument(timer: StageTimer, agent: TimedLLM) -> None:
+    agent.timer = timer
+    # llm imported the extractors by name, so they are replaced there;
+    # dateutil's fuzzy parsing is timed on its own inside them
+    for name in EXTRACTORS:
+        setattr(llm, name, timer.wrap(f"extract.{name}", getattr(llm, name)))
+    utils._parse_birth_date = timer.wrap(
+        "extract.dateutil_parse", utils._parse_birth_date
+    )
+    timer.wrap_methods("flights_db", agent.flights_db, FLIGHTS_DB_CALLS)
+    timer.wrap_methods("tickets_db", agent.tickets_db, TICKETS_DB_CALLS)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_models(args: argparse.Namespace) -> Dict[str, Any]:
+    # Stubs by default; small local models can be swapped in per stage
+    if args.llm_path:
+        from llama_cpp import Llama
+
+        llama = Llama(model_path=args.llm_path, n_ctx=2048, verbose=False)
+    else:
+        llama = StubLlama(
+            tokens=[" word"] * args.answer_tokens,
+            token_delay=args.token_delay,
+            prompt_delay=args.prompt_delay,
+        )
+
+    if args.embedder_model:
+        from embedder import HFEmbedder
+
+        embedder = HFEmbedder(model=args.embedder_model, cache_size=0)
+    else:
+        embedder = StubEmbedder(call_delay=args.embed_delay)
+
+    if args.ner_model:
+        from bert_ner import BERTNER
+
+        ner = BERTNER(model=args.ner_model)
+    else:
+        ner = StubNER(call_delay=args.ner_delay)
+    return {"llama": llama, "embedder": embedder, "ner": ner}
+
+
+def run(args: argparse.Namespace, db_path: str) -> Dict[str, Any]:
+    models = build_models(args)
+    registry.set("bert_ner", models["ner"])
+
+    flights = pd.DataFrame(
+        generate_random_flights(args.flights, ["Kazan", "Ufa", "Moscow"], seed=0)
+    )
+    flights_db = FlightsDB(args.filename, flights=flights)
+    tickets_db = TicketsDB(
+        "bench-conversation",
+        db_path=db_path,
+        embedder=models["embedder"],
+        flush_interval=None,
+        index=args.index,
+    )
+    agent = TimedLLM(
+        None,
+        tickets_db,
+        flights_db,
+        llama=models["llama"],
+        inventory=SeatInventory(flights_db),
+        slot_responses=args.slot_responses,
+    )
+    agent.streaming = True
+
+    timer = StageTimer()
+    instrument(timer, agent)
+    try:
+        for _ in range(args.conversations):
+            for name, script in CONVERSATIONS.items():
+                agent.session = BookingSession()
+                for message in script:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        if "{ticket_id}" in message:
+                            message = message.format(
+                                ticket_id=agent.flights_page().index[0]
+                            )
+                        with agent.timed(f"turn.{name}"):
+                            for _ in agent.generate(message):
+                                pass
+    finally:
+        tickets_db.close()
+        if os.path.exists(flights_db.sold_filename):
+            os.remove(flights_db.sold_filename)
+
+    return {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "args": vars(args),
+        "stages": timer.summary(),
+    }
+
+
+def compare(results: Dict[str, Any], path: str) -> None:
+    with open(path, encoding="utf-8") as f:
+        before = json.load(f)
+    print(f"\np50 vs {before.get('commit')} ({path})")
+    for stage, stats in results["stages"].items():
+        old = before["stages"].get(stage)
+        if old is None:
+            print(f"  {stage:<40}{stats['p50_ms']:10.3f} ms  (new)")
+            continue
+        change = (stats["p50_ms"] / old["p50_ms"] - 1) * 100 if old["p50_ms"] else 0.0
+        print(
+            f"  {stage:<40}{old['p50_ms']:10.3f} -> {stats['p50_ms']:10.3f} ms "
+            f"{change:+7.1f}%"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=10)
+    parser.add_argument("--flights", type=int, default=10_000)
+    parser.add_argument("--index", default="numpy", help="tickets index, see TicketsDB")
+    parser.add_argument("--slot-responses", default="llm", choices=["llm", "template"])
+    parser.add_argument("--llm-path", default=None, help="GGUF model, stub if unset")
+    parser.add_argument(
+        "--embedder-model", default=None, help="HF embedder model, stub if unset"
+    )
+    parser.add_argument("--ner-model", default=None, help="HF NER model, stub if unset")
+    # Stub timings, roughly a 7B Q4 model and the large HF models on CPU
+    parser.add_argument("--prompt-delay", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.002)
+    parser.add_argument("--answer-tokens", type=int, default=32)
+    parser.add_argument("--embed-delay", type=float, default=0.03)
+    parser.add_argument("--ner-delay", type=float, default=0.02)
+    parser.add_argument("--filename", default="bench_conversation.csv")
+    parser.add_argument("--output", default="bench_conversation.json")
+    parser.add_argument(
+        "--compare", default=None, help="results JSON of an earlier run"
+    )
+    args = parser.parse_args()
+
+    db_path = tempfile.mkdtemp()
+    try:
+        results = run(args, db_path)
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+
+    print(f"{'stage':<40}{'calls':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, stats in results["stages"].items():
+        print(
+            f"{stage:<40}{stats['calls']:7d}{stats['mean_ms']:10.3f}"
+            f"{stats['p50_ms']:10.3f}{stats['p95_ms']:10.3f}{stats['p99_ms']:10.3f}"
+        )
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import random
+import threading
+import time
+import numpy as np
+from typing import Callable, Dict, List
+from embedder import HFEmbedder
+from embedding_batcher import BatchingEmbedder
+
+TEMPLATES = [
+    "SHOW my ticket",
+    "SHOW my ticket to {city}",
+    "BUY a ticket to {city} please",
+    "My name is {name}, my email is {name_lower}@example.com",
+    "I want to fly to {city} on {date}, business class, my document number is 1234 567890",
+    "SHOW the flight I booked last week from Moscow to {city}, departing on {date}, "
+    "I think it was seat C12 and I paid around 900 for it",
+]
+CITIES = ["Kazan", "Perm", "Ufa", "Volgograd", "Saint Petersburg", "Novosibirsk"]
+NAMES = ["John Smith", "Anna Petrova", "Ivan Ivanov", "Maria Garcia"]
+
+
+def make_corpus(n: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        name = rng.choice(NAMES)
+        corpus.append(
+            rng.choice(TEMPLATES).format(
+                city=rng.choice(CITIES),
+                name=name,
+                name_lower=name.lower().replace(" ", "."),
+                date=f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            )
+            + f" #{i}"  # keep texts unique so no cache can help
+        )
+    return corpus
+
+
+def run_clients(
+    embed: Callable[[str], object], corpus: List[str], n_clients: int
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def client(texts: List[str]) -> None:
+        for text in texts:
+            start = time.perf_counter()
+            embed(text)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [
+        threading.Thread(target=client, args=(corpus[i::n_clients],))
+        for i in range(n_clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "texts_per_sec": len(corpus) / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p95_ms": float(np.percentile(latencies, 95) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type=int, default=512)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    # The cache is disabled so both paths run the model for every text
+    embedder = HFEmbedder(cache_size=0)
+    corpus = make_corpus(args.texts)
+    embedder.get_embeddings(corpus[:4])  # warm up
+
+    results = {}
+    for n_clients in args.clients:
+        per_call = run_clients(embedder.get_embeddings, corpus, n_clients)
+
+        batcher = BatchingEmbedder(
+            embedder,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+        )
+        batched = run_clients(batcher.get_embeddings, corpus, n_clients)
+        batched.update(batcher.stats())
+        batcher.shutdown()
+
+        results[n_clients] = {"per_call": per_call, "batched": batched}
+        print(
+            f"clients={n_clients:<4} "
+            f"per-call {per_call['texts_per_sec']:8.1f} texts/s "
+            f"p50 {per_call['latency_p50_ms']:7.1f} ms "
+            f"p95 {per_call['latency_p95_ms']:7.1f} ms | "
+            f"batched {batched['texts_per_sec']:8.1f} texts/s "
+            f"p50 {batched['latency_p50_ms']:7.1f} ms "
+            f"p95 {batched['latency_p95_ms']:7.1f} ms "
+            f"(mean batch {batched['mean_batch_size']:.1f})"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import random
+import time
+from utils import (
+    extract_slots,
+    extract_gender,
+    extract_classes_of_service,
+    extract_email,
+    extract_numbers,
+    extract_birth_date,
+)
+
+# Outputs of the per-field extractors, including their substring quirks
+# ("female" and "woman" contain "male" / "man"): text, then GOLDEN_FIELDS
+GOLDEN_FIELDS = ("gender", "class_of_service", "email", "document_number", "birth_date")
+GOLDEN = [
+    ("BUY", None, None, None, None, None),
+    ("BUY a ticket to Kazan", None, None, None, None, None),
+    ("SHOW my ticket", None, None, None, None, None),
+    ("I am male", "male", None, None, None, None),
+    ("I'm a female", "male", None, None, None, None),
+    ("woman", "male", None, None, None, None),
+    ("I am a lady", "female", None, None, None, None),
+    ("She is a girl, a real heroine", "female", None, None, None, None),
+    ("the gentleman in seat C12", "male", None, None, None, None),
+    ("I'm a guy who likes first class", "male", "first", None, None, None),
+    ("Economy please", None, "economy", None, None, None),
+    ("business class, not economy", None, "economy", None, None, None),
+    ("FIRST CLASS", None, "first", None, None, None),
+    ("I would like the cheapest option", None, None, None, None, None),
+    ("broadway musical fan", "female", None, None, None, None),
+    (
+        "My email is john.smith@example.com",
+        None,
+        None,
+        "john.smith@example.com",
+        None,
+        None,
+    ),
+    (
+        "email: Anna_Petrova+travel@mail.co.uk, thanks",
+        None,
+        None,
+        "Anna_Petrova+travel@mail.co.uk",
+        None,
+        None,
+    ),
+    ("contact me at a@b.c or x@y.org", None, None, "x@y.org", None, None),
+    ("1234 567890", None, None, None, "1234 567890", None),
+    ("my passport is 1 2 3 4 567890", None, None, None, "1234 567890", None),
+    ("document 4510123456", None, None, None, "4510 123456", None),
+    ("phone 12345", None, None, None, None, None),
+    ("I was born 03-03-1985", None, None, None, None, "1985-03-03"),
+    ("birth date 1990-12-31", None, None, None, None, "1990-12-31"),
+    ("born on 15.07.2001", None, None, None, None, "2001-07-15"),
+    ("born 01/01/2015", None, None, None, None, None),
+    ("my birthday is 31-02-1980", None, None, None, None, None),
+    (
+        "I'm John Smith, male, born 12-05-1979, email john@smith.com, document 1234 567890, business class",
+        "male",
+        "business",
+        "john@smith.com",
+        "1234 567890",
+        None,
+    ),
+    (
+        "Anna, female, 1988-04-21, anna@mail.ru, 9876543210, economy",
+        "male",
+        "economy",
+        "anna@mail.ru",
+        "9876 543210",
+        None,
+    ),
+    ("firstname@x.com", None, "first", "firstname@x.com", None, None),
+    ("I am a man of the world", "male", None, None, None, None),
+    ("androgenous style", "male", None, None, None, None),
+    ("she-woman", "male", None, None, None, None),
+    ("he-man", "male", None, None, None, None),
+    ("damage to my luggage", None, None, None, None, None),
+    ("manlike but ladylike", "male", None, None, None, None),
+    ("", None, None, None, None, None),
+]
+
+
+def extract_separately(text):
+    return {
+        "gender": extract_gender(text),
+        "class_of_service": extract_classes_of_service(text),
+        "email": extract_email(text),
+        "document_number": extract_numbers(text),
+        "birth_date": extract_birth_date(text),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = [text for text, *_ in GOLDEN if text]
+    messages = [
+        " ".join(rng.sample(texts, rng.randint(1, 3))) for _ in range(args.messages)
+    ]
+
+    for name, extract in (
+        ("per-field extractors", extract_separately),
+        ("extract_slots", extract_slots),
+    ):
+        start = time.perf_counter()
+        for message in messages:
+            extract(message)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:<22}{elapsed:8.2f} s  "
+            f"{elapsed / len(messages) * 1e6:8.1f} us/message"
+        )
+
+    # birth_date needs dateutil's fuzzy parser whenever a date is present,
+    # which dominates both paths; this isolates the scanning cost
+    fields = ("gender", "class_of_service", "email", "document_number")
+    start = time.perf_counter()
+    for message in messages:
+        extract_gender(message)
+        extract_classes_of_service(message)
+        extract_email(message)
+        extract_numbers(message)
+    separate = time.perf_counter() - start
+    start = time.perf_counter()
+    for message in messages:
+        extract_slots(message, fields=fields)
+    single_pass = time.perf_counter() - start
+    print(
+        f"without birth_date: per-field {separate / len(messages) * 1e6:.1f} us/message, "
+        f"extract_slots {single_pass / len(messages) * 1e6:.1f} us/message "
+        f"({separate / single_pass:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from typing import Any, Callable, Dict, List
+from flights_db import FlightsDB
+from flights_db_filler import generate_random_flights
+
+QUERIES: Dict[str, Dict[str, Any]] = {
+    "next_week_by_time": {
+        "departure_from": "2023-07-03",
+        "departure_to": "2023-07-10",
+    },
+    "next_week_under_900_by_price": {
+        "departure_from": "2023-07-03",
+        "departure_to": "2023-07-10",
+        "max_price": 900,
+        "sort_by": "price",
+    },
+    "under_600_by_time": {"max_price": 600},
+    "cheapest": {"sort_by": "price"},
+    "one_day_under_510_by_time": {
+        "departure_from": "2023-07-28",
+        "departure_to": "2023-07-29",
+        "max_price": 510,
+    },
+    "third_page_by_time": {"offset": 20},
+}
+
+
+def scan_search(
+    flights: pd.DataFrame,
+    city_name: str,
+    departure_from: Any = None,
+    departure_to: Any = None,
+    max_price: float = None,
+    sort_by: str = "departure_date",
+    limit: int = 10,
+    offset: int = 0,
+) -> pd.DataFrame:
+    # The same query as boolean masks and a sort over the whole table
+    mask = flights["city_name"] == city_name
+    if departure_from is not None:
+        mask &= flights["departure_date"] >= pd.Timestamp(departure_from)
+    if departure_to is not None:
+        mask &= flights["departure_date"] < pd.Timestamp(departure_to)
+    if max_price is not None:
+        mask &= flights["price"] <= max_price
+    return (
+        flights[mask].sort_values(sort_by, kind="stable").iloc[offset : offset + limit]
+    )
+
+
+def per_call_ms(fn: Callable, calls: List[Dict[str, Any]]) -> float:
+    start = time.perf_counter()
+    for kwargs in calls:
+        fn(**kwargs)
+    return (time.perf_counter() - start) / len(calls) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flights", type=int, default=3_000_000)
+    parser.add_argument("--cities", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    cities = [f"City {i}" for i in range(args.cities)]
+    flights = pd.DataFrame(generate_random_flights(args.flights, cities, seed=0))
+    db = FlightsDB(flights=flights)
+    typed = db.flights
+    rng = np.random.default_rng(1)
+
+    results = {"flights": args.flights, "cities": args.cities}
+    print(f"{'query':<30}{'scan, ms':>12}{'search, ms':>13}{'speedup':>10}")
+    for name, query in QUERIES.items():
+        calls = [
+            dict(query, city_name=cities[i])
+            for i in rng.integers(0, args.cities, args.calls)
+        ]
+        for kwargs in calls[:3]:
+            expected = scan_search(typed, **kwargs).index.tolist()
+            assert db.search_flights(**kwargs).index.tolist() == expected, name
+
+        before = per_call_ms(lambda **kwargs: scan_search(typed, **kwargs), calls)
+        after = per_call_ms(db.search_flights, calls)
+        results[name] = {"scan_ms": before, "search_ms": after}
+        print(f"{name:<30}{before:>12.2f}{after:>13.3f}{before / after:>9.1f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
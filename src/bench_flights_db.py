@@ -0,0 +1,124 @@
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List, Tuple
+from flights_db import FlightsDB
+
+
+def make_flights(n: int, n_cities: int = 200, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    cities = np.array([f"City {i}" for i in range(n_cities)], dtype=object)
+    departures = np.datetime64("2024-01-01T00:00") + rng.integers(
+        0, 365 * 24 * 4, n
+    ) * np.timedelta64(15, "m")
+    arrivals = departures + rng.integers(1, 12 * 4, n) * np.timedelta64(15, "m")
+    return pd.DataFrame(
+        {
+            "city_name": cities[rng.integers(0, n_cities, n)],
+            "departure_date": pd.DatetimeIndex(departures).strftime("%Y-%m-%d %H:%M"),
+            "arrival_date": pd.DatetimeIndex(arrivals).strftime("%Y-%m-%d %H:%M"),
+            "seat_place": [f"{chr(65 + i % 6)}{i % 30 + 1}" for i in range(n)],
+            "price": rng.integers(100, 1000, n),
+        }
+    )
+
+
+# The accessors as they were before the indexes: a boolean mask scan per call
+def scan_get_flights(flights: pd.DataFrame, city_name: str, departure_date: str):
+    return flights[
+        (flights["city_name"] == city_name)
+        & (flights["departure_date"] == departure_date)
+    ]
+
+
+def scan_get_cities(flights: pd.DataFrame) -> List[str]:
+    return flights["city_name"].unique().tolist()
+
+
+def scan_get_departure_dates(flights: pd.DataFrame, city_name: str) -> List[str]:
+    return flights[flights["city_name"] == city_name]["departure_date"].to_list()
+
+
+def scan_get_prices(flights: pd.DataFrame, city_name: str, departure_date: str):
+    flight = scan_get_flights(flights, city_name, departure_date)
+    return flight["price"].values.tolist() if not flight.empty else None
+
+
+def scan_get_ticket_ids(flights: pd.DataFrame, city_name: str) -> List[int]:
+    return flights[flights["city_name"] == city_name].index.tolist()
+
+
+def per_call_ms(fn: Callable, args: List[Tuple]) -> float:
+    start = time.perf_counter()
+    for call_args in args:
+        fn(*call_args)
+    return (time.perf_counter() - start) / len(args) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flights", type=int, default=1_000_000)
+    parser.add_argument("--cities", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=50)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    flights = make_flights(args.flights, args.cities)
+
+    start = time.perf_counter()
+    db = FlightsDB(flights=flights)
+    build_time = time.perf_counter() - start
+    print(f"{args.flights} flights, indexes built in {build_time:.2f} s")
+
+    rng = np.random.default_rng(1)
+    picks = rng.integers(0, len(flights), args.calls)
+    by_city = [(flights["city_name"].iat[i],) for i in picks]
+    by_flight = [
+        (flights["city_name"].iat[i], flights["departure_date"].iat[i]) for i in picks
+    ]
+
+    cases: Dict[str, Tuple[Callable, Callable, List[Tuple]]] = {
+        "get_flights": (
+            lambda *a: scan_get_flights(flights, *a),
+            db.get_flights,
+            by_flight,
+        ),
+        "get_cities": (
+            lambda: scan_get_cities(flights),
+            db.get_cities,
+            [()] * args.calls,
+        ),
+        "get_departure_dates": (
+            lambda *a: scan_get_departure_dates(flights, *a),
+            db.get_departure_dates,
+            by_city,
+        ),
+        "get_prices": (
+            lambda *a: scan_get_prices(flights, *a),
+            db.get_prices,
+            by_flight,
+        ),
+        "get_ticket_ids": (
+            lambda *a: scan_get_ticket_ids(flights, *a),
+            db.get_ticket_ids,
+            by_city,
+        ),
+    }
+
+    results = {"flights": args.flights, "index_build_s": build_time}
+    print(f"{'accessor':<22}{'scan, ms':>12}{'indexed, ms':>14}{'speedup':>10}")
+    for name, (scan, indexed, call_args) in cases.items():
+        before = per_call_ms(scan, call_args)
+        after = per_call_ms(indexed, call_args)
+        results[name] = {"scan_ms": before, "indexed_ms": after}
+        print(f"{name:<22}{before:>12.3f}{after:>14.3f}{before / after:>9.1f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import time
+import pandas as pd
+from typing import Dict
+from flights_db import COLUMNS, DB_PATH, FlightsDB
+from flights_db_filler import generate_random_flight, generate_random_flights
+
+CITIES = ["Volgograd", "Saint Petersburg", "Novosibirsk", "Kazan", "Ufa", "Perm"]
+
+
+class RewritingFlightsDB(FlightsDB):
+    # add_flight as it was before the journal: concat and rewrite the whole CSV
+    def add_flight(self, city_name, departure_date, arrival_date, seat_place, price):
+        flight_data = pd.DataFrame(
+            {
+                "city_name": [city_name],
+                "departure_date": [departure_date],
+                "arrival_date": [arrival_date],
+                "seat_place": [seat_place],
+                "price": [price],
+            },
+            columns=COLUMNS,
+        )
+        self.flights = pd.concat([self.flights, flight_data], ignore_index=True)
+        self.flights.to_csv(self.filename, index=False)
+
+
+def remove_files(filename: str) -> None:
+    for path in [f"{DB_PATH}/{filename}", f"{DB_PATH}/{filename}.journal"]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def bench_bulk(n: int, batch_size: int, filename: str) -> Dict[str, float]:
+    remove_files(filename)
+
+    start = time.perf_counter()
+    batches = [
+        generate_random_flights(min(batch_size, n - i), CITIES, seed=i)
+        for i in range(0, n, batch_size)
+    ]
+    generate_time = time.perf_counter() - start
+
+    # Compaction is triggered explicitly below, so it is timed on its own
+    db = FlightsDB(filename, compact_min_rows=n + 1, compact_ratio=float("inf"))
+    start = time.perf_counter()
+    for batch in batches:
+        db.add_flights(batch)
+    append_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.compact()
+    compact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reloaded = FlightsDB(filename)
+    load_time = time.perf_counter() - start
+    assert len(reloaded.flights) == n
+
+    remove_files(filename)
+    return {
+        "generate_s": generate_time,
+        "add_flights_s": append_time,
+        "compact_s": compact_time,
+        "load_s": load_time,
+    }
+
+
+def bench_per_row(n: int, filename: str) -> float:
+    remove_files(filename)
+    db = RewritingFlightsDB(filename)
+    random.seed(0)
+    start = time.perf_counter()
+    for _ in range(n):
+        generate_random_flight(db, CITIES)
+    elapsed = time.perf_counter() - start
+    remove_files(filename)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument(
+        "--per-row-max",
+        type=int,
+        default=2_000,
+        help="largest size to also run through the old per-row add_flight",
+    )
+    parser.add_argument(
+        "--filename",
+        default="bench_flights.csv",
+        help="a name without .csv benchmarks the columnar storage",
+    )
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for n in args.rows:
+        result = bench_bulk(n, args.batch_size, args.filename)
+        line = (
+            f"rows={n:<9} generate {result['generate_s']:6.2f} s  "
+            f"add_flights {result['add_flights_s']:6.2f} s  "
+            f"compact {result['compact_s']:6.2f} s  "
+            f"load {result['load_s']:6.2f} s"
+        )
+        if n <= args.per_row_max:
+            result["per_row_add_flight_s"] = bench_per_row(n, args.filename)
+            line += f"  | per-row add_flight {result['per_row_add_flight_s']:6.2f} s"
+        results[n] = result
+        print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+from typing import Dict
+from flights_db import DB_PATH, FlightsDB
+from flights_db_filler import generate_random_flights
+from flights_storage import CSVFlightsStorage, migrate_csv, typed_flights
+
+CITIES = ["Volgograd", "Saint Petersburg", "Novosibirsk", "Kazan", "Ufa", "Perm"]
+
+
+def resident_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, in KiB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_db(filename: str, queue: multiprocessing.Queue) -> None:
+    # Runs in a fresh process, so nothing is shared with the parent's heap
+    baseline = resident_bytes()
+    start = time.perf_counter()
+    db = FlightsDB(filename)
+    opened = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.get_flights(db.get_cities()[0])
+    first_query = time.perf_counter() - start
+
+    queue.put(
+        {
+            "open_s": opened,
+            "first_query_s": first_query,
+            "rss_mb": (resident_bytes() - baseline) / 2**20,
+        }
+    )
+
+
+def cold_start(filename: str) -> Dict[str, float]:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=open_db, args=(filename, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--filename", default="bench_flights")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    csv_filename = f"{args.filename}.csv"
+    csv_path = f"{DB_PATH}/{csv_filename}"
+    columnar_path = f"{DB_PATH}/{args.filename}"
+
+    results = {}
+    for n in args.rows:
+        CSVFlightsStorage(csv_path).save(
+            typed_flights(generate_random_flights(n, CITIES, seed=0))
+        )
+        start = time.perf_counter()
+        migrate_csv(csv_path, columnar_path)
+        migrate_time = time.perf_counter() - start
+
+        # Files were just written, so both paths read from a warm page cache
+        results[n] = {
+            "migrate_s": migrate_time,
+            "csv": cold_start(csv_filename),
+            "columnar": cold_start(args.filename),
+        }
+        for backend in ["csv", "columnar"]:
+            result = results[n][backend]
+            print(
+                f"rows={n:<9} {backend:<9} open {result['open_s']:7.3f} s  "
+                f"first query {result['first_query_s'] * 1000:7.2f} ms  "
+                f"rss {result['rss_mb']:7.1f} MB"
+            )
+
+        os.remove(csv_path)
+        shutil.rmtree(columnar_path)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
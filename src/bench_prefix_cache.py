@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+import numpy as np
+from llm import LlamaCPPLLM
+from prefix_cache import PrefixStateCache
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+SAMPLE_VALUES = {
+    "user_name": "John Smith",
+    "departure_date": "2023-05-03 14:00",
+    "arrival_date": "2023-05-03 17:00",
+    "seat_place": "C12",
+    "price": 950,
+    "city_name": "Kazan",
+    "cities": ["Kazan", "Perm", "Ufa", "Volgograd", "Saint Petersburg"],
+    "ticket_ids": [3, 8, 15, 21],
+    "dropped_filters": "a price up to 3",
+}
+
+
+def time_to_first_token(llm_agent: LlamaCPPLLM, prompt: str, context_key=None) -> float:
+    start = time.perf_counter()
+    completion = llm_agent.create_completion(
+        prompt, stream=True, context_key=context_key, max_tokens=1
+    )
+    next(iter(completion), None)
+    elapsed = time.perf_counter() - start
+    completion.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--request", default="I would like to fly to Kazan")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    llm_agent = LlamaCPPLLM(env["LLM_PATH"])
+    prefix_cache = PrefixStateCache(llm_agent.llama, max_bytes=2 * 1024**3)
+
+    results = {}
+    for key, system_context in llm_agent.system_contexts.items():
+        prompt = (
+            f"{system_context.format(**SAMPLE_VALUES)}\n{llm_agent.user}:\n"
+            f"{args.request}\n{llm_agent.assistant}:\n"
+        )
+
+        llm_agent.prefix_cache = None
+        cold = []
+        for _ in range(args.repeats):
+            llm_agent.llama.reset()
+            cold.append(time_to_first_token(llm_agent, prompt))
+
+        llm_agent.prefix_cache = prefix_cache
+        llm_agent.llama.reset()
+        time_to_first_token(llm_agent, prompt, context_key=key)  # fill the cache
+        cached = []
+        for _ in range(args.repeats):
+            # Drop the resident context so the state is loaded from the cache
+            llm_agent.llama.reset()
+            cached.append(time_to_first_token(llm_agent, prompt, context_key=key))
+
+        results[key] = {
+            "prefix_tokens": len(
+                prefix_cache.prefix_tokens(key, llm_agent.system_prefix(key))
+            ),
+            "prompt_tokens": len(llm_agent.llama.tokenize(prompt.encode("utf-8"))),
+            "ttft_cold_ms": float(np.mean(cold) * 1000),
+            "ttft_cached_ms": float(np.mean(cached) * 1000),
+            "speedup": float(np.mean(cold) / np.mean(cached)),
+        }
+
+    print(
+        f"{'context':<18}{'prefix tok':>11}{'prompt tok':>11}"
+        f"{'cold ms':>10}{'cached ms':>11}{'speedup':>9}"
+    )
+    for key, result in results.items():
+        print(
+            f"{key:<18}{result['prefix_tokens']:>11}{result['prompt_tokens']:>11}"
+            f"{result['ttft_cold_ms']:>10.1f}{result['ttft_cached_ms']:>11.1f}"
+            f"{result['speedup']:>8.2f}x"
+        )
+    print(f"Prefix cache: {prefix_cache.stats()}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"results": results, "cache": prefix_cache.stats()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
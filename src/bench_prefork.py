@@ -0,0 +1,224 @@
+import argparse
+import glob
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List
+from dotenv import dotenv_values
+from flights_db_filler import generate_random_flights
+
+env = dotenv_values(".env")
+
+NAME = "bench-prefork"
+CONVERSATION = [
+    "BUY a ticket",
+    "Kazan, something cheap",
+    "{ticket_id}",
+    "business",
+    "My name is John Smith",
+    "1234 567890",
+    "male",
+    "01-01-1990",
+    "john.smith@example.com",
+]
+
+
+def cheapest_kazan_flights(n_flights: int, n: int) -> List[int]:
+    # The same flights prefork.py generates; clients pick among the cheapest,
+    # a seat someone else took first just gets the question asked again
+    flights = pd.DataFrame(
+        generate_random_flights(n_flights, ["Kazan", "Ufa", "Moscow"], seed=0)
+    )
+    kazan = flights[flights["city_name"] == "Kazan"]
+    return kazan.sort_values("price").index[:n].tolist()
+
+
+def request(port: int, method: str, path: str, payload: Any = None) -> bytes:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        body = json.dumps(payload) if payload is not None else None
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path}: {response.status} {data!r}")
+        return data
+    finally:
+        connection.close()
+
+
+def wait_ready(port: int, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("prefork.py exited during startup")
+        try:
+            request(port, "GET", "/health")
+            return
+        except (OSError, RuntimeError):
+            time.sleep(0.2)
+    raise TimeoutError("prefork.py did not start in time")
+
+
+def run_clients(
+    port: int, n_clients: int, duration: float, ticket_ids: List[int]
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed: int) -> None:
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            session_id = str(uuid.uuid4())
+            for message in CONVERSATION:
+                if time.monotonic() >= deadline:
+                    break
+                message = message.format(ticket_id=rng.choice(ticket_ids))
+                start = time.perf_counter()
+                try:
+                    request(
+                        port,
+                        "POST",
+                        "/chat",
+                        {"session_id": session_id, "message": message},
+                    )
+                except (OSError, RuntimeError):
+                    with lock:
+                        errors[0] += 1
+                    continue
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+            request(port, "DELETE", f"/sessions/{session_id}")
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "turns": len(latencies),
+        "errors": errors[0],
+        "turns_per_sec": len(latencies) / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p95_ms": float(np.percentile(latencies, 95) * 1000),
+    }
+
+
+def cleanup() -> None:
+    db_path = env["DB_PATH"]
+    paths = glob.glob(f"{db_path}/{NAME}.*.wal") + glob.glob(
+        f"{db_path}/{NAME}.holds.sqlite3*"
+    )
+    for path in [f"{db_path}/{NAME}.sold"] + paths:
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(f"{db_path}/{NAME}.index", ignore_errors=True)
+
+
+def run(args: argparse.Namespace, n_processes: int) -> Dict[str, Any]:
+    cleanup()
+    port = args.port
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "prefork.py"),
+        "--processes",
+        str(n_processes),
+        "--port",
+        str(port),
+        "--flights",
+        NAME,
+        "--collection",
+        NAME,
+        "--synthetic-flights",
+        str(args.flights),
+        "--slot-responses",
+        args.slot_responses,
+    ]
+    if not args.real_models:
+        command += ["--stub-llm", "--stub-models"]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        wait_ready(port, process, args.startup_timeout)
+        ticket_ids = cheapest_kazan_flights(args.flights, 4 * n_processes)
+        results = run_clients(port, args.clients, args.duration, ticket_ids)
+        metrics = json.loads(request(port, "GET", "/metrics"))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        cleanup()
+
+    return dict(
+        results,
+        processes=n_processes,
+        parent_memory=metrics["parent"]["memory"],
+        workers=[
+            {"worker": worker["worker"], "turns": worker["turns"], **worker["memory"]}
+            for worker in metrics["workers"]
+        ],
+        total_memory=metrics["total"],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per run")
+    parser.add_argument("--flights", type=int, default=10_000)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--slot-responses", default="llm", choices=["llm", "template"])
+    parser.add_argument(
+        "--real-models",
+        action="store_true",
+        help="load Mistral and the HF models instead of the stubs",
+    )
+    parser.add_argument("--startup-timeout", type=float, default=600.0)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    runs = []
+    for n_processes in args.processes:
+        result = run(args, n_processes)
+        runs.append(result)
+        print(
+            f"processes={n_processes:<3} turns/s={result['turns_per_sec']:8.2f} "
+            f"p50={result['latency_p50_ms']:8.1f} ms "
+            f"p95={result['latency_p95_ms']:8.1f} ms "
+            f"errors={result['errors']}"
+        )
+        for worker in result["workers"]:
+            print(
+                f"  worker {worker['worker']}: turns={worker['turns']:<6} "
+                f"rss={worker.get('rss_kb', 0) / 1024:8.1f} MiB "
+                f"pss={worker.get('pss_kb', 0) / 1024:8.1f} MiB "
+                f"shared={worker.get('shared_kb', 0) / 1024:8.1f} MiB"
+            )
+        total = result["total_memory"]
+        print(
+            f"  total: rss={total['rss_kb'] / 1024:8.1f} MiB "
+            f"pss={total['pss_kb'] / 1024:8.1f} MiB"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import json
+import time
+import numpy as np
+from typing import Dict, List, Tuple
+from embedder import HFEmbedder
+from bert_ner import BERTNER
+from quantization import model_size_bytes
+
+CORPUS = [
+    "SHOW my ticket",
+    "BUY a ticket to Kazan",
+    "My name is John Smith",
+    "I am Anna Petrova, I want to fly to Saint Petersburg",
+    "Hello, this is Ivan Ivanov. My email is ivan.ivanov@example.com",
+    "Book me a business class seat, I'm Maria Garcia",
+    "My full name is Alexander Graham Bell and I was born 03-03-1985",
+    "Please show the ticket for Elena Sokolova to Novosibirsk",
+    "I'm a woman, my document number is 1234 567890",
+    "Dmitry Kuznetsov, economy class, Yekaterinburg",
+    "Can you tell me which flights go to Ufa next week?",
+    "Sergey here. first class to Krasnoyarsk please",
+    "The passenger is Olga Smirnova-Petrova",
+    "What did I book last time? My email is anna@mail.ru",
+    "Ticket for Mr. Robert Downey Jr., seat C12",
+    "Thanks, that's all",
+]
+
+
+def timed(fn, texts: List[str]) -> Tuple[list, float]:
+    start = time.perf_counter()
+    outputs = [fn(text) for text in texts]
+    return outputs, (time.perf_counter() - start) / len(texts)
+
+
+def entities(output: List[Dict]) -> List[Tuple[str, str]]:
+    return [(entity["word"], entity["entity"]) for entity in output]
+
+
+def check_embedder(corpus: List[str]) -> Dict[str, float]:
+    reference = HFEmbedder(cache_size=0, backend="torch")
+    quantized = HFEmbedder(cache_size=0, backend="int8")
+
+    reference_vectors, reference_latency = timed(reference.get_embeddings, corpus)
+    quantized_vectors, quantized_latency = timed(quantized.get_embeddings, corpus)
+
+    # Both are L2-normalized, so the dot product is the cosine similarity
+    cosines = np.sum(
+        np.array(reference_vectors)[:, 0] * np.array(quantized_vectors)[:, 0], axis=1
+    )
+
+    return {
+        "cosine_mean": float(np.mean(cosines)),
+        "cosine_min": float(np.min(cosines)),
+        "fp32_size_mb": model_size_bytes(reference.model) / 2**20,
+        "int8_size_mb": model_size_bytes(quantized.model) / 2**20,
+        "fp32_latency_ms": reference_latency * 1000,
+        "int8_latency_ms": quantized_latency * 1000,
+    }
+
+
+def check_ner(corpus: List[str]) -> Dict[str, float]:
+    reference = BERTNER(backend="torch")
+    quantized = BERTNER(backend="int8")
+
+    reference_outputs, reference_latency = timed(reference, corpus)
+    quantized_outputs, quantized_latency = timed(quantized, corpus)
+
+    exact, reference_total, matched = 0, 0, 0
+    for reference_output, quantized_output in zip(reference_outputs, quantized_outputs):
+        reference_entities = entities(reference_output)
+        quantized_entities = entities(quantized_output)
+        exact += reference_entities == quantized_entities
+        reference_total += len(reference_entities)
+        matched += len(set(reference_entities) & set(quantized_entities))
+
+    return {
+        "sentence_agreement": exact / len(corpus),
+        "entity_recall_vs_fp32": matched / reference_total if reference_total else 1.0,
+        "fp32_size_mb": model_size_bytes(reference.model) / 2**20,
+        "int8_size_mb": model_size_bytes(quantized.model) / 2**20,
+        "fp32_latency_ms": reference_latency * 1000,
+        "int8_latency_ms": quantized_latency * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--min-ner-agreement", type=float, default=0.9)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    results = {"embedder": check_embedder(CORPUS), "ner": check_ner(CORPUS)}
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    passed = (
+        results["embedder"]["cosine_min"] >= args.min_cosine
+        and results["ner"]["sentence_agreement"] >= args.min_ner_agreement
+    )
+    print("Parity check passed" if passed else "Parity check FAILED")
+    raise SystemExit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import pandas as pd
+from collections import Counter
+from typing import Dict, List
+from flights_db import FlightsDB
+from flights_db_filler import generate_random_flights
+from seat_inventory import SeatInventory, SeatUnavailableError
+
+
+def run_sessions(
+    inventory: SeatInventory,
+    n_tickets: int,
+    n_threads: int,
+    attempts: int,
+    think_time: float,
+) -> Dict[str, float]:
+    # Every thread plays sessions that hold a random seat, spend think_time
+    # filling in passenger details and then try to buy it
+    sold: List[int] = []
+    sold_lock = threading.Lock()
+
+    def session_loop(thread_id: int) -> None:
+        rng = random.Random(thread_id)
+        for attempt in range(attempts):
+            session_id = f"{thread_id}-{attempt}"
+            ticket_id = rng.randrange(n_tickets)
+            try:
+                inventory.hold(ticket_id, session_id)
+                if think_time:
+                    time.sleep(think_time)
+                inventory.commit(ticket_id, session_id)
+            except SeatUnavailableError:
+                continue
+            with sold_lock:
+                sold.append(ticket_id)
+
+    threads = [
+        threading.Thread(target=session_loop, args=(i,)) for i in range(n_threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    double_sales = sum(count - 1 for count in Counter(sold).values() if count > 1)
+    return {
+        "bookings": len(sold),
+        "attempts": n_threads * attempts,
+        "bookings_per_sec": len(sold) / elapsed,
+        "attempts_per_sec": n_threads * attempts / elapsed,
+        "double_sales": double_sales,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tickets", type=int, default=100_000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--attempts", type=int, default=500)
+    parser.add_argument("--stripes", type=int, nargs="+", default=[1, 64])
+    parser.add_argument(
+        "--think-ms",
+        type=float,
+        default=0.0,
+        help="time between hold and commit, e.g. waiting for passenger details",
+    )
+    parser.add_argument("--filename", default="bench_seats.csv")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    flights = pd.DataFrame(generate_random_flights(args.tickets, ["Kazan"], seed=0))
+
+    results = {}
+    failed = False
+    for n_stripes in args.stripes:
+        for n_threads in args.threads:
+            db = FlightsDB(args.filename, flights=flights)
+            inventory = SeatInventory(db, n_stripes=n_stripes)
+            result = run_sessions(
+                inventory, args.tickets, n_threads, args.attempts, args.think_ms / 1000
+            )
+            os.remove(db.sold_filename)
+
+            # Every booking must be a distinct seat, in memory and on disk
+            result["sold_in_db"] = sum(map(db.is_sold, range(args.tickets)))
+            ok = (
+                result["double_sales"] == 0
+                and result["sold_in_db"] == result["bookings"]
+            )
+            failed |= not ok
+            results[f"stripes={n_stripes},threads={n_threads}"] = result
+            print(
+                f"stripes={n_stripes:<4} threads={n_threads:<4} "
+                f"{result['bookings_per_sec']:9.0f} bookings/s "
+                f"{result['attempts_per_sec']:9.0f} attempts/s "
+                f"bookings {result['bookings']:<6} double sales {result['double_sales']} "
+                f"{'ok' if ok else 'FAILED'}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
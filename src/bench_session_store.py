@@ -0,0 +1,121 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+from typing import Any, Dict, List
+from session_store import SessionStore
+
+CITIES = ["Kazan", "Perm", "Ufa", "Volgograd", "Saint Petersburg", "Novosibirsk"]
+
+
+def fill(session: Any, rng: random.Random) -> None:
+    # A BUY flow abandoned half way: flight chosen, passenger details partly in
+    session.current_response = "add_ticket_response"
+    session.ticket_info.update(
+        city_name=rng.choice(CITIES),
+        ticket_id=rng.randrange(1_000_000),
+        departure_date="2024-05-05 14:00",
+        arrival_date="2024-05-05 17:00",
+        seat_place=f"{rng.choice('ABCDEF')}{rng.randint(1, 30)}",
+        price=rng.randint(50, 900),
+        class_of_service="business",
+        user_name="John Smith",
+    )
+    session.flight_filters = {
+        "sort_by": "price",
+        "departure_from": datetime.datetime(2024, 5, 5),
+        "departure_to": datetime.datetime(2024, 5, 6),
+    }
+    session.prompt_tokens = [rng.randint(200, 600) for _ in range(4)]
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    return {
+        "p50_ms": float(np.percentile(seconds, 50) * 1000),
+        "p95_ms": float(np.percentile(seconds, 95) * 1000),
+        "p99_ms": float(np.percentile(seconds, 99) * 1000),
+    }
+
+
+def run(args: argparse.Namespace, path: str) -> Dict[str, Any]:
+    rng = random.Random(0)
+    store = SessionStore(
+        path,
+        max_resident=args.max_resident,
+        max_bytes=args.memory_mb * 1024 * 1024,
+    )
+
+    # Every customer starts a booking and walks away
+    ids = [f"session-{i}" for i in range(args.sessions)]
+    start = time.perf_counter()
+    for session_id in ids:
+        session = store.acquire(session_id)
+        fill(session, rng)
+        store.release(session)
+    create_seconds = time.perf_counter() - start
+    after_create = store.stats()
+
+    # Some of them come back, in random order
+    returning = rng.sample(ids, min(args.returning, len(ids)))
+    turns = []
+    for session_id in returning:
+        start = time.perf_counter()
+        session = store.acquire(session_id)
+        assert session.current_response == "add_ticket_response"
+        store.release(session)
+        turns.append(time.perf_counter() - start)
+    stats = store.stats()
+    store.close()
+
+    return {
+        "args": vars(args),
+        "sessions_per_sec": args.sessions / create_seconds,
+        "after_create": after_create,
+        "returning_turn": percentiles(turns),
+        "store": stats,
+        "file_bytes_per_session": os.path.getsize(path) / args.sessions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--returning", type=int, default=10_000)
+    parser.add_argument("--max-resident", type=int, default=1024)
+    parser.add_argument("--memory-mb", type=int, default=64)
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run(args, os.path.join(directory, "sessions.sqlite3"))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    stats = results["store"]
+    print(f"new sessions/sec: {results['sessions_per_sec']:.0f}")
+    print(
+        f"resident: {stats['resident']} ({stats['resident_bytes'] / 1024:.0f} KiB), "
+        f"spilled: {stats['spilled']}, evictions: {stats['evictions']}"
+    )
+    print(f"on disk: {results['file_bytes_per_session']:.0f} bytes/session")
+    turn = results["returning_turn"]
+    print(
+        f"returning session acquire+release: p50={turn['p50_ms']:.3f} ms "
+        f"p95={turn['p95_ms']:.3f} ms p99={turn['p99_ms']:.3f} ms, "
+        f"restore mean={stats['restore_ms_mean']:.3f} ms "
+        f"max={stats['restore_ms_max']:.3f} ms"
+    )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
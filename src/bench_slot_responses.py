@@ -0,0 +1,154 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List
+from flights_db import FlightsDB
+from flights_db_filler import generate_random_flights
+from llm import LlamaCPPLLM
+from models import registry
+from seat_inventory import SeatInventory
+from session import BookingSession
+from stubs import StubEmbedder, StubLlama, StubNER
+from tickets_db import TicketsDB
+
+# One booking, one ticket field per message; {ticket_id} is taken from the
+# flights offered on the previous turn
+SCRIPT = [
+    "BUY a ticket",
+    "Kazan",
+    "{ticket_id}",
+    "business",
+    "My name is John Smith",
+    "1234 567890",
+    "male",
+    "01-01-1990",
+    "john.smith@example.com",
+]
+
+MODES = {
+    # The model answers every turn with the old flat 512-token budget
+    "llm-512": {"slot_responses": "llm", "budgets": False},
+    "llm": {"slot_responses": "llm", "budgets": True},
+    "template": {"slot_responses": "template", "budgets": True},
+}
+
+
+class TimedLLM(LlamaCPPLLM):
+    # Remembers which system context answered the turn
+    def response(self, request: str, streaming: bool, **kwargs: Any) -> Any:
+        self.turn_key = kwargs.get("context_key")
+        return super().response(request, streaming, **kwargs)
+
+    def template_response(self, context_key: str, **values: Any) -> Any:
+        self.turn_key = f"{context_key} (template)"
+        return super().template_response(context_key, **values)
+
+
+def run_mode(
+    mode: str, args: argparse.Namespace, tickets_db: TicketsDB, flights: pd.DataFrame
+) -> Dict[str, Dict[str, float]]:
+    flights_db = FlightsDB(args.filename, flights=flights)
+    llama = StubLlama(
+        tokens=[" word"] * args.answer_tokens,
+        token_delay=args.token_delay,
+        prompt_delay=args.prompt_delay,
+    )
+    agent = TimedLLM(
+        None,
+        tickets_db,
+        flights_db,
+        llama=llama,
+        inventory=SeatInventory(flights_db),
+        slot_responses=MODES[mode]["slot_responses"],
+    )
+    if not MODES[mode]["budgets"]:
+        agent.max_tokens = {}
+    agent.streaming = True
+
+    turns: Dict[str, List[float]] = {}
+    first_tokens: Dict[str, List[float]] = {}
+    try:
+        for _ in range(args.conversations):
+            agent.session = BookingSession()
+            for message in SCRIPT:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if "{ticket_id}" in message:
+                        message = message.format(
+                            ticket_id=agent.flights_page().index[0]
+                        )
+                    start = time.perf_counter()
+                    first_token = None
+                    for _ in agent.generate(message):
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                    elapsed = time.perf_counter() - start
+                turns.setdefault(agent.turn_key, []).append(elapsed * 1000)
+                first_tokens.setdefault(agent.turn_key, []).append(first_token * 1000)
+    finally:
+        if os.path.exists(flights_db.sold_filename):
+            os.remove(flights_db.sold_filename)
+
+    return {
+        key: {
+            "turns": len(times),
+            "turn_ms": float(np.mean(times)),
+            "first_token_ms": float(np.mean(first_tokens[key])),
+        }
+        for key, times in turns.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=3)
+    # Stub model timings, roughly a 7B Q4 model on CPU
+    parser.add_argument("--prompt-delay", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument(
+        "--answer-tokens",
+        type=int,
+        default=160,
+        help="tokens the stub model generates when its budget allows",
+    )
+    parser.add_argument("--filename", default="bench_slot_responses.csv")
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    registry.set("bert_ner", StubNER())
+    flights = pd.DataFrame(generate_random_flights(1000, ["Kazan", "Ufa"], seed=0))
+    db_path = tempfile.mkdtemp()
+    try:
+        tickets_db = TicketsDB(
+            "bench-slot-responses",
+            db_path=db_path,
+            embedder=StubEmbedder(),
+            flush_interval=None,
+            index="numpy",
+        )
+        results = {mode: run_mode(mode, args, tickets_db, flights) for mode in MODES}
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+
+    for mode, result in results.items():
+        total = sum(turn["turn_ms"] * turn["turns"] for turn in result.values())
+        print(f"{mode}: {total / args.conversations / 1000:.2f} s per booking")
+        for key, turn in result.items():
+            print(
+                f"  {key:<30}{turn['turn_ms']:10.1f} ms/turn "
+                f"{turn['first_token_ms']:10.1f} ms to first token"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
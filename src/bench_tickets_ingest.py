@@ -0,0 +1,85 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from typing import Any, Dict
+from tickets_db import TicketsDB
+
+TICKET = (
+    "{{'city_name': 'Kazan', 'ticket_id': {i}, 'departure_date': '2023-07-28 14:00', "
+    "'arrival_date': '2023-07-28 17:00', 'seat_place': 'C12', 'price': 555, "
+    "'class_of_service': 'business', 'user_name': 'John Smith {i}', "
+    "'document_number': '1234 {i:06d}', 'gender': 'male', "
+    "'birth_date': '1990-01-01', 'email': 'john{i}@example.com'}}"
+)
+
+
+def ingest(embedder: Any, n: int, flush_size: int, fsync: bool) -> Dict[str, float]:
+    db_path = tempfile.mkdtemp()
+    try:
+        db = TicketsDB(
+            "bench-tickets",
+            db_path=db_path,
+            embedder=embedder,
+            flush_size=flush_size,
+            flush_interval=None,
+            fsync=fsync,
+        )
+        start = time.perf_counter()
+        for i in range(n):
+            db.add(TICKET.format(i=i))
+        acked = time.perf_counter() - start
+        db.close()
+        elapsed = time.perf_counter() - start
+        assert db.collection.count() == n
+        return {
+            "tickets_per_sec": n / elapsed,
+            "add_latency_ms": acked / n * 1000,
+            "flushes": db.n_flushes,
+        }
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tickets", type=int, default=512)
+    parser.add_argument("--flush-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--no-fsync", action="store_true")
+    parser.add_argument(
+        "--stub-embedder",
+        action="store_true",
+        help="simulated embedder (20 ms per call + 2 ms per text) instead of the model",
+    )
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    if args.stub_embedder:
+        from stubs import StubEmbedder
+
+        embedder = StubEmbedder(call_delay=0.02, text_delay=0.002)
+    else:
+        from embedder import HFEmbedder
+
+        # No cache, so every ticket goes through the model
+        embedder = HFEmbedder(cache_size=0)
+
+    # flush_size=1 is one forward pass and one Chroma write per ticket, as
+    # before the buffer
+    results = {}
+    for flush_size in args.flush_sizes:
+        result = ingest(embedder, args.tickets, flush_size, not args.no_fsync)
+        results[flush_size] = result
+        print(
+            f"flush_size={flush_size:<5} {result['tickets_per_sec']:8.1f} tickets/s "
+            f"add() {result['add_latency_ms']:7.2f} ms  flushes {result['flushes']}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
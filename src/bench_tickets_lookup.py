@@ -0,0 +1,121 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import numpy as np
+from typing import Any, Callable, Dict, List
+from session import TICKET_FIELDS
+from tickets_db import TicketsDB
+
+CITIES = ["Kazan", "Moscow", "Ufa", "Novosibirsk", "Yekaterinburg", "Krasnoyarsk"]
+
+
+def make_ticket(i: int) -> Dict[str, Any]:
+    ticket = {field: None for field in TICKET_FIELDS}
+    ticket.update(
+        city_name=CITIES[i % len(CITIES)],
+        ticket_id=i,
+        departure_date=f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 14:00",
+        arrival_date=f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d} 17:00",
+        seat_place=f"{chr(65 + i % 6)}{i % 30 + 1}",
+        price=100 + i % 900,
+        class_of_service=["economy", "business", "first"][i % 3],
+        user_name=f"Passenger {i}",
+        document_number=f"{1000 + i % 9000} {i:06d}",
+        gender=["male", "female"][i % 2],
+        birth_date="1990-01-01",
+        email=f"passenger{i}@example.com",
+    )
+    return ticket
+
+
+def per_call_ms(fn: Callable, args: List[Any]) -> Dict[str, float]:
+    times = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    return {"mean_ms": float(np.mean(times)), "p95_ms": float(np.percentile(times, 95))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tickets", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--n-results", type=int, default=3)
+    parser.add_argument(
+        "--stub-embedder", action="store_true", help="hash vectors instead of the model"
+    )
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    if args.stub_embedder:
+        from stubs import StubEmbedder
+
+        embedder = StubEmbedder()
+    else:
+        from embedder import HFEmbedder
+
+        # No cache: repeated questions would otherwise skip the model
+        embedder = HFEmbedder(cache_size=0)
+
+    db_path = tempfile.mkdtemp()
+    try:
+        db = TicketsDB(
+            "bench-tickets",
+            db_path=db_path,
+            embedder=embedder,
+            flush_size=256,
+            flush_interval=None,
+            fsync=False,
+        )
+        for i in range(args.tickets):
+            db.add_ticket(make_ticket(i))
+        db.flush()
+
+        rng = np.random.default_rng(0)
+        picked = [
+            make_ticket(int(i)) for i in rng.integers(0, args.tickets, args.queries)
+        ]
+
+        def by_email(ticket: Dict) -> List[Dict]:
+            return db.lookup({"email": ticket["email"]}, args.n_results)
+
+        def by_document_number(ticket: Dict) -> List[Dict]:
+            # Typed without the space, as users often do
+            number = ticket["document_number"].replace(" ", "")
+            return db.lookup({"document_number": number}, args.n_results)
+
+        def by_vector(ticket: Dict) -> Dict:
+            return db.query(
+                f"Show my ticket, my email is {ticket['email']}",
+                n_results=args.n_results,
+                return_text=False,
+            )
+
+        for ticket in picked[:10]:
+            assert by_email(ticket)[0]["ticket_id"] == ticket["ticket_id"]
+            assert by_document_number(ticket)[0]["ticket_id"] == ticket["ticket_id"]
+
+        results = {
+            "exact_email": per_call_ms(by_email, picked),
+            "exact_document_number": per_call_ms(by_document_number, picked),
+            "vector_search": per_call_ms(by_vector, picked),
+        }
+    finally:
+        shutil.rmtree(db_path, ignore_errors=True)
+
+    print(f"{args.tickets} tickets, {args.queries} queries")
+    for name, result in results.items():
+        print(
+            f"{name:<24}{result['mean_ms']:10.2f} ms mean{result['p95_ms']:10.2f} ms p95"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
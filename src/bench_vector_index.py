@@ -0,0 +1,135 @@
+import argparse
+import json
+import shutil
+import tempfile
+import time
+import numpy as np
+from typing import Any, Dict, List
+from vector_index import NumpyIndex, open_index
+
+
+def make_vectors(n: int, centers: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    # Unit vectors around a few hundred topics, closer to real sentence
+    # embeddings than uniform noise
+    dim = centers.shape[1]
+    vectors = centers[rng.integers(0, len(centers), n)] + rng.normal(
+        scale=0.5 / np.sqrt(dim), size=(n, dim)
+    ).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def fill(index: Any, n: int, centers: np.ndarray, batch_size: int) -> float:
+    # Same seed for every index, so they all hold the same vectors
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for offset in range(0, n, batch_size):
+        size = min(batch_size, n - offset)
+        index.upsert(
+            ids=[str(offset + i) for i in range(size)],
+            embeddings=make_vectors(size, centers, rng).tolist(),
+            documents=["" for _ in range(size)],
+            metadatas=[{"n": offset + i} for i in range(size)],
+        )
+    return time.perf_counter() - start
+
+
+def search(index: Any, queries: np.ndarray, k: int) -> Dict[str, Any]:
+    times, ids = [], []
+    for query in queries:
+        start = time.perf_counter()
+        result = index.query(query_embeddings=[query.tolist()], n_results=k)
+        times.append((time.perf_counter() - start) * 1000)
+        ids.append(result["ids"][0])
+    return {
+        "ids": ids,
+        "mean_ms": float(np.mean(times)),
+        "p95_ms": float(np.percentile(times, 95)),
+    }
+
+
+def recall(found: List[List[str]], exact: List[List[str]]) -> float:
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found, exact)]))
+
+
+def run(n: int, args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    rng = np.random.default_rng(1)
+    centers = rng.normal(size=(256, args.dim)).astype(np.float32) / np.sqrt(args.dim)
+    queries = make_vectors(args.queries, centers, rng)
+
+    kinds = ["numpy", "ivf"]
+    if n <= args.chroma_max_size:
+        kinds.append("chroma")
+
+    results, exact = {}, None
+    for kind in kinds:
+        db_path = tempfile.mkdtemp()
+        try:
+            try:
+                index = open_index(kind, db_path, "bench")
+            except ImportError:
+                print("chromadb is not installed, skipping it")
+                continue
+            build = fill(index, n, centers, args.batch_size)
+
+            start = time.perf_counter()
+            if kind != "chroma":
+                index = NumpyIndex(index.path, index.n_lists, index.n_probe)
+            else:
+                index = open_index(kind, db_path, "bench")
+            reopen = time.perf_counter() - start
+
+            found = search(index, queries, args.k)
+            if exact is None:
+                exact = found["ids"]
+            results[kind] = {
+                "build_s": build,
+                "open_s": reopen,
+                "query_mean_ms": found["mean_ms"],
+                "query_p95_ms": found["p95_ms"],
+                f"recall@{args.k}": recall(found["ids"], exact),
+            }
+        finally:
+            shutil.rmtree(db_path, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    # sup-simcse-roberta-large vectors; 1M of them take 4 GB on disk
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--chroma-max-size",
+        type=int,
+        default=100_000,
+        help="skip Chroma above this size, its inserts take hours at 1M",
+    )
+    parser.add_argument("--output", default=None, help="save results as JSON")
+    args = parser.parse_args()
+
+    # The exact index is the ground truth for recall
+    results = {}
+    for n in args.sizes:
+        results[n] = run(n, args)
+        print(f"{n} tickets")
+        for kind, result in results[n].items():
+            print(
+                f"  {kind:<8}build {result['build_s']:8.2f} s  "
+                f"open {result['open_s']:6.2f} s  "
+                f"query {result['query_mean_ms']:8.2f} ms mean "
+                f"{result['query_p95_ms']:8.2f} ms p95  "
+                f"recall@{args.k} {result[f'recall@{args.k}']:.3f}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
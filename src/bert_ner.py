@@ -1,23 +1,31 @@
-import os
-import torch
-
-from transformers import AutoTokenizer, AutoModelForTokenClassification
-from transformers import pipeline
 from dotenv import dotenv_values
-from transformers import logging
-
-logging.set_verbosity_error()
+from models import configure_hf_env
+from quantization import check_backend, quantize_int8
+from telemetry import telemetry
 
 env = dotenv_values(".env")
-os.environ["HUGGINGFACE_HUB_CACHE"] = env["HUGGINGFACE_HUB_CACHE"]
 
 
 class BERTNER:
-    def __init__(self, model="dslim/bert-large-NER"):
+    def __init__(self, model="dslim/bert-large-NER", backend=None):
+        # transformers is imported here so that importing this module stays cheap
+        configure_hf_env()
+        from transformers import AutoTokenizer, AutoModelForTokenClassification
+        from transformers import pipeline
+        from transformers import logging
+
+        logging.set_verbosity_error()
+
         # self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        backend = backend or env.get("MODEL_BACKEND") or "torch"
+        check_backend(backend)
+        self.backend = backend
         self.tokenizer = AutoTokenizer.from_pretrained(model)
         self.model = AutoModelForTokenClassification.from_pretrained(model)
+        if backend == "int8":
+            self.model = quantize_int8(self.model)
         self.nlp = pipeline("ner", model=self.model, tokenizer=self.tokenizer)
 
+    @telemetry.traced("model.ner")
     def __call__(self, text):
         return self.nlp(text)
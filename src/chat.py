@@ -1,7 +1,10 @@
+import time
+from concurrent.futures import wait
 from llm import LlamaCPPLLM
-from embedder import HFEmbedder
+from models import registry
 from tickets_db import TicketsDB
 from flights_db import FlightsDB
+from telemetry import telemetry
 from dotenv import dotenv_values
 
 env = dotenv_values(".env")
@@ -25,13 +28,27 @@ def chat() -> None:
 
 
 if __name__ == "__main__":
-    embedder = HFEmbedder()
-
-    tickets_db = TicketsDB("total-memory", embedder=embedder)
-    flights_db = FlightsDB("flights.csv")
-
-    llm_agent = LlamaCPPLLM(env["LLM_PATH"], tickets_db, flights_db)
+    # Prints what the agent is doing between the messages
+    telemetry.configure(console=True)
+    start = time.perf_counter()
+    # LLM, embedder and NER load in parallel background threads
+    warmup = registry.warmup(["llama", "embedder", "bert_ner"])
+
+    tickets_db = TicketsDB("total-memory", embedder=registry.get("embedder"))
+    flights_db = FlightsDB("flights")
+
+    llm_agent = LlamaCPPLLM(
+        env["LLM_PATH"], tickets_db, flights_db, llama=registry.get("llama")
+    )
+
+    wait(warmup.values())
+    print(registry.report())
+    print(f"Startup time: {time.perf_counter() - start:.2f} s")
     llm_agent.user = "### Instructions"  # "USER", ### Human
     llm_agent.assistant = "### Response"  # "ASSISTANT"
 
-    chat()
+    try:
+        chat()
+    finally:
+        tickets_db.close()
+        telemetry.close()
@@ -1,13 +1,13 @@
-import torch
-import os
 import numpy as np
-from transformers import AutoModel, AutoTokenizer
 from chromadb import EmbeddingFunction
-from typing import Any, List, Union
+from typing import Any, List, Optional, Union
+from embedding_cache import EmbeddingCache, normalize_text
+from models import configure_hf_env
+from quantization import check_backend, quantize_int8
+from telemetry import telemetry
 from dotenv import dotenv_values
 
 env = dotenv_values(".env")
-os.environ["HUGGINGFACE_HUB_CACHE"] = env["HUGGINGFACE_HUB_CACHE"]
 
 
 class BaseEmbedder(EmbeddingFunction):
@@ -24,15 +24,50 @@ class BaseEmbedder(EmbeddingFunction):
 # https://huggingface.co/princeton-nlp/sup-simcse-roberta-large
 class HFEmbedder(BaseEmbedder):
     def __init__(
-        self, model: str = "princeton-nlp/sup-simcse-roberta-large"
+        self,
+        model: str = "princeton-nlp/sup-simcse-roberta-large",
+        cache_size: int = 4096,
+        cache_dir: Optional[str] = None,
+        backend: Optional[str] = None,
     ) -> None:  # sentence-transformers/all-MiniLM-L6-v2
-        self.device: str = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = AutoModel.from_pretrained(model).to(self.device)
+        # torch and transformers are imported here so that importing this
+        # module stays cheap
+        configure_hf_env()
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        backend = backend or env.get("MODEL_BACKEND") or "torch"
+        check_backend(backend)
+        self.backend = backend
+        self.model_name = model
         self.tokenizer = AutoTokenizer.from_pretrained(model)
 
-    def get_embeddings(self, texts: Union[str, List[str]]) -> List[List[float]]:
-        if type(texts) == str:
-            texts = [texts]
+        if backend == "int8":
+            self.device: str = "cpu"
+            self.model = quantize_int8(AutoModel.from_pretrained(model))
+        else:
+            self.device: str = "cuda" if torch.cuda.is_available() else "cpu"
+            self.model = AutoModel.from_pretrained(model).to(self.device)
+        self.model.eval()
+
+        # In-memory LRU of `cache_size` vectors, backed by an on-disk store
+        # when cache_dir is given; cache_size=0 without cache_dir disables it
+        self.cache: Optional[EmbeddingCache] = (
+            EmbeddingCache(
+                model if backend == "torch" else f"{model}:{backend}",
+                self.model.config.hidden_size,
+                max_items=cache_size,
+                cache_dir=cache_dir,
+            )
+            if cache_size > 0 or cache_dir
+            else None
+        )
+
+    @telemetry.traced("model.embedder")
+    def encode(self, texts: List[str]) -> np.ndarray:
+        import torch
+
+        telemetry.count("embedded_texts_total", len(texts))
 
         inputs = self.tokenizer(
             texts, padding=True, truncation=True, return_tensors="pt"
@@ -47,9 +82,34 @@ class HFEmbedder(BaseEmbedder):
             )
 
         norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-        normalized_embeddings = embeddings / norms
+        return (embeddings / norms).astype(np.float32)
+
+    def get_embeddings(self, texts: Union[str, List[str]]) -> List[List[float]]:
+        if type(texts) == str:
+            texts = [texts]
+
+        if self.cache is None:
+            return self.encode(texts).tolist()
+
+        texts = [normalize_text(text) for text in texts]
+        embeddings = self.cache.get_many(texts)
+
+        # Only texts missing from both cache tiers go through the model
+        misses = list(
+            dict.fromkeys(
+                text for text, embedding in zip(texts, embeddings) if embedding is None
+            )
+        )
+        if misses:
+            encoded = self.encode(misses)
+            self.cache.put_many(misses, encoded)
+            encoded_by_text = dict(zip(misses, encoded))
+            embeddings = [
+                encoded_by_text[text] if embedding is None else embedding
+                for text, embedding in zip(texts, embeddings)
+            ]
 
-        return normalized_embeddings.tolist()
+        return np.stack(embeddings).tolist()
 
     def __call__(self, text: str) -> List[List[float]]:
         return self.get_embeddings(text)
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Union
+from embedder import BaseEmbedder, HFEmbedder
+
+
+class BatchingEmbedder(BaseEmbedder):
+    # Collects texts from concurrent callers for up to max_wait_ms, groups
+    # them by token length so each forward pass pads as little as possible
+    # and resolves one future per text
+    def __init__(
+        self,
+        embedder: HFEmbedder,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        bucket_width: int = 8,
+    ) -> None:
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_width = bucket_width
+
+        self._pending: List[Tuple[str, Future]] = []
+        self._first_pending_at = 0.0
+        self._condition = threading.Condition()
+        self._running = True
+
+        self.n_batches = 0
+        self.n_texts = 0
+        self.n_padding_tokens = 0
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        future: Future = Future()
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Batching embedder is shut down")
+            if not self._pending:
+                self._first_pending_at = time.monotonic()
+            self._pending.append((text, future))
+            self._condition.notify()
+        return future
+
+    def get_embeddings(self, texts: Union[str, List[str]]) -> List[List[float]]:
+        if type(texts) == str:
+            texts = [texts]
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def _take_batch(self) -> List[Tuple[str, Future]]:
+        with self._condition:
+            while self._running and not self._pending:
+                self._condition.wait()
+
+            while self._running and len(self._pending) < self.max_batch_size:
+                remaining = self._first_pending_at + self.max_wait - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, self._pending = self._pending, []
+            return batch
+
+    def _buckets(self, texts: List[str]) -> List[List[int]]:
+        input_ids = self.embedder.tokenizer(texts, truncation=True)["input_ids"]
+        lengths = [len(ids) for ids in input_ids]
+
+        by_bucket: Dict[int, List[int]] = defaultdict(list)
+        for i, length in enumerate(lengths):
+            by_bucket[-(-length // self.bucket_width)].append(i)
+
+        batches = []
+        for bucket in sorted(by_bucket):
+            indices = by_bucket[bucket]
+            for start in range(0, len(indices), self.max_batch_size):
+                chunk = indices[start : start + self.max_batch_size]
+                longest = max(lengths[i] for i in chunk)
+                self.n_padding_tokens += sum(longest - lengths[i] for i in chunk)
+                batches.append(chunk)
+        return batches
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if not self._running:
+                    return
+                continue
+
+            texts = [text for text, _ in batch]
+            try:
+                buckets = self._buckets(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for indices in buckets:
+                try:
+                    embeddings = self.embedder.get_embeddings(
+                        [texts[i] for i in indices]
+                    )
+                except Exception as e:
+                    for i in indices:
+                        batch[i][1].set_exception(e)
+                    continue
+                for i, embedding in zip(indices, embeddings):
+                    batch[i][1].set_result(embedding)
+                self.n_batches += 1
+                self.n_texts += len(indices)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.n_batches,
+            "texts": self.n_texts,
+            "mean_batch_size": self.n_texts / self.n_batches if self.n_batches else 0.0,
+            "padding_tokens": self.n_padding_tokens,
+        }
+
+    def shutdown(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._worker.join()
@@ -0,0 +1,168 @@
+import os
+import re
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    # Texts are embedded in normalized form, so a cache hit always returns
+    # exactly what the model would produce for the same input
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class DiskEmbeddingStore:
+    # Append-only float32 matrix (memory-mapped for reads) plus a keys file
+    # whose line number is the row index. Vectors are written before their
+    # keys, so an interrupted write never leaves a key without data.
+    def __init__(self, path: str, dim: int) -> None:
+        self.vectors_path = f"{path}.f32"
+        self.keys_path = f"{path}.keys"
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+
+        self.index: Dict[str, int] = {}
+        self._mmap: Optional[np.memmap] = None
+        self._mapped_rows = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(self.keys_path) and os.path.exists(self.vectors_path):
+            n_rows = os.path.getsize(self.vectors_path) // self.row_bytes
+            with open(self.keys_path, "r", encoding="utf-8") as f:
+                keys = [key.strip() for key in f]
+            for row, key in enumerate(keys[:n_rows]):
+                self.index[key] = row
+
+            size = os.path.getsize(self.vectors_path)
+            if len(keys) != n_rows or size % self.row_bytes:
+                # Drop a partially written tail before appending again
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(len(self.index) * self.row_bytes)
+                with open(self.keys_path, "w", encoding="utf-8") as f:
+                    f.writelines(f"{key}\n" for key in self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _remap(self) -> None:
+        n_rows = os.path.getsize(self.vectors_path) // self.row_bytes
+        self._mmap = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim)
+        )
+        self._mapped_rows = n_rows
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self.index.get(key)
+            if row is None:
+                return None
+            if row >= self._mapped_rows:
+                self._remap()
+            return np.array(self._mmap[row])
+
+    def put_many(self, keys: List[str], vectors: np.ndarray) -> None:
+        with self._lock:
+            new, seen = [], set()
+            for i, key in enumerate(keys):
+                if key not in self.index and key not in seen:
+                    new.append(i)
+                    seen.add(key)
+            if not new:
+                return
+
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors[new], dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.keys_path, "a", encoding="utf-8") as f:
+                f.writelines(f"{keys[i]}\n" for i in new)
+
+            start = len(self.index)
+            for offset, i in enumerate(new):
+                self.index[keys[i]] = start + offset
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        model_name: str,
+        dim: int,
+        max_items: int = 4096,
+        cache_dir: Optional[str] = None,
+    ) -> None:
+        self.model_name = model_name
+        self.max_items = max_items
+
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = (
+            DiskEmbeddingStore(
+                os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", model_name)), dim
+            )
+            if cache_dir
+            else None
+        )
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(
+            f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")
+        ).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        if self.max_items <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+        vector = self.disk.get(key) if self.disk is not None else None
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, vector)
+        return vector
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        return [self.get(text) for text in texts]
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        keys = [self.key(text) for text in texts]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+        if self.disk is not None:
+            self.disk.put_many(keys, vectors)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_items": len(self._memory),
+            "disk_items": len(self.disk) if self.disk is not None else 0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups
+            if lookups
+            else 0.0,
+        }
@@ -1,144 +1,446 @@
+import argparse
+import csv
+import json
 import os
+import time
 import numpy as np
-from evaluate import load
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from llm import LlamaCPPLLM
-from typing import Union, List
-from tqdm import tqdm
+from models import configure_hf_env
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
 from dotenv import dotenv_values
 
 env = dotenv_values(".env")
-os.environ["HUGGINGFACE_HUB_CACHE"] = env["HUGGINGFACE_HUB_CACHE"]
+
+DATASET_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", "eval_questions.jsonl"
+)
+PROMPT = "### Instruction:\n{question}\n### Response:\n"
+METRICS = ("bertscore", "bleurt", "rouge")
+
+
+def load_dataset(path: str) -> List[Dict[str, str]]:
+    # JSONL or a JSON list of {"question", "answer"[, "id"]} objects, or a CSV
+    # with question and answer columns; ids default to the row number
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        elif path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = json.load(f)
+
+    items = [
+        {
+            "id": str(i if row.get("id") in (None, "") else row["id"]),
+            "question": row["question"],
+            "answer": row["answer"],
+        }
+        for i, row in enumerate(rows)
+    ]
+    if len({item["id"] for item in items}) != len(items):
+        raise ValueError(f"Duplicate question ids in {path}")
+    return items
+
+
+def read_jsonl(path: str) -> List[Dict[str, Any]]:
+    # Records of a checkpoint; a line torn by a crash mid-write is cut off, so
+    # appending continues from the last complete record
+    if not os.path.exists(path):
+        return []
+    records, size = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            size += len(line)
+    if size < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(size)
+    return records
+
+
+def read_checkpoint_run(path: str, run: Dict[str, Any]) -> bool:
+    # Whether the checkpoint at path was made by the same run (dataset, model,
+    # generation settings); if not, or if there is none, run is saved as its own
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved == run:
+            return True
+        changed = sorted(
+            key for key in run.keys() | saved.keys() if saved.get(key) != run.get(key)
+        )
+        print(f"Checkpoint {path} is for another {', '.join(changed)}, starting over")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(run, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+    return False
+
+
+def write_jsonl(path: str, records: List[Dict[str, Any]]) -> None:
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def append_jsonl(f: Any, record: Dict[str, Any]) -> None:
+    if f is not None:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+
+
+def generate(llama: Any, item: Dict[str, str], max_tokens: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    completion = llama.create_completion(
+        PROMPT.format(question=item["question"]), max_tokens=max_tokens
+    )
+    latency = time.perf_counter() - start
+
+    prediction = completion["choices"][0]["text"]
+    tokens = completion.get("usage", {}).get("completion_tokens")
+    if tokens is None:
+        tokens = len(llama.tokenize(prediction.encode("utf-8"), add_bos=False))
+    return dict(
+        item,
+        prediction=prediction,
+        latency_s=latency,
+        completion_tokens=tokens,
+        tokens_per_sec=tokens / latency if latency > 0 else 0.0,
+    )
+
+
+# The model of a generation pool process, loaded once by the initializer
+_worker_llama = None
+
+
+def _init_worker(llama_factory: Callable[[], Any]) -> None:
+    global _worker_llama
+    _worker_llama = llama_factory()
+
+
+def _generate_in_worker(item: Dict[str, str], max_tokens: int) -> Dict[str, Any]:
+    return generate(_worker_llama, item, max_tokens)
+
+
+def llama_factory(
+    model_path: str, workers: int = 1, n_threads: Optional[int] = None
+) -> Callable[[], Any]:
+    from llama_cpp import Llama
+
+    # The cores are split between the workers, each runs its own Llama
+    n_threads = n_threads or max(1, (os.cpu_count() or 1) // workers)
+    return partial(
+        Llama, model_path=model_path, n_ctx=2048, n_threads=n_threads, verbose=False
+    )
 
 
 class LLMEvaluator:
-    def __init__(self, model: LlamaCPPLLM):
+    # Generates the predictions with a pool of worker processes, each loading
+    # its own model through llama_factory (or in-process with the model of
+    # `model`), and scores them in batches while generation goes on. With a
+    # checkpoint, every prediction and batch of scores is appended to
+    # {checkpoint}.predictions.jsonl / {checkpoint}.scores.jsonl as soon as
+    # it is ready, and a rerun only does the questions missing from them.
+    # {checkpoint}.json holds the run they were made by (the `run` of
+    # evaluate_dataset plus max_tokens); a different run starts over.
+    def __init__(
+        self,
+        model: Optional[LlamaCPPLLM] = None,
+        llama_factory: Optional[Callable[[], Any]] = None,
+        workers: int = 1,
+        metrics: Sequence[str] = METRICS,
+        batch_size: int = 8,
+        max_tokens: int = 512,
+    ):
+        assert model is not None or llama_factory is not None
         self.model = model
-        self.bleurt = load("bleurt", module_type="metric")
-        self.rouge = load("rouge")
-        self.bertscore = load("bertscore")
+        self.llama_factory = llama_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+
+        self.metrics: Dict[str, Any] = {}
+        if metrics:
+            configure_hf_env()
+            from evaluate import load
+
+            loaders = {
+                "bertscore": lambda: load("bertscore"),
+                "bleurt": lambda: load("bleurt", module_type="metric"),
+                "rouge": lambda: load("rouge"),
+            }
+            self.metrics = {name: loaders[name]() for name in metrics}
+
+    def _generate(self, items: List[Dict[str, str]]) -> Iterator[Dict[str, Any]]:
+        if not items:
+            return
+        if self.model is not None or self.workers == 1:
+            llama = self.model.llama if self.model is not None else self.llama_factory()
+            for item in items:
+                yield generate(llama, item, self.max_tokens)
+            return
+
+        executor = ProcessPoolExecutor(
+            max_workers=min(self.workers, len(items)),
+            initializer=_init_worker,
+            initargs=(self.llama_factory,),
+        )
+        try:
+            futures = [
+                executor.submit(_generate_in_worker, item, self.max_tokens)
+                for item in items
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def score(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        predictions = [record["prediction"] for record in records]
+        references = [record["answer"] for record in records]
+        scores = [{"id": record["id"]} for record in records]
+
+        if "bertscore" in self.metrics:
+            result = self.metrics["bertscore"].compute(
+                predictions=predictions,
+                references=references,
+                lang="en",
+                model_type="distilbert-base-uncased",
+            )
+            for key in ["precision", "recall", "f1"]:
+                for score, value in zip(scores, result[key]):
+                    score[f"bertscore_{key}"] = float(value)
+        if "bleurt" in self.metrics:
+            result = self.metrics["bleurt"].compute(
+                predictions=predictions, references=references
+            )
+            for score, value in zip(scores, result["scores"]):
+                score["bleurt"] = float(value)
+        if "rouge" in self.metrics:
+            result = self.metrics["rouge"].compute(
+                predictions=predictions, references=references, use_aggregator=False
+            )
+            for key, values in result.items():
+                for score, value in zip(scores, values):
+                    score[key] = float(value)
+        return scores
 
     def evaluate(
-        self, questions: List[str], answers: List[str], filename: str = None
-    ) -> None:
+        self,
+        questions: List[str],
+        answers: List[str],
+        filename: str = None,
+        checkpoint: Optional[str] = None,
+    ) -> Dict[str, float]:
         assert (
             isinstance(questions, list)
             and isinstance(answers, list)
             and len(questions) == len(answers)
         )
-
-        predictions = [
-            self.model.llama.create_completion(
-                f"### Instruction:\n{q}\n### Response:\n", max_tokens=512
-            )["choices"][0]["text"]
-            for q in tqdm(questions, total=len(questions))
+        items = [
+            {"id": str(i), "question": q, "answer": a}
+            for i, (q, a) in enumerate(zip(questions, answers))
         ]
+        return self.evaluate_dataset(items, filename, checkpoint)
 
-        bert_scores = self.bertscore.compute(
-            predictions=predictions,
-            references=answers,
-            lang="en",
-            model_type="distilbert-base-uncased",
-        )
+    def evaluate_dataset(
+        self,
+        items: List[Dict[str, str]],
+        filename: str = None,
+        checkpoint: Optional[str] = None,
+        run: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, float]:
+        by_id = {item["id"]: item for item in items}
+        predictions_path = scores_path = None
+        predictions: Dict[str, Dict[str, Any]] = {}
+        scores: Dict[str, Dict[str, Any]] = {}
+        if checkpoint:
+            predictions_path = f"{checkpoint}.predictions.jsonl"
+            scores_path = f"{checkpoint}.scores.jsonl"
+            run = dict(run or {}, max_tokens=self.max_tokens)
+            if not read_checkpoint_run(f"{checkpoint}.json", run):
+                for path in [predictions_path, scores_path]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            saved = read_jsonl(predictions_path)
+            # Ids are row numbers by default: a question edited since is
+            # generated again, and its old prediction and scores are dropped
+            stale = {
+                record["id"]
+                for record in saved
+                if record["id"] in by_id
+                and any(
+                    record[key] != by_id[record["id"]][key]
+                    for key in ["question", "answer"]
+                )
+            }
+            saved_scores = read_jsonl(scores_path)
+            if stale:
+                saved = [record for record in saved if record["id"] not in stale]
+                saved_scores = [s for s in saved_scores if s["id"] not in stale]
+                write_jsonl(predictions_path, saved)
+                write_jsonl(scores_path, saved_scores)
+            predictions = {
+                record["id"]: record for record in saved if record["id"] in by_id
+            }
+            scores = {
+                score["id"]: score
+                for score in saved_scores
+                if score["id"] in predictions
+            }
+            print(
+                f"Resuming from {checkpoint}: {len(predictions)} predictions, "
+                f"{len(scores)} scored"
+            )
 
-        bleurt_results = self.bleurt.compute(
-            predictions=predictions, references=answers
-        )
-        bleurt_scores = bleurt_results["scores"]
+        todo = [item for item in items if item["id"] not in predictions]
+        unscored = [record for id, record in predictions.items() if id not in scores]
 
-        average_rouge_scores = self.rouge.compute(
-            predictions=predictions, references=answers
+        predictions_file = (
+            open(predictions_path, "a", encoding="utf-8") if checkpoint else None
         )
-        print(f"Rouge scores: {average_rouge_scores}")
+        scores_file = open(scores_path, "a", encoding="utf-8") if checkpoint else None
 
-        average_bert_scores = {
-            "precision": np.mean(bert_scores["precision"]),
-            "recall": np.mean(bert_scores["recall"]),
-            "f1": np.mean(bert_scores["f1"]),
-        }
-        print(f"Bert scores: {average_bert_scores}")
+        def score_batch() -> None:
+            for score in self.score(unscored) if self.metrics else []:
+                scores[score["id"]] = score
+                append_jsonl(scores_file, score)
+            unscored.clear()
 
-        average_bleurt_score = np.mean(bleurt_scores)
-        print(f"Bleurt score: {average_bleurt_score}")
+        try:
+            for i, record in enumerate(self._generate(todo), 1):
+                predictions[record["id"]] = record
+                append_jsonl(predictions_file, record)
+                print(
+                    f"[{i}/{len(todo)}] {record['id']}: {record['latency_s']:.2f} s, "
+                    f"{record['tokens_per_sec']:.1f} tokens/s"
+                )
+                unscored.append(record)
+                if len(unscored) >= self.batch_size:
+                    score_batch()
+            if unscored:
+                score_batch()
+        finally:
+            for f in [predictions_file, scores_file]:
+                if f is not None:
+                    f.close()
+
+        records = [predictions[item["id"]] for item in items]
+        summary = self.summarize(
+            records, [scores.get(item["id"], {}) for item in items]
+        )
+        for key, value in summary.items():
+            print(f"{key}: {value}")
 
         if filename:
-            with open(filename, "w", encoding="utf-8") as f:
+            self.write_report(filename, summary, records, scores)
+        return summary
+
+    def summarize(
+        self, records: List[Dict[str, Any]], scores: List[Dict[str, Any]]
+    ) -> Dict[str, float]:
+        latencies = [record["latency_s"] for record in records]
+        summary = {
+            "questions": len(records),
+            "latency_mean_s": float(np.mean(latencies)),
+            "latency_p95_s": float(np.percentile(latencies, 95)),
+            "tokens_per_sec_mean": float(
+                np.mean([record["tokens_per_sec"] for record in records])
+            ),
+            "completion_tokens": int(
+                sum(record["completion_tokens"] for record in records)
+            ),
+        }
+        keys = [key for key in scores[0] if key != "id"] if scores else []
+        for key in keys:
+            summary[key] = float(np.mean([score[key] for score in scores]))
+        return summary
+
+    def write_report(
+        self,
+        filename: str,
+        summary: Dict[str, float],
+        records: List[Dict[str, Any]],
+        scores: Dict[str, Dict[str, Any]],
+    ) -> None:
+        with open(filename, "w", encoding="utf-8") as f:
+            for key, value in summary.items():
+                f.write(f"{key}: {value}\n")
+            f.write("\n")
+            for record in records:
+                score = {
+                    key: round(value, 4)
+                    for key, value in scores.get(record["id"], {}).items()
+                    if key != "id"
+                }
                 f.write(
-                    f"Rouge scores: {average_rouge_scores}\nBert scores: {average_bert_scores}\nBleurt score: {average_bleurt_score}\n\n"
+                    f"Question:\n{record['question']}\nAnswer:\n{record['answer']}\n"
+                    f"Prediction:\n{record['prediction']}\n"
+                    f"Latency: {record['latency_s']:.2f} s, "
+                    f"{record['tokens_per_sec']:.1f} tokens/s\n"
+                    f"Scores: {score}\n\n"
                 )
-                for q, a, p in zip(questions, answers, predictions):
-                    f.write(
-                        f"Question:\n{q}\nAnswer:\n{a}\nPrediction:\n{p}\n\n".encode(
-                            "utf-8"
-                        ).decode()
-                    )
 
 
-if __name__ == "__main__":
-    questions = [
-        "What is the capital of France?",
-        "Who wrote the novel '1984'?",
-        "What is the square root of 64?",
-        "Who painted the Mona Lisa?",
-        "What is the distance from Earth to the Moon?",
-        "Who is the current president of the United States?",
-        "What is the chemical symbol for gold?",
-        "What is the highest mountain in the world?",
-        "Who discovered penicillin?",
-        "What is the largest ocean on Earth?",
-        "What is the capital of Germany?",
-        "Who wrote the novel 'To Kill a Mockingbird'?",
-        "What is the square root of 144?",
-        "Who painted 'The Starry Night'?",
-        "What is the distance from Earth to Mars?",
-        "Who is the current Prime Minister of the United Kingdom?",
-        "What is the chemical symbol for silver?",
-        "What is the longest river in the world?",
-        "Who invented the telephone?",
-        "What is the largest continent on Earth?",
-        "What is the speed of light?",
-        "Who composed the music for 'The Magic Flute'?",
-        "What is the boiling point of water at sea level?",
-        "Who is the author of 'Pride and Prejudice'?",
-        "What is the currency of Japan?",
-        "What is the tallest building in the world?",
-        "Who discovered gravity?",
-        "What is the largest planet in our solar system?",
-        "Who won the Nobel Prize in Literature in 2020?",
-        "What is the national bird of the United States?",
-    ]
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--model-path", default=env.get("LLM_PATH"))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="llama threads per worker"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="Q-model-eval",
+        help="prefix of the JSONL checkpoints a rerun resumes from",
+    )
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--metrics", nargs="*", choices=METRICS, default=METRICS)
+    parser.add_argument("--report", default="Q-model-eval.txt")
+    parser.add_argument("--output", default=None, help="save the summary as JSON")
+    parser.add_argument("--stub-llm", action="store_true")
+    args = parser.parse_args()
 
-    answers = [  # reference full-precision model answers
-        "The capital of France is Paris.",
-        "The novel '1984' was written by George Orwell.",
-        "The square root of 64 is 8.",
-        "The Mona Lisa was painted by Leonardo da Vinci.",
-        "The average distance from Earth to the Moon is about 238,900 miles (384,400 kilometers). However, this distance can vary slightly due to the elliptical shape of the Moon's orbit around Earth.",
-        "The current President of the United States is Joe Biden.",
-        "The chemical symbol for gold is Au.",
-        "The highest mountain in the world is Mount Everest, which stands at 8,848 meters (29,029 feet) tall.",
-        "Penicillin was discovered by Sir Alexander Fleming in 1928.",
-        "The largest ocean on Earth is the Pacific Ocean.",
-        "The capital of Germany is Berlin.",
-        "The novel 'To Kill a Mockingbird' was written by Harper Lee.",
-        "The square root of 144 is 12.",
-        "'The Starry Night' was painted by Vincent van Gogh.",
-        "The average distance from Earth to Mars is approximately 225 million miles (361 million kilometers). However, this distance can vary due to the elliptical shape of the planets' orbits.",
-        "As of my knowledge up to August 2021, the current Prime Minister of the United Kingdom is Boris Johnson.",
-        "The chemical symbol for silver is Ag.",
-        "The longest river in the world is the Nile River, which is approximately 4,135 miles or 6,650 kilometers long.",
-        "Alexander Graham Bell invented the telephone.",
-        "The largest continent on Earth is Asia, covering an area of approximately 44.58 million km2 (17.17 million sq mi).",
-        "The speed of light is approximately 299,792 kilometers per second or 186,282 miles per second. It is denoted by the universal physical constant 'c'.",
-        "The music for 'The Magic Flute' was composed by Wolfgang Amadeus Mozart.",
-        "The boiling point of water at sea level is 100 degrees Celsius or 212 degrees Fahrenheit.",
-        "The author of 'Pride and Prejudice' is Jane Austen.",
-        "The currency of Japan is the Japanese Yen (JPY).",
-        "The tallest building in the world is the Burj Khalifa in Dubai, United Arab Emirates. It stands at 828 meters (2,717 feet) tall with 163 floors.",
-        "Gravity is a fundamental force of nature that affects all objects with mass, and it was discovered by Sir Isaac Newton.",
-        "The largest planet in our solar system is Jupiter.",
-        "Louis Glück won the Nobel Prize in Literature in 2020.",
-        "The national bird of the United States is the Bald Eagle.",
-    ]
+    if args.stub_llm:
+        from stubs import StubLlama
+
+        factory = partial(StubLlama, token_delay=0.01, prompt_delay=0.1)
+    else:
+        factory = llama_factory(args.model_path, args.workers, args.threads)
+
+    evaluator = LLMEvaluator(
+        llama_factory=factory,
+        workers=args.workers,
+        metrics=args.metrics,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+    )
+    summary = evaluator.evaluate_dataset(
+        load_dataset(args.dataset),
+        filename=args.report,
+        checkpoint=args.checkpoint,
+        run={
+            "dataset": os.path.abspath(args.dataset),
+            "model": "stub" if args.stub_llm else args.model_path,
+        },
+    )
 
-    evaluator = LLMEvaluator(LlamaCPPLLM(model_name=env["LLM_PATH"]))
-    evaluator.evaluate(questions, answers, filename="Q-model-eval.txt")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import os
+import threading
+from typing import Any
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process, the thread lock is enough
+    fcntl = None
+
+
+class FileLock:
+    # Exclusive lock shared by the threads of this process and, through
+    # flock on `path`, by other processes (prefork workers) using the same
+    # file. Reentrant within a thread.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self) -> "FileLock":
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            if self._fd is None or self._pid != os.getpid():
+                # A descriptor inherited through fork shares the parent's lock
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
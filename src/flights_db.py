@@ -1,28 +1,265 @@
 import pandas as pd
+import numpy as np
 import os
-from typing import List, Optional, Union
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Union
 from dotenv import dotenv_values
-
+from file_lock import FileLock
+from flights_storage import (
+    CATEGORICAL_COLUMNS,
+    COLUMNS,
+    ColumnarFlightsStorage,
+    FlightsTail,
+    concat_flights,
+    empty_flights,
+    format_dates,
+    migrate_csv,
+    open_storage,
+    present_flights,
+    read_journal,
+    typed_flights,
+)
+from telemetry import telemetry
 
 env = dotenv_values(".env")
 DB_PATH = env["DB_PATH"]
 
+# Columns kept in per-city sorted order for range search
+SORTED_COLUMNS = ["departure_date", "price"]
+SEARCH_CHUNK_SIZE = 1024
+
+
+def _timestamp(value: Any) -> Optional[np.datetime64]:
+    try:
+        timestamp = pd.Timestamp(value)
+    except (ValueError, TypeError):
+        return None
+    return None if pd.isna(timestamp) else np.datetime64(timestamp, "ns")
+
 
 class FlightsDB:
-    def __init__(self, filename: str = "flights.csv"):
+    # The table is kept typed in memory (see flights_storage) and stored
+    # either as CSV ("flights.csv") or as a memory-mapped columnar store
+    # ("flights"). New flights are appended to a journal file next to it
+    # instead of rewriting the whole table; the journal is merged back once it
+    # grows past compact_ratio of the table (and at least compact_min_rows).
+    # In memory the saved table (memory-mapped when columnar) is never
+    # copied: the journal's rows live in a FlightsTail after it, and row
+    # positions (ticket ids) run on from the table into the tail.
+    def __init__(
+        self,
+        filename: str = "flights.csv",
+        flights: Optional[pd.DataFrame] = None,
+        compact_ratio: float = 0.5,
+        compact_min_rows: int = 10_000,
+    ):
         self.filename: str = f"{DB_PATH}/{filename}"
-        if os.path.exists(self.filename):
-            self.flights: pd.DataFrame = pd.read_csv(self.filename)
-        else:
-            self.flights: pd.DataFrame = pd.DataFrame(
-                columns=[
-                    "city_name",
-                    "departure_date",
-                    "arrival_date",
-                    "seat_place",
-                    "price",
-                ]
+        self.journal_filename: str = f"{self.filename}.journal"
+        # Ticket ids of sold flights, one per line
+        self.sold_filename: str = f"{self.filename}.sold"
+        self.storage = open_storage(self.filename)
+        self.compact_ratio = compact_ratio
+        self.compact_min_rows = compact_min_rows
+        self.journal_rows = 0
+
+        csv_filename = f"{self.filename}.csv"
+        if (
+            isinstance(self.storage, ColumnarFlightsStorage)
+            and not self.storage.exists()
+            and any(
+                os.path.exists(path)
+                for path in [csv_filename, f"{csv_filename}.journal"]
             )
+        ):
+            # First start on a columnar store next to an existing CSV
+            migrate_csv(csv_filename, self.filename)
+
+        if flights is not None:
+            self._base = typed_flights(flights.reset_index(drop=True))
+        else:
+            self._base = self._load()
+        self._base_values: Dict[str, Any] = {}
+        self._tail = FlightsTail()
+        # Sold flags by row, with spare capacity as the tail's columns have
+        self._sold = np.zeros(len(self._base), dtype=bool)
+
+        self.build_indexes()
+        if flights is None:
+            journal = read_journal(self.journal_filename)
+            self.journal_rows = len(journal)
+            self._append(journal)
+
+        self._sold_lock = threading.Lock()
+        # Sales by other processes (prefork workers) sharing the file are read
+        # from it; the file lock makes a sale atomic across them
+        self._sold_file_lock = FileLock(self.sold_filename)
+        self._sold_offset = 0
+        self._city_sold: Dict[str, int] = {}
+        self._read_sold()
+
+    def _load(self) -> pd.DataFrame:
+        return self.storage.load() if self.storage.exists() else empty_flights()
+
+    @property
+    def n_rows(self) -> int:
+        return len(self._base) + len(self._tail)
+
+    @property
+    def flights(self) -> pd.DataFrame:
+        # The whole typed table; a merged copy while the tail has rows
+        if not len(self._tail):
+            return self._base
+        return concat_flights(self._base, self._tail.frame())
+
+    @flights.setter
+    def flights(self, flights: pd.DataFrame) -> None:
+        self._base = flights
+        self._base_values = {}
+        self._tail = FlightsTail()
+
+    def _base_column(self, column: str, rows: np.ndarray) -> np.ndarray:
+        values = self._base_values.get(column)
+        if values is None:
+            if column in CATEGORICAL_COLUMNS:
+                # Codes and labels, the column is not expanded to strings
+                values = (
+                    self._base[column].cat.codes.to_numpy(),
+                    np.asarray(self._base[column].cat.categories, dtype=object),
+                )
+            else:
+                values = self._base[column].to_numpy()
+            self._base_values[column] = values
+        if column in CATEGORICAL_COLUMNS:
+            codes, labels = values
+            return labels[codes[rows]]
+        return values[rows]
+
+    def _values(self, column: str, rows: np.ndarray) -> np.ndarray:
+        # Values of a column at row positions, from the table or the tail
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(self._tail):
+            return self._base_column(column, rows)
+        n_base = len(self._base)
+        in_base = rows < n_base
+        tail = self._tail.column(column)
+        values = np.empty(len(rows), dtype=tail.dtype)
+        values[in_base] = self._base_column(column, rows[in_base])
+        values[~in_base] = tail[rows[~in_base] - n_base]
+        return values
+
+    def _frame(self, rows: np.ndarray) -> pd.DataFrame:
+        if not len(self._tail):
+            return self._base.iloc[rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        return pd.DataFrame(
+            {column: self._values(column, rows) for column in COLUMNS}, index=rows
+        )
+
+    def _append(self, batch: pd.DataFrame) -> None:
+        if not len(batch):
+            return
+        first_row = self.n_rows
+        self._tail.append(batch)
+        self._index_flights(batch, first_row)
+        if self.n_rows > len(self._sold):
+            sold = np.zeros(max(self.n_rows, 2 * len(self._sold)), dtype=bool)
+            sold[: len(self._sold)] = self._sold
+            self._sold = sold
+
+    def build_indexes(self) -> None:
+        # Row positions (equal to ticket ids) per city, kept in table order so
+        # lookups return the same rows as a boolean mask scan would
+        self._city_rows: Dict[str, np.ndarray] = {
+            city: rows.astype(np.int64)
+            for city, rows in self._base.groupby(
+                "city_name", sort=False, observed=True
+            ).indices.items()
+        }
+        self._cities: List[str] = list(self._city_rows)
+
+        # Per city and sorted column: row positions ordered by that column,
+        # plus the sorted values, so ranges and (city, departure_date) are
+        # binary searches. The sort is stable, so rows sharing a value stay in
+        # table order
+        self._sorted_rows: Dict[str, Dict[str, np.ndarray]] = {}
+        self._sorted_values: Dict[str, Dict[str, np.ndarray]] = {}
+        for column in SORTED_COLUMNS:
+            values = self._base[column].to_numpy()
+            self._sorted_rows[column] = {}
+            self._sorted_values[column] = {}
+            for city, rows in self._city_rows.items():
+                order = rows[np.argsort(values[rows], kind="stable")]
+                self._sorted_rows[column][city] = order
+                self._sorted_values[column][city] = values[order]
+        if len(self._tail):
+            self._index_flights(self._tail.frame(), len(self._base))
+
+    def _index_flights(self, batch: pd.DataFrame, first_row: int) -> None:
+        columns = {column: batch[column].to_numpy() for column in SORTED_COLUMNS}
+        for city, batch_rows in batch.groupby(
+            "city_name", sort=False, observed=True
+        ).indices.items():
+            if city not in self._city_rows:
+                self._cities.append(city)
+                self._city_rows[city] = np.empty(0, dtype=np.int64)
+                for column, values in columns.items():
+                    self._sorted_rows[column][city] = np.empty(0, dtype=np.int64)
+                    self._sorted_values[column][city] = np.empty(0, dtype=values.dtype)
+
+            rows = batch_rows.astype(np.int64) + first_row
+            self._city_rows[city] = np.concatenate([self._city_rows[city], rows])
+
+            # Merge the sorted new values into the sorted old ones. New rows
+            # go after old rows with the same value, keeping table order
+            for column, values in columns.items():
+                order = np.argsort(values[batch_rows], kind="stable")
+                new_values = values[batch_rows][order]
+                old_values = self._sorted_values[column][city]
+                positions = np.searchsorted(old_values, new_values, side="right")
+                self._sorted_values[column][city] = np.insert(
+                    old_values, positions, new_values
+                )
+                self._sorted_rows[column][city] = np.insert(
+                    self._sorted_rows[column][city], positions, rows[order]
+                )
+
+    def _needs_compaction(self, journal_rows: int, n_rows: int) -> bool:
+        return journal_rows >= max(
+            self.compact_min_rows, self.compact_ratio * (n_rows - journal_rows)
+        )
+
+    @telemetry.traced("flights_db.add_flights")
+    def add_flights(self, flights: Union[pd.DataFrame, Dict[str, Sequence]]) -> None:
+        # Takes a columnar batch: a DataFrame or a dict of equally long columns
+        raw = pd.DataFrame(flights, columns=COLUMNS).reset_index(drop=True)
+        if raw.empty:
+            return
+        batch = typed_flights(raw)
+        self._append(batch)
+
+        if self._needs_compaction(self.journal_rows + len(batch), self.n_rows):
+            # The batch would be compacted right away, skip the journal
+            self.compact()
+            return
+
+        with open(self.journal_filename, "a", encoding="utf-8", newline="") as f:
+            # One write call per batch, so a crash leaves at most one torn line
+            f.write(raw.to_csv(index=False, header=False))
+        self.journal_rows += len(batch)
+
+    def compact(self) -> None:
+        # Save the table with the journal merged in, then drop the journal.
+        # The only full copy of the table; a columnar store is mapped again
+        flights = self.flights
+        self.storage.save(flights)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.journal_rows = 0
+        self.flights = (
+            self.storage.load()
+            if isinstance(self.storage, ColumnarFlightsStorage)
+            else flights
+        )
 
     def add_flight(
         self,
@@ -32,7 +269,7 @@ class FlightsDB:
         seat_place: str,
         price: float,
     ) -> None:
-        flight_data = pd.DataFrame(
+        self.add_flights(
             {
                 "city_name": [city_name],
                 "departure_date": [departure_date],
@@ -41,49 +278,191 @@ class FlightsDB:
                 "price": [price],
             }
         )
-        self.flights = pd.concat([self.flights, flight_data], ignore_index=True)
-        self.flights.to_csv(self.filename, index=False)
+
+    def _set_sold(self, ticket_id: int) -> None:
+        if 0 <= ticket_id < self.n_rows and not self._sold[ticket_id]:
+            self._sold[ticket_id] = True
+            city = str(self._values("city_name", [ticket_id])[0])
+            self._city_sold[city] = self._city_sold.get(city, 0) + 1
+
+    def _read_sold(self) -> None:
+        # Ticket ids appended since the last read; a torn last line is left
+        # for the next read
+        if (
+            not os.path.exists(self.sold_filename)
+            or os.path.getsize(self.sold_filename) == self._sold_offset
+        ):
+            return
+        with open(self.sold_filename, "rb") as f:
+            f.seek(self._sold_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._set_sold(int(line))
+        self._sold_offset += end
+
+    def refresh_sold(self) -> None:
+        with self._sold_lock:
+            self._read_sold()
+
+    def is_sold(self, ticket_id: int) -> bool:
+        return 0 <= ticket_id < self.n_rows and bool(self._sold[ticket_id])
+
+    @telemetry.traced("flights_db.mark_sold")
+    def mark_sold(self, ticket_id: int) -> bool:
+        # Seat holds live in SeatInventory; this is the final check against
+        # double sales, also by other processes. False if already sold.
+        with self._sold_lock, self._sold_file_lock:
+            self._read_sold()
+            if self.is_sold(ticket_id):
+                return False
+            line = f"{ticket_id}\n".encode("utf-8")
+            with open(self.sold_filename, "r+b") as f:
+                # Nobody writes while the lock is held, so anything past the
+                # last complete line was torn by a crash
+                f.truncate(self._sold_offset)
+                f.seek(self._sold_offset)
+                f.write(line)
+            self._sold_offset += len(line)
+            self._set_sold(ticket_id)
+            return True
+
+    def _rows(
+        self, city_name: Optional[str], departure_date: Optional[str] = None
+    ) -> np.ndarray:
+        rows = self._city_rows.get(city_name)
+        if rows is None:
+            return np.empty(0, dtype=np.int64)
+        if not departure_date:
+            return rows
+
+        departure = _timestamp(departure_date)
+        if departure is None:
+            return np.empty(0, dtype=np.int64)
+        departures = self._sorted_values["departure_date"][city_name]
+        start = np.searchsorted(departures, departure, side="left")
+        end = np.searchsorted(departures, departure, side="right")
+        return self._sorted_rows["departure_date"][city_name][start:end]
+
+    def _format_dates(self, column: str, rows: np.ndarray) -> List[str]:
+        return format_dates(self._values(column, rows)).tolist()
 
     def get_flights(
         self, city_name: Optional[str] = None, departure_date: Optional[str] = None
     ) -> pd.DataFrame:
         if city_name and departure_date:
-            return self.flights[
-                (self.flights["city_name"] == city_name)
-                & (self.flights["departure_date"] == departure_date)
-            ]
+            flights = self._frame(self._rows(city_name, departure_date))
         elif city_name:
-            return self.flights[self.flights["city_name"] == city_name]
+            flights = self._frame(self._rows(city_name))
+        else:
+            flights = self.flights
+        return present_flights(flights)
+
+    def _range(self, column: str, city_name: str, low: Any, high: Any) -> slice:
+        # Positions in the city's sorted column for low <= value < high
+        # (value <= high for prices, a ceiling is inclusive)
+        values = self._sorted_values[column][city_name]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        if high is None:
+            end = len(values)
+        else:
+            side = "right" if column == "price" else "left"
+            end = np.searchsorted(values, high, side=side)
+        return slice(start, max(start, end))
+
+    @telemetry.traced("flights_db.search_flights")
+    def search_flights(
+        self,
+        city_name: str,
+        departure_from: Any = None,
+        departure_to: Any = None,
+        max_price: Optional[float] = None,
+        sort_by: str = "departure_date",
+        limit: Optional[int] = 10,
+        offset: int = 0,
+    ) -> pd.DataFrame:
+        # Flights to city_name departing in [departure_from, departure_to) for
+        # at most max_price, ordered by sort_by ("departure_date" or "price"),
+        # as the page [offset, offset + limit). Indexed by ticket id, sold
+        # flights are left out.
+        if sort_by not in SORTED_COLUMNS:
+            raise ValueError(f"Cannot sort flights by {sort_by!r}")
+        self.refresh_sold()
+        if city_name not in self._city_rows:
+            return present_flights(self._base.iloc[[]])
+
+        bounds = {
+            "departure_date": (_timestamp(departure_from), _timestamp(departure_to)),
+            "price": (None, max_price),
+        }
+        ranges = {
+            column: self._range(column, city_name, *bounds[column])
+            for column in SORTED_COLUMNS
+        }
+        (other,) = [column for column in SORTED_COLUMNS if column != sort_by]
+        n_rows = len(self._city_rows[city_name])
+        primary = self._sorted_rows[sort_by][city_name][ranges[sort_by]]
+        secondary = self._sorted_rows[other][city_name][ranges[other]]
+        end = None if limit is None else offset + limit
+
+        def matches(rows: np.ndarray, column: str) -> np.ndarray:
+            rows = rows[~self._sold[rows]]
+            low, high = bounds[column]
+            values = self._values(column, rows)
+            mask = np.ones(len(rows), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high if column == "price" else values < high
+            return rows[mask]
+
+        if len(secondary) == n_rows and not self._city_sold.get(city_name):
+            # Only the sort column is filtered, the page is a slice of it
+            page = primary[offset:end]
+        elif 8 * len(secondary) < (
+            len(primary) if end is None else end * len(primary) / max(len(secondary), 1)
+        ):
+            # Filling the page by walking the sort order reads about
+            # end * len(primary) / len(secondary) rows, so when the other range
+            # is much smaller than that, filter it by the sort column and order the
+            # survivors instead (ties in table order)
+            rows = matches(secondary, sort_by)
+            values = self._values(sort_by, rows)
+            page = rows[np.lexsort((rows, values))][offset:end]
         else:
-            return self.flights
+            # Walk the sort order in chunks and stop once the page is full
+            found: List[np.ndarray] = []
+            n_found = 0
+            for start in range(0, len(primary), SEARCH_CHUNK_SIZE):
+                rows = matches(primary[start : start + SEARCH_CHUNK_SIZE], other)
+                found.append(rows)
+                n_found += len(rows)
+                if end is not None and n_found >= end:
+                    break
+            page = np.concatenate(found)[offset:end] if found else primary[:0]
+
+        return present_flights(self._frame(page))
 
     def get_cities(self) -> List[str]:
-        return self.flights["city_name"].unique().tolist()
+        return list(self._cities)
 
     def get_departure_dates(self, city_name: str) -> List[str]:
-        return self.flights[self.flights["city_name"] == city_name][
-            "departure_date"
-        ].to_list()
+        return self._format_dates("departure_date", self._rows(city_name))
 
     def get_arrival_date(self, city_name: str, departure_date: str) -> Optional[str]:
-        flight = self.flights[
-            (self.flights["city_name"] == city_name)
-            & (self.flights["departure_date"] == departure_date)
-        ]
-        return flight["arrival_date"].values[0] if not flight.empty else None
+        rows = self._rows(city_name, departure_date)
+        return self._format_dates("arrival_date", rows[:1])[0] if len(rows) else None
 
     def get_prices(self, city_name: str, departure_date: str) -> Optional[List[float]]:
-        flight = self.flights[
-            (self.flights["city_name"] == city_name)
-            & (self.flights["departure_date"] == departure_date)
-        ]
-        return flight["price"].values.tolist() if not flight.empty else None
+        rows = self._rows(city_name, departure_date)
+        return self._values("price", rows).tolist() if len(rows) else None
 
     def get_ticket_ids(self, city_name: str) -> List[int]:
-        return self.flights[self.flights["city_name"] == city_name].index.tolist()
+        return self._rows(city_name).tolist()
 
+    @telemetry.traced("flights_db.get_ticket")
     def get_ticket(self, ticket_id: int) -> Optional[pd.Series]:
-        if ticket_id in self.flights.index:
-            return self.flights.iloc[ticket_id]
+        if isinstance(ticket_id, (int, np.integer)) and 0 <= ticket_id < self.n_rows:
+            return present_flights(self._frame([ticket_id])).iloc[0]
         else:
             return None
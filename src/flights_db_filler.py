@@ -1,5 +1,8 @@
+import argparse
 import random
+import numpy as np
 from datetime import datetime, timedelta
+from typing import Dict, Optional
 from flights_db import FlightsDB
 
 
@@ -20,8 +23,49 @@ def generate_random_flight(db: FlightsDB, cities: list[str]) -> None:
     )
 
 
+def generate_random_flights(
+    n: int, cities: list[str], seed: Optional[int] = None
+) -> Dict[str, np.ndarray]:
+    # Same distribution as generate_random_flight, as a columnar batch. There
+    # are only 12 * 28 * 24 departure times and 6 * 30 seats, so their strings
+    # are formatted once and picked by index
+    rng = np.random.default_rng(seed)
+
+    departures = [
+        datetime(2023, month, day, hour)
+        for month in range(1, 13)
+        for day in range(1, 29)
+        for hour in range(24)
+    ]
+    departure_strings = np.array(
+        [date.strftime("%Y-%m-%d %H:%M") for date in departures], dtype=object
+    )
+    arrival_strings = np.array(
+        [(date + timedelta(hours=3)).strftime("%Y-%m-%d %H:%M") for date in departures],
+        dtype=object,
+    )
+    seats = np.array(
+        [f"{letter}{number}" for letter in "ABCDEF" for number in range(1, 31)],
+        dtype=object,
+    )
+
+    departure_ids = rng.integers(0, len(departures), n)
+    return {
+        "city_name": np.array(cities, dtype=object)[rng.integers(0, len(cities), n)],
+        "departure_date": departure_strings[departure_ids],
+        "arrival_date": arrival_strings[departure_ids],
+        "seat_place": seats[rng.integers(0, len(seats), n)],
+        "price": rng.uniform(500, 1500, n).astype(np.int64),
+    }
+
+
 def main():
-    db = FlightsDB("flights.csv")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flights", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    db = FlightsDB("flights")
     cities = [
         "Volgograd",
         "Saint Petersburg",
@@ -35,8 +79,10 @@ def main():
         "Perm",
     ]
 
-    for _ in range(30):
-        generate_random_flight(db, cities)
+    for start in range(0, args.flights, args.batch_size):
+        n = min(args.batch_size, args.flights - start)
+        db.add_flights(generate_random_flights(n, cities))
+    db.compact()
 
     print(db.get_flights())
 
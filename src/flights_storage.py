@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from typing import Dict, Union
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+COLUMNS = ["city_name", "departure_date", "arrival_date", "seat_place", "price"]
+CATEGORICAL_COLUMNS = ["city_name", "seat_place"]
+DATE_COLUMNS = ["departure_date", "arrival_date"]
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+# Column types of FlightsTail
+TAIL_DTYPES = {
+    "city_name": object,
+    "departure_date": "datetime64[ns]",
+    "arrival_date": "datetime64[ns]",
+    "seat_place": object,
+    "price": np.int64,
+}
+
+
+def empty_flights() -> pd.DataFrame:
+    return typed_flights(pd.DataFrame({column: [] for column in COLUMNS}))
+
+
+def typed_flights(flights: Union[pd.DataFrame, Dict]) -> pd.DataFrame:
+    # The in-memory schema: categorical strings, datetime64 dates, int prices
+    flights = pd.DataFrame(flights, columns=COLUMNS)
+    return pd.DataFrame(
+        {
+            "city_name": flights["city_name"].astype(str).astype("category"),
+            "departure_date": pd.to_datetime(flights["departure_date"]),
+            "arrival_date": pd.to_datetime(flights["arrival_date"]),
+            "seat_place": flights["seat_place"].astype(str).astype("category"),
+            "price": flights["price"].astype(np.int64),
+        }
+    )
+
+
+def format_dates(values: np.ndarray) -> np.ndarray:
+    # Flights share few distinct times, so each one is formatted only once
+    codes, uniques = pd.factorize(np.asarray(values))
+    # Same as strftime(DATE_FORMAT), several times faster
+    labels = np.char.replace(
+        np.datetime_as_string(np.asarray(uniques, dtype="datetime64[ns]"), unit="m"),
+        "T",
+        " ",
+    ).astype(object)
+    # NaT gets code -1, which picks the trailing None
+    return np.append(labels, None)[codes]
+
+
+def present_flights(flights: pd.DataFrame) -> pd.DataFrame:
+    # Back to the CSV schema (plain strings), which is what prompts, tables
+    # and the tickets db expect
+    return pd.DataFrame(
+        {
+            "city_name": flights["city_name"].astype(str),
+            "departure_date": format_dates(flights["departure_date"]),
+            "arrival_date": format_dates(flights["arrival_date"]),
+            "seat_place": flights["seat_place"].astype(str),
+            "price": flights["price"],
+        },
+        index=flights.index,
+    )
+
+
+def read_journal(path: str) -> pd.DataFrame:
+    # Rows appended since the last compaction, as headerless CSV lines
+    if not os.path.exists(path):
+        return empty_flights()
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            # Drop a partially written tail before appending again
+            f.truncate(data.rfind(b"\n") + 1)
+    if not os.path.getsize(path):
+        return empty_flights()
+    return typed_flights(pd.read_csv(path, header=None, names=COLUMNS))
+
+
+def concat_flights(flights: pd.DataFrame, batch: pd.DataFrame) -> pd.DataFrame:
+    # Plain pd.concat turns categoricals with different categories into
+    # object columns; the union keeps the existing codes and adds new ones
+    if flights.empty:
+        return batch.reset_index(drop=True)
+    columns = {}
+    for column in COLUMNS:
+        if column in CATEGORICAL_COLUMNS:
+            columns[column] = pd.api.types.union_categoricals(
+                [flights[column], batch[column]]
+            )
+        else:
+            columns[column] = np.concatenate(
+                [flights[column].to_numpy(), batch[column].to_numpy()]
+            )
+    return pd.DataFrame(columns)
+
+
+class FlightsTail:
+    # Rows added to a table since it was last saved, in growable in-memory
+    # columns (categoricals as plain strings). The capacity doubles when it
+    # runs out, so appends copy each row a constant number of times instead
+    # of the whole table per append, as concat_flights would
+    def __init__(self) -> None:
+        self.n_rows = 0
+        self._columns: Dict[str, np.ndarray] = {
+            column: np.empty(0, dtype=TAIL_DTYPES[column]) for column in COLUMNS
+        }
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def append(self, batch: pd.DataFrame) -> None:
+        # batch is typed (typed_flights)
+        end = self.n_rows + len(batch)
+        capacity = len(self._columns["price"])
+        if end > capacity:
+            capacity = max(end, 2 * capacity, 64)
+            for column, values in self._columns.items():
+                grown = np.empty(capacity, dtype=values.dtype)
+                grown[: self.n_rows] = values[: self.n_rows]
+                self._columns[column] = grown
+        for column in COLUMNS:
+            values = self._columns[column]
+            values[self.n_rows : end] = batch[column].to_numpy(dtype=values.dtype)
+        self.n_rows = end
+
+    def column(self, column: str) -> np.ndarray:
+        return self._columns[column][: self.n_rows]
+
+    def frame(self) -> pd.DataFrame:
+        return typed_flights({column: self.column(column) for column in COLUMNS})
+
+
+class CSVFlightsStorage:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> pd.DataFrame:
+        return typed_flights(pd.read_csv(self.path))
+
+    def save(self, flights: pd.DataFrame) -> None:
+        temp_path = f"{self.path}.tmp"
+        present_flights(flights).to_csv(temp_path, index=False)
+        os.replace(temp_path, self.path)
+
+
+class ColumnarFlightsStorage:
+    # A directory of generations, each holding one .npy file per column
+    # (category codes, datetime64[ns], int64) plus the category labels.
+    # Columns are opened with np.load(mmap_mode="r"), so startup reads no row
+    # data. A save writes a new generation and then switches the CURRENT
+    # pointer with os.replace, so readers never see a half-written table.
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.current_path = os.path.join(path, "CURRENT")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.current_path)
+
+    def _generation(self) -> str:
+        with open(self.current_path, encoding="utf-8") as f:
+            return os.path.join(self.path, f.read().strip())
+
+    def load(self) -> pd.DataFrame:
+        generation = self._generation()
+        with open(os.path.join(generation, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+
+        def column(name: str) -> np.ndarray:
+            return np.load(os.path.join(generation, f"{name}.npy"), mmap_mode="r")
+
+        columns = {}
+        for name in COLUMNS:
+            if name in CATEGORICAL_COLUMNS:
+                columns[name] = pd.Categorical.from_codes(
+                    column(name), categories=meta["categories"][name], validate=False
+                )
+            else:
+                columns[name] = column(name)
+        return pd.DataFrame(columns, copy=False)
+
+    def save(self, flights: pd.DataFrame) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        number = 0
+        if self.exists():
+            previous = os.path.basename(self._generation())
+            number = int(previous.split("-")[1]) + 1
+        name = f"gen-{number:06d}"
+        generation = os.path.join(self.path, name)
+        os.makedirs(generation)
+
+        meta = {"n_rows": len(flights), "categories": {}}
+        for column in COLUMNS:
+            values = flights[column]
+            if column in CATEGORICAL_COLUMNS:
+                meta["categories"][column] = values.cat.categories.tolist()
+                values = values.cat.codes
+            elif column in DATE_COLUMNS:
+                values = values.astype("datetime64[ns]")
+            np.save(os.path.join(generation, f"{column}.npy"), values.to_numpy())
+        with open(os.path.join(generation, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        temp_path = f"{self.current_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(temp_path, self.current_path)
+
+        # Open memory maps keep their inode, so older generations can go now
+        for entry in os.listdir(self.path):
+            if entry.startswith("gen-") and entry != name:
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+
+def open_storage(path: str) -> Union[CSVFlightsStorage, ColumnarFlightsStorage]:
+    # "flights.csv" is the CSV table, any name without .csv a columnar store
+    if path.endswith(".csv"):
+        return CSVFlightsStorage(path)
+    return ColumnarFlightsStorage(path)
+
+
+def migrate_csv(csv_path: str, columnar_path: str) -> int:
+    # The CSV and its journal are left in place
+    csv = CSVFlightsStorage(csv_path)
+    flights = csv.load() if csv.exists() else empty_flights()
+    flights = concat_flights(flights, read_journal(f"{csv_path}.journal"))
+    ColumnarFlightsStorage(columnar_path).save(flights)
+    return len(flights)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a flights CSV into the columnar storage format"
+    )
+    parser.add_argument("--csv", default="flights.csv")
+    parser.add_argument("--columnar", default="flights")
+    args = parser.parse_args()
+
+    n_rows = migrate_csv(
+        f"{env['DB_PATH']}/{args.csv}", f"{env['DB_PATH']}/{args.columnar}"
+    )
+    print(f"Migrated {n_rows} flights from {args.csv} to {args.columnar}")
+
+
+if __name__ == "__main__":
+    main()
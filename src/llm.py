@@ -1,24 +1,36 @@
-import ast
+import pandas as pd
+import copy
+import threading
 from prettytable import PrettyTable
 from termcolor import colored
-from typing import List, Optional, Any
+from typing import Dict, List, Optional, Any, Union
 from llama_cpp import Llama
-from tickets_db import TicketsDB
+from tickets_db import TicketsDB, ticket_from_record
 from flights_db import FlightsDB
+from session import BookingSession
+from scheduler import GenerationScheduler, PRIORITY_SLOT, PRIORITY_SUMMARY
+from prefix_cache import PrefixStateCache
+from seat_inventory import SeatInventory, SeatUnavailableError
+from slot_templates import SlotTemplates
+from prompt_builder import PromptBuilder, Items, Text, template_parts
 from utils import (
-    extract_email,
-    extract_birth_date,
-    extract_numbers,
-    extract_gender,
-    extract_classes_of_service,
+    extract_slots,
     extract_city,
     extract_name,
     extract_value,
+    extract_flight_filters,
+    describe_flight_filters,
+    extract_email,
+    extract_numbers,
 )
 
-from utils import logging
+from telemetry import telemetry
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
 
-enable_logging = True
+# search_flights filters dropped together when they leave no flights
+FLIGHT_FILTER_GROUPS = [["max_price"], ["departure_from", "departure_to"]]
 
 
 class LlamaCPPLLM:
@@ -27,8 +39,43 @@ class LlamaCPPLLM:
         model_name: Optional[str] = None,
         tickets_db: TicketsDB = None,
         flights_db: FlightsDB = None,
+        llama: Optional[Llama] = None,
+        session: Optional[BookingSession] = None,
+        scheduler: Optional[GenerationScheduler] = None,
+        prefix_cache: Optional[PrefixStateCache] = None,
+        inventory: Optional[SeatInventory] = None,
+        slot_responses: Optional[str] = None,
+        slot_templates: Optional[SlotTemplates] = None,
     ) -> None:
-        self.llama = Llama(model_path=model_name, n_ctx=2048, verbose=False)
+        self.llama = (
+            llama
+            if llama is not None
+            else Llama(model_path=model_name, n_ctx=2048, verbose=False)
+        )
+        # Shared by every per-session copy, llama contexts are not thread-safe
+        self.llama_lock = threading.Lock()
+        # When set, completions are queued through the scheduler instead of
+        # calling the model directly
+        self.scheduler = scheduler
+        self.response_timeout: Optional[float] = None
+        # Restores the evaluated system_contexts prefix before each completion
+        self.prefix_cache = prefix_cache
+        # Prompts are built as token lists that fit the model's context
+        self.prompt_builder = PromptBuilder(self.llama)
+        # Seat holds and sales, shared by every per-session copy
+        self.inventory = (
+            inventory if inventory is not None else SeatInventory(flights_db)
+        )
+        # "template" answers the questions for missing ticket fields from
+        # slot_templates instead of the model, "llm" generates them
+        self.slot_responses = slot_responses or env.get("SLOT_RESPONSES") or "llm"
+        if self.slot_responses not in ("llm", "template"):
+            raise ValueError(f"Unknown slot responses mode: {self.slot_responses!r}")
+        self.slot_templates = (
+            slot_templates
+            if slot_templates is not None
+            else SlotTemplates(path=env.get("SLOT_TEMPLATES"))
+        )
 
         self.user = "### Instruction"
         self.assistant = "### Response"
@@ -40,6 +87,26 @@ class LlamaCPPLLM:
         self.memory_access_threshold = 1.5
 
         self.db_n_results = 1
+        # Flights listed to the user when asking for a ticket id
+        self.flights_page_size = 10
+        # Token budgets per system context: slot questions are one sentence,
+        # so a rambling answer is cut early instead of running to 512
+        self.default_max_tokens = 512
+        self.max_tokens = {
+            "init": 192,
+            "buy": 128,
+            "show_ticket": 128,
+            "ticket_id": 128,
+            "ticket_id_relaxed": 128,
+            "city_no_flights": 96,
+            "city_name": 96,
+            "user_name": 64,
+            "gender": 64,
+            "birth_date": 64,
+            "email": 64,
+            "document_number": 64,
+            "class_of_service": 64,
+        }
 
         self.system_contexts = {
             "init": "<<SYS>>Keep in mind!, you are in the role of an airline ticket seller. Stick to your role!  It seems that the user did not indicate his choise (BUY or SHOW). Prompt the user to book a ticket or inquire about their bookings. Make sure to mention the two options: [BUY] to purchase a ticket, and [SHOW] to view ticket details. The user must use these terms in the chat!<</SYS>>",
@@ -53,32 +120,31 @@ class LlamaCPPLLM:
             "class_of_service": "<<SYS>>Keep in mind! You are in the role of an airline ticket seller. It seems that the user did not indicate his class of service. Ask the user which class of service does he prefer? He can choose between economy class, business class and first class. You must not deviate from your role; be sure to ask this question!<</SYS>>",
             "show_ticket": "<<SYS>>You should extract base information from the flight ticket in provided TICKET_INFO ant tell the summary of the ticket. Just one sentence about the ticket. Please don't write anything else<</SYS>>",
             "ticket_id": "<<SYS>>Remember, you are in the role of an airline ticket seller. The user has a choice of several tickets. It seems that the user did not indicate his id or id is not in the accepted ids. Accepted ticket ids are {ticket_ids}. Say user he should choose a ticket by its id. Don't come up with anything that isn't listed in SYS!!! You must not deviate from your role!<</SYS>>",
+            "ticket_id_relaxed": "<<SYS>>Remember, you are in the role of an airline ticket seller. There are no flights with {dropped_filters}, so this condition was dropped; tell the user so. The user has a choice of several other tickets. Accepted ticket ids are {ticket_ids}. Say user he should choose a ticket by its id. Don't come up with anything that isn't listed in SYS!!! You must not deviate from your role!<</SYS>>",
+            "city_no_flights": "<<SYS>>Keep in mind! You are in the role of an airline ticket seller. There are no available flights to {city_name}; tell the user so. Accepted cities are {cities}: Ask the user to choose another city he wish to fly to. You must not deviate from your role; be sure to ask this question!<</SYS>>",
         }
 
-        self.ticket_info = {
-            "city_name": None,
-            "ticket_id": None,
-            "departure_date": None,
-            "arrival_date": None,
-            "seat_place": None,
-            "price": None,
-            "class_of_service": None,
-            "user_name": None,
-            "document_number": None,
-            "gender": None,
-            "birth_date": None,
-            "email": None,
-        }
+        self.session = session if session is not None else BookingSession()
+        # Flight filters dropped this turn for leaving no flights, to tell
+        # the user about
+        self.dropped_filters: Dict[str, Any] = {}
 
-        self.current_response = None
+    def for_session(self, session: BookingSession) -> "LlamaCPPLLM":
+        # Shallow copy: the model, databases and prompts are shared,
+        # only the booking state is per session
+        agent = copy.copy(self)
+        agent.session = session
+        return agent
 
     @property
-    @logging(enable_logging, message="[Resetting ticket info]")
+    def ticket_info(self):
+        return self.session.ticket_info
+
+    @telemetry.traced("clear_ticket_info", message="[Resetting ticket info]")
     def clear_ticket_info(self):
-        for key in self.ticket_info.keys():
-            self.ticket_info[key] = None
+        self.session.clear_ticket_info()
 
-    @logging(enable_logging, message="[Printing ticket info]")
+    @telemetry.traced("print_ticket_info", message="[Printing ticket info]")
     def print_ticket_info(self, ticket_info=None):
         ticket_info = self.ticket_info if ticket_info is None else ticket_info
         table = PrettyTable()
@@ -89,10 +155,40 @@ class LlamaCPPLLM:
             )
         print(table)
 
-    @property
-    @logging(enable_logging, message="[Printing flights info]")
+    def flights_page(self) -> pd.DataFrame:
+        # The first page of flights to the chosen city matching the filters
+        # collected so far, instead of every flight to it
+        return self.flights_db.search_flights(
+            self.ticket_info["city_name"],
+            limit=self.flights_page_size,
+            **self.session.flight_filters,
+        )
+
+    def relax_flight_filters(self) -> Dict[str, Any]:
+        # When the filters leave no flights to the chosen city, drops the
+        # price ceiling or the departure window (the first that brings
+        # flights back), else both; returns the dropped filters. Nothing is
+        # dropped when the city has no flights left at all
+        filters = self.session.flight_filters
+        groups = [
+            [name for name in group if name in filters]
+            for group in FLIGHT_FILTER_GROUPS
+        ]
+        groups = [group for group in groups if group]
+        if not groups or not self.flights_page().empty:
+            return {}
+        for names in groups + [sum(groups, [])]:
+            relaxed = {k: v for k, v in filters.items() if k not in names}
+            if not self.flights_db.search_flights(
+                self.ticket_info["city_name"], limit=1, **relaxed
+            ).empty:
+                self.session.flight_filters = relaxed
+                return {name: filters[name] for name in names}
+        return {}
+
+    @telemetry.traced("print_flights", message="[Printing flights info]")
     def print_flights(self):
-        flights = self.flights_db.get_flights(self.ticket_info["city_name"])
+        flights = self.flights_page()
         table = PrettyTable()
         table.field_names = [
             colored("ID", "blue"),
@@ -117,37 +213,141 @@ class LlamaCPPLLM:
 
         print(table)
 
-    @property
-    @logging(enable_logging, message="[Adding info to tickets db]")
+    @telemetry.traced("add_ticket_to_db", message="[Adding info to tickets db]")
     def add_ticket_to_db(self):
-        self.tickets_db.add(str(self.ticket_info)) if all(
-            value is not None for value in self.ticket_info.values()
-        ) else None
+        if all(value is not None for value in self.ticket_info.values()):
+            self.tickets_db.add_ticket(self.ticket_info)
+
+    def system_prefix(self, context_key: str) -> str:
+        # Constant part of a system context, before any format placeholder
+        return self.system_contexts[context_key].split("{", 1)[0]
 
-    def response(self, request: str, streaming: bool) -> Any:
-        return self.llama.create_completion(
-            prompt=request, stream=streaming, max_tokens=512, stop=[f"{self.user}:"]
+    def create_completion(
+        self, prompt: str, stream: bool, context_key: Optional[str] = None, **kwargs
+    ) -> Any:
+        # Callers must hold llama_lock (or be the scheduler worker)
+        if self.prefix_cache is not None and context_key is not None:
+            self.prefix_cache.restore(context_key, self.system_prefix(context_key))
+        return self.llama.create_completion(prompt=prompt, stream=stream, **kwargs)
+
+    def completion_max_tokens(self, context_key: Optional[str]) -> int:
+        return self.max_tokens.get(context_key, self.default_max_tokens)
+
+    def prompt(
+        self,
+        context_key: str,
+        request: str,
+        separator: str = "",
+        inputs: Optional[Items] = None,
+        **values: Any,
+    ) -> List[int]:
+        # system context, user request, optional input lines, assistant cue;
+        # what doesn't fit n_ctx minus the completion budget is cut
+        parts = template_parts(self.system_contexts[context_key], **values)
+        parts += [f"{separator}{self.user}:\n", Text(request)]
+        if inputs is not None:
+            parts += [f"\n{self.input}:\n", inputs, f"{self.assistant}:\n"]
+        else:
+            parts.append(f"\n{self.assistant}:\n")
+
+        tokens = self.prompt_builder.build(
+            context_key, parts, self.completion_max_tokens(context_key)
         )
+        self.session.prompt_tokens.append(len(tokens))
+        return tokens
 
+    def response(
+        self,
+        request: Union[str, List[int]],
+        streaming: bool,
+        priority: int = PRIORITY_SLOT,
+        context_key: Optional[str] = None,
+    ) -> Any:
+        completion_kwargs = dict(
+            context_key=context_key,
+            max_tokens=self.completion_max_tokens(context_key),
+            stop=[f"{self.user}:"],
+        )
+
+        if self.scheduler is not None:
+            generation = self.scheduler.submit(
+                self.session.session_id,
+                request,
+                priority=priority,
+                timeout=self.response_timeout,
+                **completion_kwargs,
+            )
+            if streaming:
+                return telemetry.stream_completion(context_key, generation.stream())
+            return telemetry.timed_completion(context_key, generation.result)
+
+        if streaming:
+            return telemetry.stream_completion(
+                context_key, self._stream_response(request, completion_kwargs)
+            )
+
+        with self.llama_lock:
+            return telemetry.timed_completion(
+                context_key,
+                lambda: self.create_completion(
+                    request, stream=False, **completion_kwargs
+                ),
+            )
+
+    def _stream_response(self, request: str, completion_kwargs: dict) -> Any:
+        # The lock is held while tokens are pulled and released as soon as the
+        # consumer exhausts or closes the generator
+        with self.llama_lock:
+            yield from self.create_completion(request, stream=True, **completion_kwargs)
+
+    def template_response(self, context_key: str, **values: Any) -> Any:
+        return self.slot_templates.completion(context_key, self.streaming, **values)
+
+    @telemetry.traced("extract_contexts")
     def extract_contexts(self, request: str) -> Any:
+        missing = [field for field, value in self.ticket_info.items() if value is None]
+        # gender, class_of_service, email, document_number and birth_date
+        # come from a single pass over the message
+        extracted = extract_slots(request, fields=missing)
+
+        ticket_ids = []
+        # Filters come from the turns choosing a flight (its city, then its
+        # id; passenger details are asked for after)
+        if self.ticket_info["ticket_id"] is None:
+            self.session.flight_filters.update(extract_flight_filters(request))
+            if self.ticket_info["city_name"] is not None:
+                ticket_ids = self.flights_page().index.tolist()
+
         extraction_mapping = {
             "city_name": (extract_city, [request, self.flights_db.get_cities()]),
-            "gender": (extract_gender, [request]),
-            "class_of_service": (extract_classes_of_service, [request]),
-            "birth_date": (extract_birth_date, [request]),
-            "ticket_id": (extract_value, [request, self.flights_db.get_ticket_ids(self.ticket_info["city_name"])]),
-            "email": (extract_email, [request]),
+            "ticket_id": (extract_value, [request, ticket_ids]),
             "user_name": (extract_name, [request]),
-            "document_number": (extract_numbers, [request])
         }
 
         for field, (extractor, args) in extraction_mapping.items():
             if self.ticket_info[field] is None:
-                value = extractor(*args)
-                if value is not None:
-                    self.ticket_info[field] = value
+                extracted[field] = extractor(*args)
+
+        for field, value in extracted.items():
+            if self.ticket_info[field] is None and value is not None:
+                self.ticket_info[field] = value
+
+        self.dropped_filters = {}
+        if self.ticket_info["ticket_id"] is None and self.ticket_info["city_name"]:
+            # Before the flights are listed, also when the city came just now
+            self.dropped_filters = self.relax_flight_filters()
 
         if self.ticket_info["ticket_id"] is not None:
+            try:
+                # Taken (or extended) every turn while passenger details are
+                # filled in, so the seat cannot be sold to another session
+                self.inventory.hold(
+                    self.ticket_info["ticket_id"], self.session.session_id
+                )
+            except SeatUnavailableError:
+                self.session.clear_flight()
+                return
+
             ticket = self.flights_db.get_ticket(self.ticket_info["ticket_id"])
             self.ticket_info.update({
                 "departure_date": ticket["departure_date"],
@@ -156,97 +356,158 @@ class LlamaCPPLLM:
                 "seat_place": ticket["seat_place"]
             })
 
-    def add_ticket_response(self, request: str) -> Any:
-        self.extract_contexts(request)
-
-        self.print_ticket_info()
-
+    def missing_slot_response(self, request: str) -> Any:
+        # Asks for the first ticket field still unknown, None when all are set
         for key, value in self.ticket_info.items():
             if key in ["departure_date", "arrival_date", "seat_place", "price"]:
                 continue
 
             if value is None:
-                system_context = self.system_contexts[key]
-
+                values = {}
                 if key == "city_name":
-                    system_context = system_context.format(
-                        cities=self.flights_db.get_cities()
-                    )
+                    values["cities"] = self.flights_db.get_cities()
                 elif key == "ticket_id":
-                    self.print_flights
-                    system_context = system_context.format(
-                        ticket_ids=self.flights_db.get_ticket_ids(
-                            self.ticket_info["city_name"]
-                        )
-                    )
+                    ticket_ids = self.flights_page().index.tolist()
+                    if not ticket_ids:
+                        # No flights left to the city whatever the filters,
+                        # the user has to choose another one
+                        key = "city_no_flights"
+                        city_name = self.ticket_info["city_name"]
+                        values["city_name"] = city_name
+                        values["cities"] = [
+                            city
+                            for city in self.flights_db.get_cities()
+                            if city != city_name
+                        ]
+                        self.ticket_info["city_name"] = None
+                    else:
+                        self.print_flights()
+                        values["ticket_ids"] = ticket_ids
+                        if self.dropped_filters:
+                            key = "ticket_id_relaxed"
+                            values["dropped_filters"] = describe_flight_filters(
+                                self.dropped_filters
+                            )
+
+                if self.slot_responses == "template" and key in self.slot_templates:
+                    return self.template_response(key, **values)
 
                 return self.response(
-                    f"{system_context}\n{self.user}:\n{request}\n{self.assistant}:\n",
+                    self.prompt(key, request, separator="\n", **values),
                     streaming=self.streaming,
+                    context_key=key,
                 )
+        return None
+
+    def add_ticket_response(self, request: str) -> Any:
+        self.extract_contexts(request)
+
+        self.print_ticket_info()
 
-        system_context = self.system_contexts["buy"].format(
+        response = self.missing_slot_response(request)
+        if response is not None:
+            return response
+
+        try:
+            self.inventory.commit(self.ticket_info["ticket_id"], self.session.session_id)
+        except SeatUnavailableError:
+            # The hold expired and another session bought the seat meanwhile
+            self.session.clear_flight()
+            return self.missing_slot_response(request)
+
+        prompt = self.prompt(
+            "buy",
+            request,
             user_name=self.ticket_info["user_name"],
             departure_date=self.ticket_info["departure_date"],
             arrival_date=self.ticket_info["arrival_date"],
             seat_place=self.ticket_info["seat_place"],
             price=self.ticket_info["price"],
         )
-        self.add_ticket_to_db
-        self.clear_ticket_info
-        self.current_response = None
+        self.add_ticket_to_db()
+        self.clear_ticket_info()
+        self.session.current_response = None
 
-        return self.response(
-            f"{system_context}{self.user}:\n{request}\n{self.assistant}:\n",
-            streaming=self.streaming,
-        )
+        return self.response(prompt, streaming=self.streaming, context_key="buy")
 
     def generate(self, request: str) -> Any:
         if request.upper().startswith("BUY"):
-            self.current_response = self.add_ticket_response
+            self.session.current_response = "add_ticket_response"
         elif request.upper().startswith("SHOW"):
-            self.current_response = self.memory_response
-
-        if self.current_response is not None:
-            return self.current_response(request)
-        return self.response(
-            f"{self.system_contexts['init']}{self.user}:\n{request}\n{self.assistant}:\n",
-            streaming=self.streaming,
-        )
+            self.session.current_response = "memory_response"
+
+        # A streamed answer is timed by its own span as the caller reads it,
+        # after the turn span has ended
+        with telemetry.span(
+            "turn",
+            session_id=self.session.session_id,
+            flow=self.session.current_response or "init",
+        ):
+            if self.session.current_response is not None:
+                return getattr(self, self.session.current_response)(request)
+            return self.response(
+                self.prompt("init", request),
+                streaming=self.streaming,
+                context_key="init",
+            )
 
-    @logging(enable_logging, message="[Querying ticket info from tickets db]")
+    @telemetry.traced(
+        "memory_response", message="[Querying ticket info from tickets db]"
+    )
     def memory_response(self, request):
-        memory_queries_data = self.tickets_db.query(
-            request, n_results=self.db_n_results, return_text=False
+        # An email or document number in the message is looked up exactly,
+        # without the embedder; vector search is the fallback
+        keys = {
+            "email": extract_email(request),
+            "document_number": extract_numbers(request),
+        }
+        acceptable_memory_queries = self.tickets_db.lookup(
+            keys, n_results=self.db_n_results
         )
-        memory_queries = memory_queries_data["documents"][0]
-        memory_queries_distances = memory_queries_data["distances"][0]
-
-        acceptable_memory_queries = []
 
-        def memory_response(request: str, memory_queries: List[str]) -> Any:
-            queries = f"{self.system_contexts['show_ticket']}{self.user}:\n{request}\n{self.input}:\n"
+        def memory_response(request: str, memory_queries: List[dict]) -> Any:
+            for query in memory_queries:
+                self.print_ticket_info(query)
 
-            for i, query in enumerate(memory_queries):
-                queries += f"TICKET_INFO {i}: {query}\n"
-                self.print_ticket_info(ast.literal_eval(query))
-
-            queries += f"{self.assistant}:\n"
-
-            return self.response(queries, streaming=self.streaming)
+            # Tickets that don't fit the context are left out, the best
+            # matches come first
+            ticket_lines = Items(
+                [
+                    f"TICKET_INFO {i}: {query}\n"
+                    for i, query in enumerate(memory_queries)
+                ],
+                separator="",
+            )
+            return self.response(
+                self.prompt("show_ticket", request, inputs=ticket_lines),
+                streaming=self.streaming,
+                priority=PRIORITY_SUMMARY,
+                context_key="show_ticket",
+            )
 
-        for query, distance in list(zip(memory_queries, memory_queries_distances)):
-            if distance < self.memory_access_threshold:
-                acceptable_memory_queries.append(query)
+        if not acceptable_memory_queries:
+            memory_queries_data = self.tickets_db.query(
+                request, n_results=self.db_n_results, return_text=False
+            )
+            for document, metadata, distance in zip(
+                memory_queries_data["documents"][0],
+                memory_queries_data["metadatas"][0],
+                memory_queries_data["distances"][0],
+            ):
+                if distance < self.memory_access_threshold:
+                    acceptable_memory_queries.append(
+                        ticket_from_record(document, metadata)
+                    )
 
-        self.current_response = None
+        self.session.current_response = None
 
         if len(acceptable_memory_queries) > 0:
             response = memory_response(request, acceptable_memory_queries)
         else:
             response = self.response(
-                f"{self.system_contexts['init']}{self.user}:\n{request}\n{self.assistant}:\n",
+                self.prompt("init", request),
                 streaming=self.streaming,
+                context_key="init",
             )
 
         return response
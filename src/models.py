@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+
+def configure_hf_env() -> None:
+    # Must run before transformers is imported, it reads the cache path once
+    if env.get("HUGGINGFACE_HUB_CACHE"):
+        os.environ["HUGGINGFACE_HUB_CACHE"] = env["HUGGINGFACE_HUB_CACHE"]
+
+
+class ModelRegistry:
+    # Named model factories that run on first use (or in background warmup
+    # threads), so importing a module never loads weights
+    def __init__(self) -> None:
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._models: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+        self.load_times: Dict[str, float] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        with self._registry_lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+            self._models.pop(name, None)
+
+    def set(self, name: str, model: Any) -> None:
+        # Inject an already built model (or a stub) under `name`
+        with self._registry_lock:
+            self._locks.setdefault(name, threading.Lock())
+            self._models[name] = model
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str) -> Any:
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        if name not in self._locks:
+            raise KeyError(f"Model {name!r} is not registered")
+
+        with self._locks[name]:
+            if name not in self._models:
+                start = time.perf_counter()
+                self._models[name] = self._factories[name]()
+                self.load_times[name] = time.perf_counter() - start
+            return self._models[name]
+
+    def warmup(
+        self, names: Optional[Iterable[str]] = None, parallel: bool = True
+    ) -> Dict[str, Future]:
+        names = list(names) if names is not None else list(self._factories)
+        if not parallel:
+            for name in names:
+                self.get(name)
+            return {}
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(len(names), 1), thread_name_prefix="model-warmup"
+        )
+        futures = {name: executor.submit(self.get, name) for name in names}
+        executor.shutdown(wait=False)
+        return futures
+
+    def report(self) -> str:
+        lines = [f"{'model':<12}{'load time, s':>14}"]
+        for name in self._locks:
+            if name in self.load_times:
+                status = f"{self.load_times[name]:.2f}"
+            else:
+                status = "injected" if self.is_loaded(name) else "not loaded"
+            lines.append(f"{name:<12}{status:>14}")
+        # Models warmed in parallel overlap, so this exceeds wall-clock time
+        lines.append(f"{'sum':<12}{sum(self.load_times.values()):>14.2f}")
+        return "\n".join(lines)
+
+
+def _load_llama() -> Any:
+    from llama_cpp import Llama
+
+    return Llama(model_path=env["LLM_PATH"], n_ctx=2048, verbose=False)
+
+
+def _load_embedder() -> Any:
+    from embedder import HFEmbedder
+
+    return HFEmbedder(cache_dir=f"{env['DB_PATH']}/embedding-cache")
+
+
+def _load_bert_ner() -> Any:
+    from bert_ner import BERTNER
+
+    return BERTNER()
+
+
+registry = ModelRegistry()
+registry.register("llama", _load_llama)
+registry.register("embedder", _load_embedder)
+registry.register("bert_ner", _load_bert_ner)
@@ -0,0 +1,103 @@
+import ctypes
+import llama_cpp
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+from llama_cpp import Llama
+
+
+class PrefixStateCache:
+    # Keeps llama.cpp context snapshots taken right after evaluating a constant
+    # system prompt prefix. Restoring one makes llama.cpp's prompt prefix
+    # matching skip those tokens, so only the user part of a prompt is decoded.
+    # Must be used while holding the model lock.
+    def __init__(self, llama: Llama, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.llama = llama
+        self.max_bytes = max_bytes
+
+        # key -> (prefix tokens, state data)
+        self._states: "OrderedDict[str, Tuple[List[int], bytes]]" = OrderedDict()
+        self._tokens: Dict[Tuple[str, str], List[int]] = {}
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.resident_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def prefix_tokens(self, key: str, prefix: str) -> List[int]:
+        tokens = self._tokens.get((key, prefix))
+        if tokens is None:
+            # The last token may merge with the text that follows it in the
+            # full prompt, so it is left out of the cached part
+            tokens = self.llama.tokenize(prefix.encode("utf-8"))[:-1]
+            self._tokens[(key, prefix)] = tokens
+        return tokens
+
+    def _evaluated_tokens(self) -> List[int]:
+        return self.llama.input_ids[: self.llama.n_tokens].tolist()
+
+    def _snapshot(self) -> bytes:
+        buffer = (ctypes.c_uint8 * llama_cpp.llama_get_state_size(self.llama.ctx))()
+        n_bytes = llama_cpp.llama_copy_state_data(self.llama.ctx, buffer)
+        return bytes(buffer[:n_bytes])
+
+    def _load(self, tokens: List[int], data: bytes) -> None:
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        if llama_cpp.llama_set_state_data(self.llama.ctx, buffer) != len(data):
+            raise RuntimeError("Failed to set llama state data")
+        self.llama.input_ids[: len(tokens)] = tokens
+        self.llama.n_tokens = len(tokens)
+
+    def _store(self, key: str, tokens: List[int], data: bytes) -> None:
+        if key in self._states:
+            self.size_bytes -= len(self._states.pop(key)[1])
+
+        if len(data) > self.max_bytes:
+            return
+
+        while self._states and self.size_bytes + len(data) > self.max_bytes:
+            _, (_, evicted) = self._states.popitem(last=False)
+            self.size_bytes -= len(evicted)
+            self.evictions += 1
+
+        self._states[key] = (tokens, data)
+        self.size_bytes += len(data)
+
+    def restore(self, key: str, prefix: str) -> None:
+        tokens = self.prefix_tokens(key, prefix)
+        if not tokens:
+            return
+
+        if self._evaluated_tokens()[: len(tokens)] == tokens:
+            # The previous prompt already left this prefix in the context
+            self.resident_hits += 1
+            if key in self._states:
+                self._states.move_to_end(key)
+            return
+
+        entry = self._states.get(key)
+        if entry is not None and entry[0] == tokens:
+            self._states.move_to_end(key)
+            self._load(*entry)
+            self.hits += 1
+            return
+
+        self.misses += 1
+        self.llama.reset()
+        self.llama.eval(tokens)
+        self._store(key, tokens, self._snapshot())
+
+    def clear(self) -> None:
+        self._states.clear()
+        self.size_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._states),
+            "size_bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "resident_hits": self.resident_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
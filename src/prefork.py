@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+import uuid
+import zlib
+from concurrent.futures import wait
+from typing import Any, Dict, List, Optional
+from server import (
+    ChatServer,
+    HTTPError,
+    add_arguments,
+    build_agent,
+    open_session_store,
+    parse_chat_payload,
+    read_request,
+)
+from telemetry import telemetry
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+# smaps_rollup fields, in kB: Pss splits each shared page between the
+# processes that map it, so the workers' Pss adds up to the real footprint
+MEMORY_FIELDS = [
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+]
+
+
+def memory_usage(pid: int) -> Dict[str, int]:
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        # Not Linux, or the process is gone
+        return {}
+    usage = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if name in MEMORY_FIELDS:
+            usage[f"{name.lower()}_kb"] = int(value.split()[0])
+    if usage:
+        usage["shared_kb"] = usage["shared_clean_kb"] + usage["shared_dirty_kb"]
+        usage["private_kb"] = usage["private_clean_kb"] + usage["private_dirty_kb"]
+    return usage
+
+
+def preload(args: argparse.Namespace) -> Any:
+    # Runs in the parent before the fork, so the workers share the weights'
+    # pages copy-on-write: the GGUF file is mmap'd (its pages stay in the
+    # page cache, shared even after a worker writes its own KV cache) and
+    # the HF models' tensors are never written to. Nothing may run inference
+    # here: torch's OpenMP pool does not survive a fork.
+    from models import registry
+    from flights_db import FlightsDB
+
+    if args.stub_llm:
+        from stubs import StubLlama
+
+        registry.set("llama", StubLlama(token_delay=0.05))
+    else:
+
+        def load_llama() -> Any:
+            from llama_cpp import Llama
+
+            return Llama(
+                model_path=env["LLM_PATH"],
+                n_ctx=2048,
+                n_threads=args.threads,
+                use_mmap=True,
+                verbose=False,
+            )
+
+        registry.register("llama", load_llama)
+    if args.stub_models:
+        from stubs import StubEmbedder, StubNER
+
+        registry.set("embedder", StubEmbedder())
+        registry.set("bert_ner", StubNER())
+    else:
+
+        def load_embedder() -> Any:
+            from embedder import HFEmbedder
+
+            # The on-disk embedding store is written by one process only
+            return HFEmbedder()
+
+        registry.register("embedder", load_embedder)
+    wait(registry.warmup(["llama", "embedder", "bert_ner"]).values())
+    print(registry.report())
+
+    if args.synthetic_flights:
+        import pandas as pd
+        from flights_db_filler import generate_random_flights
+
+        flights = pd.DataFrame(
+            generate_random_flights(
+                args.synthetic_flights, ["Kazan", "Ufa", "Moscow"], seed=0
+            )
+        )
+        return FlightsDB(args.flights, flights=flights)
+    return FlightsDB(args.flights)
+
+
+def run_worker(
+    index: int, args: argparse.Namespace, ports: List[int], flights_db: Any
+) -> None:
+    # Runs in the forked child; threads (the embedding batcher, the tickets
+    # flusher, the seat sweeper, the server's pool) are all started here
+    from embedding_batcher import BatchingEmbedder
+    from models import registry
+    from tickets_db import TicketsDB
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(args.threads)
+    if args.telemetry_path:
+        # One file per worker, appends from several processes would interleave
+        telemetry.configure(path=f"{args.telemetry_path}.{index}")
+
+    embedder = registry.get("embedder")
+    if not args.stub_models:
+        # Concurrent sessions share forward passes, as in server.py
+        embedder = BatchingEmbedder(embedder)
+    tickets_db = TicketsDB(
+        args.collection,
+        embedder=embedder,
+        index=args.index,
+        shared=True,
+        worker_id=str(index),
+    )
+    if index == 0:
+        # Tickets of a crashed run with more workers, or of server.py
+        tickets_db.adopt_logs([str(i) for i in range(len(ports))])
+    # Holds must be exclusive across workers, as sales are
+    llm_agent = build_agent(
+        args, tickets_db, flights_db, seat_holds=f"{flights_db.filename}.holds.sqlite3"
+    )
+    sessions = open_session_store(args)
+
+    try:
+        asyncio.run(
+            ChatServer(
+                llm_agent, "127.0.0.1", ports[index], args.workers, sessions
+            ).serve_forever()
+        )
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        tickets_db.close()
+        sessions.close()
+        telemetry.close()
+
+
+async def send_json(
+    writer: asyncio.StreamWriter, status: int, reason: str, payload: dict
+) -> None:
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+
+class PreforkRouter:
+    # The parent's front end: a session always goes to the same worker (by
+    # a hash of its id, assigned here for new sessions), since the session
+    # lives in that worker's memory; seat holds are shared through SQLite.
+    # Requests and replies are piped through unchanged, streaming included.
+    def __init__(self, host: str, port: int, ports: List[int], pids: List[int]):
+        self.host = host
+        self.port = port
+        self.ports = ports
+        self.pids = pids
+        # Chat turns routed to each worker
+        self.n_turns = [0] * len(ports)
+        self.started = time.time()
+
+    def worker_for(self, session_id: str) -> int:
+        return zlib.crc32(session_id.encode("utf-8")) % len(self.ports)
+
+    async def proxy(
+        self,
+        index: int,
+        method: str,
+        path: str,
+        body: bytes,
+        writer: Optional[asyncio.StreamWriter] = None,
+    ) -> bytes:
+        # Pipes the worker's reply to writer, or returns it without writing
+        worker_reader, worker_writer = await asyncio.open_connection(
+            "127.0.0.1", self.ports[index]
+        )
+        try:
+            worker_writer.write(
+                (
+                    f"{method} {path} HTTP/1.1\r\n"
+                    f"Host: 127.0.0.1:{self.ports[index]}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + body
+            )
+            await worker_writer.drain()
+            reply = b""
+            while True:
+                data = await worker_reader.read(65536)
+                if not data:
+                    return reply
+                if writer is None:
+                    reply += data
+                else:
+                    writer.write(data)
+                    await writer.drain()
+        finally:
+            worker_writer.close()
+
+    async def worker_json(self, index: int, path: str) -> Any:
+        try:
+            reply = await self.proxy(index, "GET", path, b"")
+        except OSError:
+            return None
+        return json.loads(reply.partition(b"\r\n\r\n")[2] or b"null")
+
+    async def metrics(self) -> Dict[str, Any]:
+        replies = await asyncio.gather(
+            *(self.worker_json(i, "/metrics") for i in range(len(self.ports)))
+        )
+        workers = [
+            {
+                "worker": i,
+                "pid": pid,
+                "turns": self.n_turns[i],
+                "memory": memory_usage(pid),
+                "metrics": reply,
+            }
+            for i, (pid, reply) in enumerate(zip(self.pids, replies))
+        ]
+        parent = {"pid": os.getpid(), "memory": memory_usage(os.getpid())}
+        return {
+            "uptime_s": time.time() - self.started,
+            "parent": parent,
+            "workers": workers,
+            # Parent included, it maps the same weights
+            "total": {
+                field: sum(
+                    process["memory"].get(field, 0) for process in workers + [parent]
+                )
+                for field in ["rss_kb", "pss_kb", "shared_kb", "private_kb"]
+            },
+        }
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, path, headers, body = await read_request(reader)
+
+            if method == "POST" and path == "/chat":
+                payload = parse_chat_payload(body)
+                # The worker keeps the id, and replies with it as usual
+                payload["session_id"] = payload.get("session_id") or str(uuid.uuid4())
+                index = self.worker_for(payload["session_id"])
+                self.n_turns[index] += 1
+                await self.proxy(
+                    index,
+                    method,
+                    path,
+                    json.dumps(payload).encode("utf-8"),
+                    writer,
+                )
+            elif method == "DELETE" and path.startswith("/sessions/"):
+                session_id = path[len("/sessions/") :]
+                await self.proxy(self.worker_for(session_id), method, path, b"", writer)
+            elif method == "GET" and path.startswith("/workers/"):
+                # /workers/<n>/metrics/prometheus and such, one worker each
+                index, _, rest = path[len("/workers/") :].partition("/")
+                if not index.isdigit() or int(index) >= len(self.ports):
+                    raise HTTPError(404, "Not Found")
+                await self.proxy(int(index), method, "/" + rest, b"", writer)
+            elif method == "GET" and path == "/health":
+                replies = await asyncio.gather(
+                    *(self.worker_json(i, "/health") for i in range(len(self.ports)))
+                )
+                await send_json(
+                    writer,
+                    200 if all(replies) else 503,
+                    "OK" if all(replies) else "Service Unavailable",
+                    {"workers": replies},
+                )
+            elif method == "GET" and path == "/metrics":
+                await send_json(writer, 200, "OK", await self.metrics())
+            else:
+                raise HTTPError(404, "Not Found")
+        except HTTPError as e:
+            await send_json(writer, e.status, e.reason, {"error": e.reason})
+        except OSError:
+            # ConnectionError from the client, or a worker that is down
+            pass
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, stop: asyncio.Event) -> None:
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        print(f"Serving on {self.host}:{self.port} with {len(self.ports)} workers")
+        async with server:
+            await stop.wait()
+
+
+async def supervise(router: PreforkRouter) -> None:
+    # Until SIGINT/SIGTERM, or until a worker dies: its sessions are lost
+    # either way, so the whole group is restarted by whatever started it
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async def watch() -> None:
+        while not stop.is_set():
+            for i, pid in enumerate(router.pids):
+                if pid > 0 and os.waitpid(pid, os.WNOHANG)[0]:
+                    print(f"Worker {i} (pid {pid}) exited, shutting down")
+                    # Reaped, not to be signalled
+                    router.pids[i] = -1
+                    stop.set()
+            await asyncio.sleep(1.0)
+
+    watcher = asyncio.create_task(watch())
+    await router.serve(stop)
+    await watcher
+
+
+def stop_workers(pids: List[int], timeout: float = 10.0) -> None:
+    for pid in pids:
+        if pid > 0:
+            os.kill(pid, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for pid in pids:
+        if pid <= 0:
+            continue
+        while os.waitpid(pid, os.WNOHANG)[0] == 0:
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                break
+            time.sleep(0.05)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="server.py in several forked worker processes"
+    )
+    add_arguments(parser)
+    parser.add_argument("--processes", type=int, default=2, help="worker processes")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="llama.cpp and torch threads per worker (default: cores / processes)",
+    )
+    parser.add_argument("--stub-models", action="store_true")
+    parser.add_argument("--flights", default="flights", help="FlightsDB filename")
+    parser.add_argument(
+        "--synthetic-flights",
+        type=int,
+        default=0,
+        help="serve this many generated flights instead of the stored ones",
+    )
+    parser.add_argument("--collection", default="total-memory")
+    parser.add_argument(
+        "--index",
+        default="numpy",
+        choices=["numpy", "ivf"],
+        help="tickets index, Chroma can't be shared between processes",
+    )
+    args = parser.parse_args()
+    if args.threads is None:
+        args.threads = max((os.cpu_count() or 1) // args.processes, 1)
+    if args.telemetry:
+        telemetry.configure(enabled=True)
+
+    flights_db = preload(args)
+    ports = [args.port + 1 + i for i in range(args.processes)]
+    pids = []
+    for index in range(args.processes):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(index, args, ports, flights_db)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                # Never returns into the parent's code
+                os._exit(status)
+        pids.append(pid)
+
+    router = PreforkRouter(args.host, args.port, ports, pids)
+    try:
+        asyncio.run(supervise(router))
+    finally:
+        stop_workers(router.pids)
+
+
+if __name__ == "__main__":
+    main()
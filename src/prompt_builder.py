@@ -0,0 +1,149 @@
+import string
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+
+class Text:
+    # Variable text (the user's message, a formatted value): tokenized on
+    # every prompt, cut from the end only if dropping list items wasn't enough
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class Items:
+    # A list section ({cities}, {ticket_ids}, TICKET_INFO lines): items that
+    # don't fit the budget are dropped from the end, and `more` (with {n}
+    # dropped items) is appended instead
+    def __init__(
+        self, items: Sequence[Any], separator: str = ", ", more: str = ""
+    ) -> None:
+        self.items = [str(item) for item in items]
+        self.separator = separator
+        self.more = more
+
+
+Part = Union[str, Text, Items]
+
+
+def template_parts(template: str, **values: Any) -> List[Part]:
+    # Splits a system context around its {placeholders}: the literal pieces
+    # stay as they are, lists become Items and other values Text
+    parts: List[Part] = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            value = values[field]
+            parts.append(
+                Items(value, more=" and {n} more")
+                if isinstance(value, (list, tuple))
+                else Text(str(value))
+            )
+    return parts
+
+
+class PromptBuilder:
+    # Builds prompts as token lists from parts. The parts are joined and the
+    # whole prompt is tokenized in one call, so the tokens are exactly those
+    # of the equivalent f-string prompt (tokenizing pieces separately would
+    # give each its own leading space). The prompt must fit n_ctx minus the
+    # completion's max_tokens: list items are dropped first, then variable
+    # text is cut. Both are searched by bisection over the joined prompt.
+    def __init__(self, llama: Any, n_ctx: Optional[int] = None) -> None:
+        self.llama = llama
+        self.n_ctx = n_ctx if n_ctx is not None else llama.n_ctx()
+
+        self._lock = threading.Lock()
+        self.tokenize_calls = 0
+        # context key -> prompts, tokens, max_prompt_tokens, truncated
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def tokenize(self, text: str, bos: bool = False) -> List[int]:
+        with self._lock:
+            self.tokenize_calls += 1
+        return self.llama.tokenize(text.encode("utf-8"), add_bos=bos)
+
+    @staticmethod
+    def _size(part: Part) -> int:
+        if isinstance(part, Items):
+            return len(part.items)
+        return len(part.text if isinstance(part, Text) else part)
+
+    @staticmethod
+    def _render(part: Part, keep: int) -> str:
+        if isinstance(part, str):
+            return part
+        if isinstance(part, Text):
+            return part.text[:keep]
+        text = part.separator.join(part.items[:keep])
+        if keep < len(part.items) and part.more:
+            text += part.more.format(n=len(part.items) - keep)
+        return text
+
+    def _tokens(self, parts: List[Part], keeps: List[int]) -> List[int]:
+        # Only the start of the prompt gets the BOS token
+        return self.tokenize(
+            "".join(self._render(part, keep) for part, keep in zip(parts, keeps)),
+            bos=True,
+        )
+
+    def _largest_fit(
+        self, parts: List[Part], keeps: List[int], i: int, budget: int
+    ) -> List[int]:
+        # Keeps as many items or characters of parts[i] as fit the budget and
+        # returns that prompt's tokens (still over budget if none fit)
+        keep = keeps[i]
+        keeps[i] = 0
+        best = self._tokens(parts, keeps)
+        low, high = 0, keep - 1
+        while low < high:
+            keeps[i] = (low + high + 1) // 2
+            tokens = self._tokens(parts, keeps)
+            if len(tokens) <= budget:
+                low, best = keeps[i], tokens
+            else:
+                high = keeps[i] - 1
+        keeps[i] = low
+        return best
+
+    def build(self, context_key: str, parts: List[Part], max_tokens: int) -> List[int]:
+        budget = self.n_ctx - max_tokens
+        keeps = [self._size(part) for part in parts]
+        tokens = self._tokens(parts, keeps)
+
+        truncated = len(tokens) > budget
+        # Lists first, the last one first; then variable text, cut from its end
+        lists = [i for i, part in enumerate(parts) if isinstance(part, Items)]
+        texts = [i for i, part in enumerate(parts) if isinstance(part, Text)]
+        for i in lists[::-1] + texts[::-1]:
+            if len(tokens) <= budget:
+                break
+            if keeps[i]:
+                tokens = self._largest_fit(parts, keeps, i, budget)
+
+        if len(tokens) > budget:
+            raise ValueError(
+                f"Prompt for {context_key!r} needs {len(tokens)} tokens of static "
+                f"text, over the {budget}-token budget"
+            )
+
+        with self._lock:
+            counts = self._counts.setdefault(
+                context_key,
+                {"prompts": 0, "tokens": 0, "max_prompt_tokens": 0, "truncated": 0},
+            )
+            counts["prompts"] += 1
+            counts["tokens"] += len(tokens)
+            counts["max_prompt_tokens"] = max(counts["max_prompt_tokens"], len(tokens))
+            counts["truncated"] += truncated
+        return tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "n_ctx": self.n_ctx,
+            "tokenize_calls": self.tokenize_calls,
+            "contexts": {
+                key: dict(counts, mean_tokens=counts["tokens"] / counts["prompts"])
+                for key, counts in self._counts.items()
+            },
+        }
@@ -0,0 +1,37 @@
+from typing import Any
+
+BACKENDS = ("torch", "int8")
+
+
+def check_backend(backend: str) -> None:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+def quantize_int8(model: Any) -> Any:
+    # Dynamic quantization: Linear weights are stored as int8 and activations
+    # are quantized on the fly, which roughly quarters the weights' RAM and
+    # speeds up CPU matmuls. Only runs on CPU.
+    import torch
+
+    return torch.quantization.quantize_dynamic(
+        model.to("cpu").eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def model_size_bytes(model: Any) -> int:
+    import torch
+
+    state = model.state_dict()
+    size = 0
+    for value in state.values():
+        if isinstance(value, torch.Tensor):
+            size += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # Packed params of quantized Linear layers (weight, bias)
+            size += sum(
+                item.numel() * item.element_size()
+                for item in value
+                if isinstance(item, torch.Tensor)
+            )
+    return size
@@ -0,0 +1,87 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class QueryCache:
+    # LRU of query results with a TTL. Every entry remembers the generation
+    # of the collection it was computed at; the owner bumps the generation on
+    # each write, which makes all older entries misses without scanning them.
+    # Results are deep-copied in and out, so callers can't alter cached ones.
+    def __init__(
+        self,
+        max_items: int = 256,
+        ttl: Optional[float] = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> (generation, stored at, result)
+        self._entries: "OrderedDict[Hashable, Tuple[int, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.generation += 1
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            generation, stored_at, result = entry
+            if generation != self.generation:
+                del self._entries[key]
+                self.invalidated += 1
+                self.misses += 1
+                return False, None
+            if self.ttl is not None and self.clock() - stored_at > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return True, copy.deepcopy(result)
+
+    def put(self, key: Hashable, generation: int, result: Any) -> None:
+        # `generation` is the one read before computing the result: if a write
+        # happened meanwhile, the entry is already stale and is not stored
+        if self.max_items <= 0:
+            return
+        result = copy.deepcopy(result)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (generation, self.clock(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,382 @@
+import threading
+import time
+import queue
+import numpy as np
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+
+PRIORITY_SLOT = 0  # short slot-filling questions
+PRIORITY_SUMMARY = 1  # long memory_response ticket summaries
+
+_DONE = object()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class GenerationCancelledError(Exception):
+    pass
+
+
+class GenerationRequest:
+    def __init__(
+        self,
+        session_id: str,
+        prompt: Any,
+        priority: int,
+        deadline: Optional[float],
+        completion_kwargs: Dict[str, Any],
+        scheduler: Optional["GenerationScheduler"] = None,
+    ) -> None:
+        self.session_id = session_id
+        self.prompt = prompt
+        self.priority = priority
+        self.deadline = deadline
+        self.completion_kwargs = completion_kwargs
+        self.scheduler = scheduler
+
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.n_tokens = 0
+        self.error: Optional[Exception] = None
+
+        self._chunks: queue.Queue = queue.Queue()
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        return self.deadline is not None and (now or time.monotonic()) > self.deadline
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        # A queued request leaves the queue now, not when the worker gets to it
+        if self.scheduler is not None:
+            self.scheduler._withdraw(
+                self, "cancelled", GenerationCancelledError("Cancelled while queued")
+            )
+
+    def _next_chunk(self) -> Any:
+        # Waits no longer than the deadline, also while queued behind a long
+        # generation
+        if self.deadline is None:
+            return self._chunks.get()
+        try:
+            return self._chunks.get(timeout=max(self.deadline - time.monotonic(), 0))
+        except queue.Empty:
+            pass
+        if self.scheduler is not None and self.scheduler._withdraw(
+            self, "expired", DeadlineExceededError("Deadline passed while queued")
+        ):
+            raise self.error
+        raise DeadlineExceededError("Deadline passed during generation")
+
+    def stream(self) -> Iterator[Dict[str, Any]]:
+        # Closing this generator (client gone) cancels the generation
+        try:
+            while True:
+                chunk = self._next_chunk()
+                if chunk is _DONE:
+                    break
+                yield chunk
+        finally:
+            self.cancel()
+
+        if self.error is not None:
+            raise self.error
+
+    def result(self) -> Dict[str, Any]:
+        text = ""
+        finish_reason = None
+        while True:
+            chunk = self._next_chunk()
+            if chunk is _DONE:
+                break
+            text += chunk["choices"][0]["text"]
+            finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+
+        if self.error is not None:
+            raise self.error
+
+        return {"choices": [{"text": text, "index": 0, "finish_reason": finish_reason}]}
+
+
+class GenerationScheduler:
+    def __init__(
+        self,
+        create_completion: Callable[..., Iterator[Dict[str, Any]]],
+        max_queue_size: int = 64,
+        default_timeout: Optional[float] = None,
+        aging_threshold: float = 10.0,
+        stats_window: int = 1000,
+    ) -> None:
+        # create_completion is called with stream=True and must yield llama
+        # style chunks; the single worker thread serializes access to the model
+        self.create_completion = create_completion
+        self.max_queue_size = max_queue_size
+        self.default_timeout = default_timeout
+        # Low priority requests waiting longer than this are served anyway
+        self.aging_threshold = aging_threshold
+
+        # priority -> session_id -> pending requests; sessions are rotated
+        # to the back after being served, which gives round-robin fairness
+        self._queues: Dict[int, "OrderedDict[str, Deque[GenerationRequest]]"] = {}
+        self._queue_depth = 0
+        self._condition = threading.Condition()
+        self._running = True
+
+        self._wait_times: Deque[float] = deque(maxlen=stats_window)
+        self._ttfts: Deque[float] = deque(maxlen=stats_window)
+        self._tokens_per_sec: Deque[float] = deque(maxlen=stats_window)
+        self._counters = {
+            "submitted": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "expired": 0,
+            "rejected": 0,
+            "failed": 0,
+        }
+        self._total_tokens = 0
+        self._total_generation_time = 0.0
+        self.current: Optional[GenerationRequest] = None
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(
+        self,
+        session_id: str,
+        prompt: Any,
+        priority: int = PRIORITY_SLOT,
+        timeout: Optional[float] = None,
+        **completion_kwargs: Any,
+    ) -> GenerationRequest:
+        timeout = timeout if timeout is not None else self.default_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        request = GenerationRequest(
+            session_id, prompt, priority, deadline, completion_kwargs, scheduler=self
+        )
+
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Scheduler is shut down")
+            if self._queue_depth >= self.max_queue_size:
+                self._drop_stale()
+            if self._queue_depth >= self.max_queue_size:
+                self._counters["rejected"] += 1
+                raise QueueFullError(
+                    f"Generation queue is full ({self.max_queue_size} requests)"
+                )
+
+            sessions = self._queues.setdefault(priority, OrderedDict())
+            sessions.setdefault(session_id, deque()).append(request)
+            self._queue_depth += 1
+            self._counters["submitted"] += 1
+            self._condition.notify()
+
+        return request
+
+    def _pop_next(self) -> Optional[GenerationRequest]:
+        levels = sorted(level for level, sessions in self._queues.items() if sessions)
+        if not levels:
+            return None
+
+        level = levels[0]
+        now = time.monotonic()
+        for lower in levels[1:]:
+            oldest = min(
+                pending[0].enqueued_at for pending in self._queues[lower].values()
+            )
+            if now - oldest > self.aging_threshold:
+                level = lower
+                break
+
+        sessions = self._queues[level]
+        session_id, pending = sessions.popitem(last=False)
+        request = pending.popleft()
+        if pending:
+            sessions[session_id] = pending
+        self._queue_depth -= 1
+
+        return request
+
+    def _remove(self, request: GenerationRequest) -> bool:
+        # Caller holds _condition
+        sessions = self._queues.get(request.priority, {})
+        pending = sessions.get(request.session_id)
+        if not pending or request not in pending:
+            return False
+        pending.remove(request)
+        if not pending:
+            del sessions[request.session_id]
+        self._queue_depth -= 1
+        return True
+
+    def _withdraw(
+        self, request: GenerationRequest, outcome: str, error: Exception
+    ) -> bool:
+        # Finishes a request that is still queued; False once the worker has
+        # taken it, it then stops at the next chunk
+        with self._condition:
+            if not self._remove(request):
+                return False
+        request.error = error
+        self._finish(request, outcome)
+        return True
+
+    def _drop_stale(self) -> None:
+        # Caller holds _condition. Requests nobody waits for anymore must not
+        # make live ones fail with QueueFullError
+        now = time.monotonic()
+        for sessions in list(self._queues.values()):
+            for pending in list(sessions.values()):
+                for request in list(pending):
+                    if request.cancelled:
+                        self._withdraw(
+                            request,
+                            "cancelled",
+                            GenerationCancelledError("Cancelled while queued"),
+                        )
+                    elif request.expired(now):
+                        self._withdraw(
+                            request,
+                            "expired",
+                            DeadlineExceededError("Deadline passed while queued"),
+                        )
+
+    def _finish(self, request: GenerationRequest, outcome: str) -> None:
+        request.finished_at = time.monotonic()
+        with self._condition:
+            self._counters[outcome] += 1
+        request._chunks.put(_DONE)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self._running and self._queue_depth == 0:
+                    self._condition.wait()
+                if not self._running and self._queue_depth == 0:
+                    return
+                request = self._pop_next()
+
+            # Expiry first: a consumer that gave up on its deadline also
+            # cancels the request
+            if request.expired():
+                request.error = DeadlineExceededError("Deadline passed while queued")
+                self._finish(request, "expired")
+                continue
+            if request.cancelled:
+                request.error = GenerationCancelledError("Cancelled while queued")
+                self._finish(request, "cancelled")
+                continue
+
+            self._generate(request)
+
+    def _generate(self, request: GenerationRequest) -> None:
+        request.started_at = time.monotonic()
+        self._wait_times.append(request.started_at - request.enqueued_at)
+        self.current = request
+        outcome = "completed"
+
+        try:
+            completion = self.create_completion(
+                prompt=request.prompt, stream=True, **request.completion_kwargs
+            )
+            try:
+                for chunk in completion:
+                    if request.expired():
+                        outcome = "expired"
+                        request.error = DeadlineExceededError(
+                            "Deadline passed during generation"
+                        )
+                        break
+                    if request.cancelled:
+                        outcome = "cancelled"
+                        request.error = GenerationCancelledError(
+                            "Cancelled during generation"
+                        )
+                        break
+                    if request.first_token_at is None:
+                        request.first_token_at = time.monotonic()
+                    request.n_tokens += 1
+                    request._chunks.put(chunk)
+            finally:
+                close = getattr(completion, "close", None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            outcome = "failed"
+            request.error = e
+        finally:
+            self.current = None
+
+        elapsed = time.monotonic() - request.started_at
+        if request.first_token_at is not None:
+            self._ttfts.append(request.first_token_at - request.started_at)
+        if request.n_tokens and elapsed > 0:
+            self._tokens_per_sec.append(request.n_tokens / elapsed)
+            with self._condition:
+                self._total_tokens += request.n_tokens
+                self._total_generation_time += elapsed
+
+        self._finish(request, outcome)
+
+    def queue_depth(self, priority: Optional[int] = None) -> int:
+        with self._condition:
+            if priority is None:
+                return self._queue_depth
+            return sum(
+                len(pending) for pending in self._queues.get(priority, {}).values()
+            )
+
+    @staticmethod
+    def _summary(samples: List[float]) -> Dict[str, Optional[float]]:
+        if not samples:
+            return {"mean": None, "p50": None, "p95": None, "max": None}
+        return {
+            "mean": float(np.mean(samples)),
+            "p50": float(np.percentile(samples, 50)),
+            "p95": float(np.percentile(samples, 95)),
+            "max": float(np.max(samples)),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            depth_by_priority = {
+                level: sum(len(pending) for pending in sessions.values())
+                for level, sessions in self._queues.items()
+            }
+            counters = dict(self._counters)
+            throughput = (
+                self._total_tokens / self._total_generation_time
+                if self._total_generation_time > 0
+                else None
+            )
+
+        return {
+            "queue_depth": sum(depth_by_priority.values()),
+            "queue_depth_by_priority": depth_by_priority,
+            "busy": self.current is not None,
+            **counters,
+            "wait_time_s": self._summary(list(self._wait_times)),
+            "ttft_s": self._summary(list(self._ttfts)),
+            "tokens_per_sec": self._summary(list(self._tokens_per_sec)),
+            "aggregate_tokens_per_sec": throughput,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if wait:
+            self._worker.join()
@@ -0,0 +1,305 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+
+class SeatUnavailableError(Exception):
+    pass
+
+
+class SeatInventory:
+    # Short-lived holds and final sales of flights (one seat per ticket id).
+    # State is split into stripes by ticket id, each with its own lock, so
+    # sessions booking different flights never wait for each other. A hold
+    # past its expiry counts as free everywhere; release_expired (run by the
+    # sweeper thread when sweep_interval is set) only reclaims the memory.
+    def __init__(
+        self,
+        flights_db: Any = None,
+        hold_ttl: float = 300.0,
+        n_stripes: int = 64,
+        sweep_interval: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.flights_db = flights_db
+        self.hold_ttl = hold_ttl
+        self.clock = clock
+
+        self._locks = [threading.Lock() for _ in range(n_stripes)]
+        # ticket id -> (session id, expires at)
+        self._holds: List[Dict[int, Tuple[str, float]]] = [{} for _ in range(n_stripes)]
+        self._sold: List[Set[int]] = [set() for _ in range(n_stripes)]
+
+        # Counters are per stripe too, so they are only touched under its lock
+        self._counts: List[Dict[str, int]] = [
+            {"holds": 0, "sales": 0, "conflicts": 0, "expired_holds": 0}
+            for _ in range(n_stripes)
+        ]
+
+        self._running = True
+        if sweep_interval is not None:
+            self._sweeper = threading.Thread(
+                target=self._sweep, args=(sweep_interval,), daemon=True
+            )
+            self._sweeper.start()
+
+    def _stripe(self, ticket_id: int) -> int:
+        return hash(ticket_id) % len(self._locks)
+
+    def _is_sold(self, stripe: int, ticket_id: int) -> bool:
+        if ticket_id in self._sold[stripe]:
+            return True
+        return self.flights_db is not None and self.flights_db.is_sold(ticket_id)
+
+    def _holder(self, stripe: int, ticket_id: int, now: float) -> Optional[str]:
+        hold = self._holds[stripe].get(ticket_id)
+        if hold is None:
+            return None
+        if hold[1] <= now:
+            del self._holds[stripe][ticket_id]
+            self._counts[stripe]["expired_holds"] += 1
+            return None
+        return hold[0]
+
+    def is_available(self, ticket_id: int, session_id: Optional[str] = None) -> bool:
+        stripe = self._stripe(ticket_id)
+        with self._locks[stripe]:
+            if self._is_sold(stripe, ticket_id):
+                return False
+            holder = self._holder(stripe, ticket_id, self.clock())
+            return holder is None or holder == session_id
+
+    def hold(self, ticket_id: int, session_id: str) -> float:
+        # Takes or extends the session's hold, returns when it expires
+        stripe = self._stripe(ticket_id)
+        with self._locks[stripe]:
+            now = self.clock()
+            holder = self._holder(stripe, ticket_id, now)
+            if self._is_sold(stripe, ticket_id) or holder not in (None, session_id):
+                self._counts[stripe]["conflicts"] += 1
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+
+            expires_at = now + self.hold_ttl
+            self._holds[stripe][ticket_id] = (session_id, expires_at)
+            self._counts[stripe]["holds"] += holder is None
+            return expires_at
+
+    def release(self, ticket_id: int, session_id: str) -> bool:
+        stripe = self._stripe(ticket_id)
+        with self._locks[stripe]:
+            hold = self._holds[stripe].get(ticket_id)
+            if hold is None or hold[0] != session_id:
+                return False
+            del self._holds[stripe][ticket_id]
+            return True
+
+    def release_session(self, session_id: str) -> int:
+        released = 0
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                holds = self._holds[stripe]
+                for ticket_id in [t for t, h in holds.items() if h[0] == session_id]:
+                    del holds[ticket_id]
+                    released += 1
+        return released
+
+    def commit(self, ticket_id: int, session_id: str) -> None:
+        # Sells the seat if the session still holds it, or if its hold
+        # expired but nobody else took the seat in the meantime
+        stripe = self._stripe(ticket_id)
+        with self._locks[stripe]:
+            holder = self._holder(stripe, ticket_id, self.clock())
+            if self._is_sold(stripe, ticket_id) or holder not in (None, session_id):
+                self._counts[stripe]["conflicts"] += 1
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+
+            if self.flights_db is not None and not self.flights_db.mark_sold(ticket_id):
+                # Sold by another process sharing the flights db
+                self._counts[stripe]["conflicts"] += 1
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+            self._sold[stripe].add(ticket_id)
+            self._holds[stripe].pop(ticket_id, None)
+            self._counts[stripe]["sales"] += 1
+
+    def release_expired(self) -> int:
+        released = 0
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                now = self.clock()
+                holds = self._holds[stripe]
+                expired = [t for t, h in holds.items() if h[1] <= now]
+                for ticket_id in expired:
+                    del holds[ticket_id]
+                self._counts[stripe]["expired_holds"] += len(expired)
+                released += len(expired)
+        return released
+
+    def _sweep(self, interval: float) -> None:
+        while self._running:
+            time.sleep(interval)
+            self.release_expired()
+
+    def stats(self) -> Dict[str, int]:
+        stats = {"active_holds": sum(len(holds) for holds in self._holds)}
+        for counts in self._counts:
+            for name, count in counts.items():
+                stats[name] = stats.get(name, 0) + count
+        return stats
+
+    def shutdown(self) -> None:
+        self._running = False
+
+
+class SharedSeatInventory(SeatInventory):
+    # The same holds, kept in a SQLite file so that several processes
+    # (prefork workers) sharing it see each other's: a check and the write
+    # that follows run in one write transaction, which SQLite serializes
+    # between processes. Expiry uses wall-clock time, the same in every
+    # process. Sales are shared through flights_db's sold file; counters and
+    # sales without a flights_db stay per process.
+    def __init__(
+        self,
+        path: str,
+        flights_db: Any = None,
+        hold_ttl: float = 300.0,
+        sweep_interval: Optional[float] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # A connection per thread, so turns of different sessions don't queue
+        # on one connection
+        self._local = threading.local()
+        with self._transaction() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS holds (ticket_id INTEGER PRIMARY KEY, "
+                "session_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        super().__init__(
+            flights_db,
+            hold_ttl=hold_ttl,
+            n_stripes=1,
+            sweep_interval=sweep_interval,
+            clock=clock,
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            # Connections must not cross a fork
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _count(self, name: str) -> None:
+        with self._locks[0]:
+            self._counts[0][name] += 1
+
+    def _shared_holder(
+        self, db: sqlite3.Connection, ticket_id: int, now: float
+    ) -> Optional[str]:
+        row = db.execute(
+            "SELECT session_id, expires_at FROM holds WHERE ticket_id = ?",
+            (ticket_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            db.execute("DELETE FROM holds WHERE ticket_id = ?", (ticket_id,))
+            self._count("expired_holds")
+            return None
+        return row[0]
+
+    def _sold_anywhere(self, ticket_id: int) -> bool:
+        if self.flights_db is not None:
+            # Sales by other processes
+            self.flights_db.refresh_sold()
+        with self._locks[0]:
+            return self._is_sold(0, ticket_id)
+
+    def is_available(self, ticket_id: int, session_id: Optional[str] = None) -> bool:
+        if self._sold_anywhere(ticket_id):
+            return False
+        with self._transaction() as db:
+            holder = self._shared_holder(db, ticket_id, self.clock())
+        return holder is None or holder == session_id
+
+    def hold(self, ticket_id: int, session_id: str) -> float:
+        with self._transaction() as db:
+            now = self.clock()
+            holder = self._shared_holder(db, ticket_id, now)
+            if self._sold_anywhere(ticket_id) or holder not in (None, session_id):
+                self._count("conflicts")
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+
+            expires_at = now + self.hold_ttl
+            db.execute(
+                "INSERT OR REPLACE INTO holds VALUES (?, ?, ?)",
+                (ticket_id, session_id, expires_at),
+            )
+        if holder is None:
+            self._count("holds")
+        return expires_at
+
+    def release(self, ticket_id: int, session_id: str) -> bool:
+        with self._transaction() as db:
+            cursor = db.execute(
+                "DELETE FROM holds WHERE ticket_id = ? AND session_id = ?",
+                (ticket_id, session_id),
+            )
+        return cursor.rowcount > 0
+
+    def release_session(self, session_id: str) -> int:
+        with self._transaction() as db:
+            cursor = db.execute("DELETE FROM holds WHERE session_id = ?", (session_id,))
+        return cursor.rowcount
+
+    def commit(self, ticket_id: int, session_id: str) -> None:
+        with self._transaction() as db:
+            holder = self._shared_holder(db, ticket_id, self.clock())
+            if self._sold_anywhere(ticket_id) or holder not in (None, session_id):
+                self._count("conflicts")
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+
+            if self.flights_db is not None and not self.flights_db.mark_sold(ticket_id):
+                self._count("conflicts")
+                raise SeatUnavailableError(f"Ticket {ticket_id} is not available")
+            with self._locks[0]:
+                self._sold[0].add(ticket_id)
+            db.execute("DELETE FROM holds WHERE ticket_id = ?", (ticket_id,))
+        self._count("sales")
+
+    def release_expired(self) -> int:
+        with self._transaction() as db:
+            cursor = db.execute(
+                "DELETE FROM holds WHERE expires_at <= ?", (self.clock(),)
+            )
+        with self._locks[0]:
+            self._counts[0]["expired_holds"] += cursor.rowcount
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        # Holds of every process
+        stats["active_holds"] = (
+            self._connection()
+            .execute("SELECT COUNT(*) FROM holds WHERE expires_at > ?", (self.clock(),))
+            .fetchone()[0]
+        )
+        return stats
@@ -0,0 +1,506 @@
+import argparse
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from llm import LlamaCPPLLM
+from session import BookingSession
+from session_store import SessionStore
+from slot_templates import SlotTemplates
+from seat_inventory import SeatInventory, SharedSeatInventory
+from scheduler import (
+    GenerationScheduler,
+    QueueFullError,
+    DeadlineExceededError,
+    GenerationCancelledError,
+)
+from telemetry import telemetry
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+# Chat messages are short, a bigger body is refused before it is read
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, reason: str) -> None:
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+async def read_request(
+    reader: asyncio.StreamReader,
+) -> Tuple[str, str, Dict[str, str], bytes]:
+    request_line = await reader.readline()
+    if not request_line:
+        raise ConnectionError("Client closed the connection")
+
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Bad Request")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Bad Request")
+    if length < 0:
+        raise HTTPError(400, "Bad Request")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "Payload Too Large")
+    body = await reader.readexactly(length)
+
+    return method.upper(), path, headers, body
+
+
+def parse_chat_payload(body: bytes) -> Dict[str, Any]:
+    # {"message": str[, "session_id": str]}, anything else is a 400
+    try:
+        payload = json.loads(body or b"{}")
+        message = payload["message"]
+        session_id = payload.get("session_id")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPError(400, "Bad Request")
+    if not isinstance(message, str) or not isinstance(session_id, (str, type(None))):
+        raise HTTPError(400, "Bad Request")
+    return payload
+
+
+ERROR_STATUSES = {
+    QueueFullError: (503, "Service Unavailable"),
+    DeadlineExceededError: (504, "Gateway Timeout"),
+    GenerationCancelledError: (499, "Client Closed Request"),
+}
+
+
+class ChatServer:
+    def __init__(
+        self,
+        llm_agent: LlamaCPPLLM,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_workers: int = 8,
+        sessions: Optional[SessionStore] = None,
+    ) -> None:
+        # One agent holds the shared Llama, embedder, NER and databases,
+        # sessions get lightweight per-session views of it
+        self.llm_agent = llm_agent
+        self.llm_agent.streaming = True
+        self.host = host
+        self.port = port
+
+        self.sessions = sessions if sessions is not None else SessionStore()
+        # Per-session locks and their requests in flight, dropped at zero so
+        # spilled sessions leave nothing behind
+        self.session_locks: Dict[str, asyncio.Lock] = {}
+        self.session_requests: Dict[str, int] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Session store calls (SQLite, pickling) stay off the event loop and
+        # don't queue behind generations
+        self.store_executor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="session-store"
+        )
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def in_store_executor(self, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.store_executor, fn, *args)
+
+    async def get_session(self, session_id: Optional[str] = None) -> BookingSession:
+        # Restored if it was spilled; kept resident until put_session()
+        session = await self.in_store_executor(self.sessions.acquire, session_id)
+        if session.session_id not in self.session_locks:
+            self.session_locks[session.session_id] = asyncio.Lock()
+            self.session_requests[session.session_id] = 0
+        self.session_requests[session.session_id] += 1
+        return session
+
+    async def put_session(self, session: BookingSession) -> None:
+        self.session_requests[session.session_id] -= 1
+        if not self.session_requests[session.session_id]:
+            del self.session_requests[session.session_id]
+            del self.session_locks[session.session_id]
+        await self.in_store_executor(self.sessions.release, session)
+
+    def close_session(self, session_id: str) -> bool:
+        self.llm_agent.inventory.release_session(session_id)
+        return self.sessions.remove(session_id)
+
+    def _produce(
+        self,
+        session: BookingSession,
+        message: str,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        cancelled: threading.Event,
+    ) -> None:
+        # Runs in a worker thread. Tokens are handed to the event loop without
+        # waiting for the client, so a slow reader never holds the model lock
+        agent = self.llm_agent.for_session(session)
+        try:
+            completion = agent.generate(message)
+            try:
+                for chunk in completion:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(
+                        queue.put_nowait, chunk["choices"][0]["text"]
+                    )
+            finally:
+                completion.close()
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def stream_reply(
+        self, session: BookingSession, message: str, writer: asyncio.StreamWriter
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        async with self.session_locks[session.session_id]:
+            producer = loop.run_in_executor(
+                self.executor, self._produce, session, message, loop, queue, cancelled
+            )
+
+            # Headers wait for the first token so that scheduler rejections
+            # can still be reported with a proper status code
+            token = await queue.get()
+            if isinstance(token, Exception):
+                await producer
+                status, reason = ERROR_STATUSES.get(
+                    type(token), (500, "Internal Server Error")
+                )
+                telemetry.count(
+                    "generation_failures_total",
+                    error=type(token).__name__,
+                    stage="before_stream",
+                )
+                # Unexpected errors are not described to the client
+                error = str(token) if type(token) in ERROR_STATUSES else reason
+                await self.send_json(writer, status, reason, {"error": error})
+                return
+
+            writer.write(
+                (
+                    "HTTP/1.1 200 OK\r\n"
+                    "Content-Type: text/plain; charset=utf-8\r\n"
+                    "Transfer-Encoding: chunked\r\n"
+                    f"X-Session-Id: {session.session_id}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+            )
+
+            try:
+                while token is not None:
+                    if isinstance(token, Exception):
+                        # The 200 is sent already, the reply just ends early
+                        telemetry.count(
+                            "generation_failures_total",
+                            error=type(token).__name__,
+                            stage="streaming",
+                        )
+                        break
+                    data = token.encode("utf-8")
+                    if data:
+                        writer.write(
+                            f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n"
+                        )
+                        await writer.drain()
+                    token = await queue.get()
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            except (ConnectionError, asyncio.CancelledError):
+                # Client went away: stop generating for it
+                cancelled.set()
+                raise
+            finally:
+                await producer
+
+    async def send_json(
+        self, writer: asyncio.StreamWriter, status: int, reason: str, payload: dict
+    ) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+    async def send_text(
+        self, writer: asyncio.StreamWriter, status: int, reason: str, text: str
+    ) -> None:
+        body = text.encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, path, headers, body = await read_request(reader)
+
+            if method == "POST" and path == "/chat":
+                payload = parse_chat_payload(body)
+                session = await self.get_session(payload.get("session_id"))
+                try:
+                    await self.stream_reply(session, payload["message"], writer)
+                finally:
+                    await self.put_session(session)
+            elif method == "DELETE" and path.startswith("/sessions/"):
+                closed = await self.in_store_executor(
+                    self.close_session, path[len("/sessions/") :]
+                )
+                await self.send_json(writer, 200, "OK", {"closed": closed})
+            elif method == "GET" and path == "/health":
+                await self.send_json(
+                    writer, 200, "OK", {"sessions": len(self.sessions)}
+                )
+            elif method == "GET" and path == "/metrics":
+                scheduler = self.llm_agent.scheduler
+                session_store = await self.in_store_executor(self.sessions.stats)
+                await self.send_json(
+                    writer,
+                    200,
+                    "OK",
+                    {
+                        "sessions": len(self.sessions),
+                        "session_store": session_store,
+                        "scheduler": scheduler.stats() if scheduler else None,
+                        "prefix_cache": (
+                            self.llm_agent.prefix_cache.stats()
+                            if self.llm_agent.prefix_cache
+                            else None
+                        ),
+                        "seat_inventory": self.llm_agent.inventory.stats(),
+                        "tickets_db": self.llm_agent.tickets_db.stats(),
+                        "prompts": self.llm_agent.prompt_builder.stats(),
+                        "telemetry": telemetry.snapshot(),
+                    },
+                )
+            elif method == "GET" and path == "/metrics/prometheus":
+                await self.send_text(writer, 200, "OK", telemetry.prometheus())
+            else:
+                raise HTTPError(404, "Not Found")
+        except HTTPError as e:
+            await self.send_json(writer, e.status, e.reason, {"error": e.reason})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port
+        )
+
+    async def serve_forever(self) -> None:
+        if self.server is None:
+            await self.start()
+        print(f"Serving on {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+        self.store_executor.shutdown(wait=True)
+        self.sessions.close()
+        if self.llm_agent.scheduler is not None:
+            self.llm_agent.scheduler.shutdown()
+        if self.llm_agent.tickets_db is not None:
+            self.llm_agent.tickets_db.close()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    # Shared with prefork.py, which runs this server in each worker
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="per-request deadline, seconds"
+    )
+    parser.add_argument(
+        "--stub-llm", action="store_true", help="serve fake tokens instead of Mistral"
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=int,
+        default=512,
+        help="memory budget for cached system prompt states, 0 disables it",
+    )
+    parser.add_argument(
+        "--seat-hold-ttl",
+        type=float,
+        default=300.0,
+        help="seconds a chosen seat stays reserved while details are filled in",
+    )
+    parser.add_argument(
+        "--slot-responses",
+        choices=["llm", "template"],
+        default=None,
+        help="ask for missing ticket fields with the model or with templates "
+        "(default: SLOT_RESPONSES from .env, else llm)",
+    )
+    parser.add_argument(
+        "--slot-templates",
+        default=None,
+        help="JSON file of {context key: [phrasings]}, e.g. pre-generated with "
+        "the deployed model (default: SLOT_TEMPLATES from .env, else built-in)",
+    )
+    parser.add_argument(
+        "--session-store",
+        default=f"{env['DB_PATH']}/sessions.sqlite3",
+        help="SQLite file idle sessions are spilled to, empty keeps all in memory",
+    )
+    parser.add_argument("--max-resident-sessions", type=int, default=1024)
+    parser.add_argument(
+        "--session-memory-mb",
+        type=int,
+        default=64,
+        help="memory budget for resident session state",
+    )
+    parser.add_argument(
+        "--session-idle-ttl",
+        type=float,
+        default=600.0,
+        help="seconds without a message before a session is spilled",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        help="record spans and metrics (default: TELEMETRY from .env)",
+    )
+    parser.add_argument(
+        "--telemetry-path", default=None, help="append finished spans to this JSONL"
+    )
+
+
+def open_session_store(args: argparse.Namespace) -> SessionStore:
+    return SessionStore(
+        args.session_store or None,
+        max_resident=args.max_resident_sessions,
+        max_bytes=args.session_memory_mb * 1024 * 1024,
+        idle_ttl=args.session_idle_ttl,
+        sweep_interval=min(args.session_idle_ttl, 60.0),
+    )
+
+
+def build_agent(
+    args: argparse.Namespace, tickets_db, flights_db, seat_holds: Optional[str] = None
+) -> LlamaCPPLLM:
+    # seat_holds: SQLite file of holds shared with other processes
+    from models import registry
+
+    if seat_holds is not None:
+        inventory = SharedSeatInventory(
+            seat_holds, flights_db, hold_ttl=args.seat_hold_ttl, sweep_interval=60.0
+        )
+    else:
+        inventory = SeatInventory(
+            flights_db, hold_ttl=args.seat_hold_ttl, sweep_interval=60.0
+        )
+
+    llm_agent = LlamaCPPLLM(
+        env["LLM_PATH"],
+        tickets_db,
+        flights_db,
+        llama=registry.get("llama"),
+        inventory=inventory,
+        slot_responses=args.slot_responses,
+        slot_templates=(
+            SlotTemplates(path=args.slot_templates) if args.slot_templates else None
+        ),
+    )
+    llm_agent.user = "### Instructions"
+    llm_agent.assistant = "### Response"
+    if args.prefix_cache_mb and not args.stub_llm:
+        from prefix_cache import PrefixStateCache
+
+        llm_agent.prefix_cache = PrefixStateCache(
+            llm_agent.llama, max_bytes=args.prefix_cache_mb * 1024 * 1024
+        )
+    llm_agent.scheduler = GenerationScheduler(
+        llm_agent.create_completion,
+        max_queue_size=args.max_queue,
+        default_timeout=args.timeout,
+    )
+    return llm_agent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.telemetry:
+        telemetry.configure(enabled=True)
+    if args.telemetry_path:
+        telemetry.configure(path=args.telemetry_path)
+
+    from concurrent.futures import wait
+    from embedding_batcher import BatchingEmbedder
+    from models import registry
+    from tickets_db import TicketsDB
+    from flights_db import FlightsDB
+
+    if args.stub_llm:
+        from stubs import StubLlama
+
+        registry.set("llama", StubLlama(token_delay=0.05))
+    warmup = registry.warmup(["llama", "embedder", "bert_ner"])
+
+    # Concurrent sessions share forward passes through the micro-batcher
+    tickets_db = TicketsDB(
+        "total-memory", embedder=BatchingEmbedder(registry.get("embedder"))
+    )
+    # Tickets logged by prefork workers that were not flushed
+    tickets_db.adopt_logs()
+    flights_db = FlightsDB("flights")
+
+    wait(warmup.values())
+    print(registry.report())
+    llm_agent = build_agent(args, tickets_db, flights_db)
+    sessions = open_session_store(args)
+
+    try:
+        asyncio.run(
+            ChatServer(
+                llm_agent, args.host, args.port, args.workers, sessions
+            ).serve_forever()
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Buffered tickets are logged already, this only saves a replay
+        tickets_db.close()
+        sessions.close()
+        telemetry.close()
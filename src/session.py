@@ -0,0 +1,42 @@
+import uuid
+from typing import Any, Dict, List, Optional
+
+# Filled from the chosen flight, cleared when its seat is lost
+FLIGHT_FIELDS = ["ticket_id", "departure_date", "arrival_date", "seat_place", "price"]
+
+TICKET_FIELDS = [
+    "city_name",
+    "ticket_id",
+    "departure_date",
+    "arrival_date",
+    "seat_place",
+    "price",
+    "class_of_service",
+    "user_name",
+    "document_number",
+    "gender",
+    "birth_date",
+    "email",
+]
+
+
+class BookingSession:
+    def __init__(self, session_id: Optional[str] = None) -> None:
+        self.session_id: str = session_id or str(uuid.uuid4())
+        self.ticket_info: Dict[str, Any] = {key: None for key in TICKET_FIELDS}
+        # Name of the LlamaCPPLLM method that handles the ongoing flow
+        # ("add_ticket_response" / "memory_response"), None when idle
+        self.current_response: Optional[str] = None
+        # FlightsDB.search_flights arguments collected from the conversation
+        self.flight_filters: Dict[str, Any] = {}
+        # Prompt length in tokens of every model turn
+        self.prompt_tokens: List[int] = []
+
+    def clear_ticket_info(self) -> None:
+        for key in self.ticket_info.keys():
+            self.ticket_info[key] = None
+        self.flight_filters = {}
+
+    def clear_flight(self) -> None:
+        for key in FLIGHT_FIELDS:
+            self.ticket_info[key] = None
@@ -0,0 +1,320 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from session import BookingSession
+from telemetry import telemetry
+
+
+class SessionStore:
+    # Booking sessions by id. Resident sessions are kept in LRU order, within
+    # max_resident sessions and max_bytes of pickled state; past either, and
+    # after idle_ttl seconds without a message (checked by the sweeper thread
+    # when sweep_interval is set), the least recently used ones are spilled
+    # to a SQLite file and restored on their next message. A session is never
+    # spilled while a turn uses it, between acquire() and release(). Without
+    # a path every session stays resident.
+    # Only the resident map changes under _lock; pickling and SQLite I/O run
+    # outside it, with sessions being spilled or restored marked in transit
+    # so no other call touches them meanwhile.
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_resident: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_ttl: Optional[float] = 600.0,
+        disk_ttl: Optional[float] = 7 * 24 * 3600.0,
+        sweep_interval: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.path = path
+        self.max_resident = max_resident
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        # Spilled sessions nobody came back to are deleted after disk_ttl
+        self.disk_ttl = disk_ttl
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        # Serializes use of the connection, never taken under _lock
+        self._db_lock = threading.Lock()
+        # session id -> set once its spill or restore is done
+        self._transit: Dict[str, threading.Event] = {}
+        self._resident: "OrderedDict[str, BookingSession]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._last_used: Dict[str, float] = {}
+        # session id -> turns using it right now
+        self._active: Dict[str, int] = {}
+        self.size_bytes = 0
+
+        self.n_created = 0
+        self.n_restores = 0
+        self.restore_seconds = 0.0
+        self.max_restore_seconds = 0.0
+        self.evictions: Dict[str, int] = {"lru": 0, "idle": 0, "shutdown": 0}
+
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # Prefork workers share the file, SQLite locks it between them
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # A power loss may lose the last spills, not corrupt the file
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, state BLOB NOT NULL, "
+                "spilled_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+        self._running = True
+        if sweep_interval is not None:
+            self._sweeper = threading.Thread(
+                target=self._sweep, args=(sweep_interval,), daemon=True
+            )
+            self._sweeper.start()
+
+    def __len__(self) -> int:
+        return len(self._resident)
+
+    def _measure(self, session: BookingSession) -> int:
+        return len(pickle.dumps(session, pickle.HIGHEST_PROTOCOL))
+
+    def _add(self, session: BookingSession, size: int) -> None:
+        self._resident[session.session_id] = session
+        self._sizes[session.session_id] = size
+        self._last_used[session.session_id] = self.clock()
+        self.size_bytes += size
+
+    def _pop(self, session_id: str) -> BookingSession:
+        self.size_bytes -= self._sizes.pop(session_id)
+        del self._last_used[session_id]
+        return self._resident.pop(session_id)
+
+    def _end_transit(self, session_ids: List[str]) -> None:
+        with self._lock:
+            events = [self._transit.pop(id) for id in session_ids]
+        for event in events:
+            event.set()
+
+    def _restore(self, session_id: str) -> Optional[BookingSession]:
+        start = time.perf_counter()
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT state FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            # Resident again; it is written anew when spilled next time
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+        session = pickle.loads(zlib.decompress(row[0]))
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.n_restores += 1
+            self.restore_seconds += elapsed
+            self.max_restore_seconds = max(self.max_restore_seconds, elapsed)
+        telemetry.observe("session_restore_seconds", elapsed)
+        return session
+
+    def acquire(self, session_id: Optional[str] = None) -> BookingSession:
+        # The resident session, the spilled one restored, or a new one. A
+        # named session is in transit while it is restored or created, so
+        # concurrent first messages of one session share the same object
+        while True:
+            with self._lock:
+                event = self._transit.get(session_id) if session_id else None
+                if event is None:
+                    session = self._resident.get(session_id) if session_id else None
+                    if session is not None:
+                        self._resident.move_to_end(session_id)
+                        self._active[session_id] = self._active.get(session_id, 0) + 1
+                        return session
+                    loading = session_id is not None
+                    if loading:
+                        self._transit[session_id] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            session = (
+                self._restore(session_id) if loading and self._db is not None else None
+            )
+            created = session is None
+            if created:
+                session = BookingSession(session_id)
+            size = self._measure(session)
+            with self._lock:
+                self._add(session, size)
+                self.n_created += created
+                self._active[session.session_id] = (
+                    self._active.get(session.session_id, 0) + 1
+                )
+        finally:
+            if loading:
+                self._end_transit([session_id])
+        return session
+
+    def release(self, session: BookingSession) -> None:
+        # After a turn: the session's state may have grown
+        size = self._measure(session)
+        with self._lock:
+            session_id = session.session_id
+            self._active[session_id] -= 1
+            if not self._active[session_id]:
+                del self._active[session_id]
+            if session_id in self._resident:
+                self._resident.move_to_end(session_id)
+                self.size_bytes += size - self._sizes[session_id]
+                self._sizes[session_id] = size
+                self._last_used[session_id] = self.clock()
+            victims = self._over_budget()
+        self._spill(victims, "lru")
+
+    def _take(self, session_id: str) -> Tuple[str, BookingSession, int]:
+        # Under _lock: out of the resident map and into transit
+        size = self._sizes[session_id]
+        self._transit[session_id] = threading.Event()
+        return session_id, self._pop(session_id), size
+
+    def _over_budget(self) -> List[Tuple[str, BookingSession, int]]:
+        victims = []
+        if self._db is None:
+            return victims
+        for session_id in list(self._resident):
+            if (
+                len(self._resident) <= self.max_resident
+                and self.size_bytes <= self.max_bytes
+            ):
+                break
+            if session_id not in self._active:
+                victims.append(self._take(session_id))
+        return victims
+
+    def _spill(
+        self, victims: List[Tuple[str, BookingSession, int]], reason: str
+    ) -> None:
+        if not victims:
+            return
+        try:
+            rows = [
+                (
+                    session_id,
+                    zlib.compress(pickle.dumps(session, pickle.HIGHEST_PROTOCOL)),
+                    time.time(),
+                )
+                for session_id, session, _ in victims
+            ]
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", rows
+                )
+                self._db.commit()
+        except Exception:
+            # Kept resident rather than lost; the next spill retries
+            with self._lock:
+                for session_id, session, size in victims:
+                    self._add(session, size)
+            raise
+        finally:
+            self._end_transit([session_id for session_id, _, _ in victims])
+        with self._lock:
+            self.evictions[reason] += len(victims)
+        telemetry.count("session_evictions_total", len(victims), reason=reason)
+
+    def evict_idle(self) -> int:
+        if self._db is None:
+            return 0
+        victims = []
+        with self._lock:
+            if self.idle_ttl is not None:
+                idle_since = self.clock() - self.idle_ttl
+                for session_id in list(self._resident):
+                    if self._last_used[session_id] > idle_since:
+                        # LRU order: the rest were used later
+                        break
+                    if session_id not in self._active:
+                        victims.append(self._take(session_id))
+        self._spill(victims, "idle")
+        if self.disk_ttl is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "DELETE FROM sessions WHERE spilled_at < ?",
+                    (time.time() - self.disk_ttl,),
+                )
+                self._db.commit()
+        return len(victims)
+
+    def _sweep(self, interval: float) -> None:
+        while self._running:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+            except sqlite3.Error as e:
+                # Sessions stay resident, the next sweep retries
+                print(f"SessionStore sweep failed: {e}")
+
+    def remove(self, session_id: str) -> bool:
+        while True:
+            with self._lock:
+                event = self._transit.get(session_id)
+                if event is None:
+                    removed = session_id in self._resident
+                    if removed:
+                        self._pop(session_id)
+                    break
+            event.wait()
+        if self._db is not None:
+            with self._db_lock:
+                cursor = self._db.execute(
+                    "DELETE FROM sessions WHERE session_id = ?", (session_id,)
+                )
+                self._db.commit()
+            removed = removed or cursor.rowcount > 0
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        spilled = 0
+        if self._db is not None:
+            with self._db_lock:
+                spilled = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[
+                    0
+                ]
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "resident_bytes": self.size_bytes,
+                "active": len(self._active),
+                "spilled": spilled,
+                "created": self.n_created,
+                "restores": self.n_restores,
+                "restore_ms_mean": (
+                    self.restore_seconds / self.n_restores * 1000
+                    if self.n_restores
+                    else 0.0
+                ),
+                "restore_ms_max": self.max_restore_seconds * 1000,
+                "evictions": dict(self.evictions),
+            }
+
+    def close(self) -> None:
+        # Idle sessions are spilled, so they survive a restart
+        self._running = False
+        if self._db is None:
+            return
+        with self._lock:
+            victims = [
+                self._take(session_id)
+                for session_id in list(self._resident)
+                if session_id not in self._active
+            ]
+        self._spill(victims, "shutdown")
+        with self._db_lock:
+            self._db.close()
+            self._db = None
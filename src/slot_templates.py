@@ -0,0 +1,111 @@
+import json
+import random
+import re
+from typing import Any, Dict, Iterator, List, Optional
+
+# Ready-made wordings of the slot questions asked by the system_contexts of
+# LlamaCPPLLM, so those turns don't need the model. {cities}, {city_name},
+# {ticket_ids} and {dropped_filters} are filled in on every turn.
+SLOT_TEMPLATES: Dict[str, List[str]] = {
+    "user_name": [
+        "Could you please tell me your full name?",
+        "May I have your full name for the booking?",
+        "What is the passenger's full name?",
+    ],
+    "gender": [
+        "Please specify your gender: Male or Female.",
+        "What is your gender, Male or Female?",
+        "For the ticket I need your gender. Is it Male or Female?",
+    ],
+    "birth_date": [
+        "What is your date of birth? Please use the format DD-MM-YYYY.",
+        "Could you tell me your birth date (DD-MM-YYYY)?",
+        "Please enter your date of birth in the DD-MM-YYYY format.",
+    ],
+    "email": [
+        "What email should we send the ticket to? For example, user@example.com.",
+        "Please provide your email address (e.g. user@example.com).",
+        "Could you share your email, like user@example.com?",
+    ],
+    "document_number": [
+        "Please enter your document number (10 digits).",
+        "What is your document number? It should have 10 digits.",
+        "Could you provide the 10-digit number of your document?",
+    ],
+    "city_name": [
+        "Where would you like to fly? We fly to {cities}.",
+        "Which city are you flying to? Available destinations: {cities}.",
+        "Please choose your destination city: {cities}.",
+    ],
+    "class_of_service": [
+        "Which class of service do you prefer: economy, business or first class?",
+        "Would you like to fly economy, business or first class?",
+        "Please choose a class of service: economy, business or first.",
+    ],
+    "ticket_id": [
+        "Please choose a flight by its id: {ticket_ids}.",
+        "Which of these flights suits you? Reply with its id: {ticket_ids}.",
+        "Here are the available flights. Pick one by id: {ticket_ids}.",
+    ],
+    "ticket_id_relaxed": [
+        "There are no flights with {dropped_filters}, so I left that out. "
+        "Please choose a flight by its id: {ticket_ids}.",
+        "Nothing matches {dropped_filters}; here are other flights. "
+        "Reply with an id: {ticket_ids}.",
+        "No flight has {dropped_filters}, so I dropped that condition. "
+        "Pick one by id: {ticket_ids}.",
+    ],
+    "city_no_flights": [
+        "There are no available flights to {city_name}. "
+        "Please choose another city: {cities}.",
+        "Flights to {city_name} are sold out. Where else would you like to fly? "
+        "We fly to {cities}.",
+        "I'm sorry, nothing is left to {city_name}. "
+        "Please pick another destination: {cities}.",
+    ],
+}
+
+
+class SlotTemplates:
+    # Serves slot questions as llama_cpp-shaped completions (a dict, or a
+    # generator of chunks when streaming), rotating through the phrasings.
+    # A JSON file of {context key: [phrasings]} replaces the built-in ones
+    # per key, e.g. for a pool pre-generated with the deployed model.
+    def __init__(
+        self,
+        templates: Optional[Dict[str, List[str]]] = None,
+        path: Optional[str] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.templates = {
+            key: list(phrasings)
+            for key, phrasings in (templates or SLOT_TEMPLATES).items()
+        }
+        if path is not None:
+            with open(path, encoding="utf-8") as f:
+                self.templates.update(json.load(f))
+        self._random = random.Random(seed)
+        self.served: Dict[str, int] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.templates.get(key))
+
+    def render(self, key: str, **values: Any) -> str:
+        self.served[key] = self.served.get(key, 0) + 1
+        values = {
+            name: ", ".join(map(str, value)) if isinstance(value, list) else value
+            for name, value in values.items()
+        }
+        return self._random.choice(self.templates[key]).format(**values)
+
+    def _chunk(self, text: str, finish_reason: Optional[str]) -> Dict[str, Any]:
+        return {"choices": [{"text": text, "index": 0, "finish_reason": finish_reason}]}
+
+    def _stream(self, text: str) -> Iterator[Dict[str, Any]]:
+        words = re.findall(r"\s*\S+", text)
+        for i, word in enumerate(words):
+            yield self._chunk(word, "stop" if i == len(words) - 1 else None)
+
+    def completion(self, key: str, stream: bool, **values: Any) -> Any:
+        text = self.render(key, **values)
+        return self._stream(text) if stream else self._chunk(text, "stop")
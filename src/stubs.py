@@ -0,0 +1,106 @@
+import hashlib
+import re
+import time
+import zlib
+import numpy as np
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+
+# Drop-in replacement for llama_cpp.Llama that yields fake tokens, so the
+# chat flow can be exercised without loading a model
+class StubLlama:
+    def __init__(
+        self,
+        tokens: Optional[List[str]] = None,
+        token_delay: float = 0.0,
+        prompt_delay: float = 0.0,
+        context_size: int = 2048,
+    ) -> None:
+        self.tokens = tokens or ["Hello", "!", " How", " can", " I", " help", "?"]
+        self.token_delay = token_delay
+        # Simulated prompt evaluation, paid once per completion
+        self.prompt_delay = prompt_delay
+        self.context_size = context_size
+        self.n_calls = 0
+
+    def n_ctx(self) -> int:
+        return self.context_size
+
+    def tokenize(
+        self, text: bytes, add_bos: bool = True, special: bool = False
+    ) -> List[int]:
+        # One token per word (with its leading whitespace), ids from a hash
+        words = re.findall(rb"\s*\S+|\s+", text)
+        return [1] * add_bos + [zlib.crc32(word) % 32000 + 2 for word in words]
+
+    def _chunk(self, text: str) -> Dict[str, Any]:
+        return {"choices": [{"text": text, "index": 0, "finish_reason": None}]}
+
+    def _stream(self, max_tokens: int) -> Iterator[Dict[str, Any]]:
+        if self.prompt_delay:
+            time.sleep(self.prompt_delay)
+        for token in self.tokens[:max_tokens]:
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield self._chunk(token)
+
+    def create_completion(
+        self,
+        prompt: Union[str, List[int]],
+        stream: bool = False,
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Any:
+        self.n_calls += 1
+        if stream:
+            return self._stream(max_tokens)
+        return self._chunk(
+            "".join(chunk["choices"][0]["text"] for chunk in self._stream(max_tokens))
+        )
+
+
+# Stands in for HFEmbedder: unit vectors seeded by a hash of the text, with
+# an optional simulated forward-pass cost per call and per text
+class StubEmbedder:
+    def __init__(
+        self, dim: int = 1024, call_delay: float = 0.0, text_delay: float = 0.0
+    ) -> None:
+        self.dim = dim
+        self.call_delay = call_delay
+        self.text_delay = text_delay
+        self.n_calls = 0
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim)
+        return vector / np.linalg.norm(vector)
+
+    def get_embeddings(self, texts: Union[str, List[str]]) -> List[List[float]]:
+        if type(texts) == str:
+            texts = [texts]
+        self.n_calls += 1
+        if self.call_delay or self.text_delay:
+            time.sleep(self.call_delay + self.text_delay * len(texts))
+        return np.stack([self._vector(text) for text in texts]).tolist()
+
+    def __call__(self, texts: Union[str, List[str]]) -> List[List[float]]:
+        return self.get_embeddings(texts)
+
+
+# Stands in for BERTNER: every run of two or more capitalized words is a
+# person, which is enough for scripted conversations
+class StubNER:
+    def __init__(self, call_delay: float = 0.0) -> None:
+        self.call_delay = call_delay
+        self.n_calls = 0
+
+    def __call__(self, text: str) -> List[Dict[str, Any]]:
+        self.n_calls += 1
+        if self.call_delay:
+            time.sleep(self.call_delay)
+        entities = []
+        for match in re.finditer(r"\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+)+\b", text):
+            for i, word in enumerate(match.group(0).split()):
+                entities.append({"entity": "I-PER" if i else "B-PER", "word": word})
+        return entities
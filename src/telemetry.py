@@ -0,0 +1,339 @@
+import contextvars
+import json
+import random
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from termcolor import colored
+from dotenv import dotenv_values
+
+env = dotenv_values(".env")
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is implied
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "attributes",
+        "start",
+        "duration",
+        "status",
+    )
+
+    def __init__(
+        self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]
+    ) -> None:
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.status = "ok"
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration * 1000,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    # Returned by span() while telemetry is disabled
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class _SpanContext:
+    def __init__(self, telemetry: "Telemetry", span: Span) -> None:
+        self.telemetry = telemetry
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self._token = _current_span.set(self.span)
+        self._started = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.span.status = "error"
+        self.telemetry.end_span(self.span, time.perf_counter() - self._started)
+
+
+class Telemetry:
+    # Nested timing spans, counters and latency histograms. Spans nest through
+    # a context variable, so a turn's extractor, database and model calls
+    # become its children; finished spans are appended to a JSON lines file.
+    # Disabled (the default), span() returns a shared no-op and traced
+    # functions pay a single flag check.
+    def __init__(
+        self,
+        enabled: bool = False,
+        path: Optional[str] = None,
+        console: bool = False,
+        buckets: Tuple[float, ...] = BUCKETS,
+    ) -> None:
+        self.enabled = enabled
+        self.path = path
+        # Prints the messages of traced functions, like the chat always did
+        self.console = console
+        self.buckets = buckets
+
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._file = None
+
+    def configure(
+        self,
+        enabled: Optional[bool] = None,
+        path: Optional[str] = None,
+        console: Optional[bool] = None,
+    ) -> None:
+        if enabled is not None:
+            self.enabled = enabled
+        if path is not None:
+            self.close()
+            self.path = path
+        if console is not None:
+            self.console = console
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def span(self, name: str, **attributes: Any) -> Any:
+        if not self.enabled:
+            return NOOP_SPAN
+        return _SpanContext(self, Span(name, _current_span.get(), attributes))
+
+    def end_span(self, span: Span, duration: float) -> None:
+        span.duration = duration
+        self.observe("span_duration_seconds", duration, span=span.name)
+        self.count("spans_total", span=span.name, status=span.status)
+        if self.path is not None:
+            line = json.dumps(span.to_dict(), default=str) + "\n"
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(line)
+                self._file.flush()
+
+    def traced(self, name: str, message: Optional[str] = None) -> Callable:
+        # Runs the function in a span named `name`
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if message is not None and self.console:
+                    print(f"LOG: {colored(message, color='yellow')}")
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def stream_completion(
+        self, context_key: Optional[str], chunks: Iterator[Any]
+    ) -> Iterator[Any]:
+        # A streamed completion is timed as it is consumed: its span (a child
+        # of the current one) ends with the last chunk, one chunk per token
+        if not self.enabled:
+            return chunks
+        return self._stream(context_key, chunks, _current_span.get())
+
+    def timed_completion(self, context_key: Optional[str], fn: Callable) -> Any:
+        # A blocking completion call: time, tokens and a span of its own
+        if not self.enabled:
+            return fn()
+        with self.span("llm.completion", context_key=context_key) as span:
+            start = time.perf_counter()
+            completion = fn()
+            self.observe(
+                "completion_seconds", time.perf_counter() - start, context=context_key
+            )
+            usage = completion.get("usage") or {}
+            span.set(tokens=usage.get("completion_tokens"))
+            self._count_tokens(context_key, usage.get("completion_tokens", 0))
+        return completion
+
+    def _count_tokens(self, context_key: Optional[str], n_tokens: int) -> None:
+        self.count("completions_total", context=context_key)
+        self.count("completion_tokens_total", n_tokens, context=context_key)
+
+    def _stream(
+        self, context_key: Optional[str], chunks: Iterator[Any], parent: Optional[Span]
+    ) -> Iterator[Any]:
+        span = Span("llm.completion", parent, {"context_key": context_key})
+        start = time.perf_counter()
+        n_tokens = 0
+        try:
+            for chunk in chunks:
+                if n_tokens == 0:
+                    ttft = time.perf_counter() - start
+                    span.set(ttft_ms=ttft * 1000)
+                    self.observe("completion_ttft_seconds", ttft, context=context_key)
+                n_tokens += 1
+                yield chunk
+        except GeneratorExit:
+            # The consumer stopped reading, e.g. the client went away
+            span.status = "cancelled"
+            raise
+        except BaseException:
+            span.status = "error"
+            raise
+        finally:
+            # Closes the underlying stream too, it may hold the model lock
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            duration = time.perf_counter() - start
+            span.set(tokens=n_tokens)
+            self.observe("completion_seconds", duration, context=context_key)
+            self._count_tokens(context_key, n_tokens)
+            self.end_span(span, duration)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(zip(map(str, self.buckets), histogram.counts)),
+                }
+                for (name, labels), histogram in self._histograms.items()
+            ]
+        return {"enabled": self.enabled, "counters": counters, "histograms": histograms}
+
+    def prometheus(self) -> str:
+        # Prometheus text exposition format
+        def labels_text(labels: Labels, extra: Labels = ()) -> str:
+            pairs = [
+                '{}="{}"'.format(
+                    k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                )
+                for k, v in labels + extra
+            ]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            for i, ((name, labels), value) in enumerate(counters):
+                if i == 0 or counters[i - 1][0][0] != name:
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{labels_text(labels)} {value}")
+            for i, ((name, labels), histogram) in enumerate(histograms):
+                if i == 0 or histograms[i - 1][0][0] != name:
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    le = (("le", str(bound)),)
+                    lines.append(f"{name}_bucket{labels_text(labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{labels_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{labels_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+telemetry = Telemetry(
+    enabled=(env.get("TELEMETRY") or "").lower() in ("1", "true", "on"),
+    path=env.get("TELEMETRY_PATH") or None,
+)
@@ -0,0 +1,31 @@
+import random
+import pytest
+from bench_extractors import GOLDEN, GOLDEN_FIELDS, extract_separately
+from utils import extract_slots
+
+GOLDEN_CASES = [(text, dict(zip(GOLDEN_FIELDS, values))) for text, *values in GOLDEN]
+
+
+@pytest.mark.parametrize("text, expected", GOLDEN_CASES)
+def test_extract_slots_matches_golden(text, expected):
+    assert extract_slots(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", GOLDEN_CASES)
+def test_per_field_extractors_match_golden(text, expected):
+    assert extract_separately(text) == expected
+
+
+def test_extract_slots_skips_birth_date_unless_asked():
+    text = "I was born 03-03-1985"
+    assert extract_slots(text, fields=("gender",))["birth_date"] is None
+    assert extract_slots(text, fields=("birth_date",))["birth_date"] == "1985-03-03"
+
+
+def test_extract_slots_matches_per_field_extractors_on_combined_messages():
+    # Joined messages put keywords of different slots next to each other
+    rng = random.Random(0)
+    texts = [text for text, *_ in GOLDEN if text]
+    for _ in range(500):
+        text = " ".join(rng.sample(texts, rng.randint(2, 4)))
+        assert extract_slots(text) == extract_separately(text), text
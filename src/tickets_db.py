@@ -1,38 +1,422 @@
-import chromadb
+import ast
+import glob
+import json
+import os
+import threading
+import time
 import uuid
 import datetime
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional
 from embedder import BaseEmbedder, HFEmbedder
+from embedding_cache import normalize_text
+from query_cache import QueryCache
+from vector_index import open_index
+from session import TICKET_FIELDS
+from telemetry import telemetry
 from dotenv import dotenv_values
 
 env = dotenv_values(".env")
 DB_PATH = env["DB_PATH"]
 
+# Ticket fields answered by an exact metadata match instead of vector search
+KEY_FIELDS = ["email", "document_number", "user_name"]
+
+
+def normalize_key(field: str, value: Any) -> str:
+    # "1234 567890" and "1234567890", "John@Mail.ru" and "john@mail.ru" match
+    if field == "document_number":
+        return "".join(ch for ch in str(value) if ch.isdigit())
+    return " ".join(str(value).split()).lower()
+
+
+def ticket_metadata(ticket: Dict[str, Any]) -> Dict[str, Any]:
+    # Chroma metadata takes str/int/float/bool only, no None or numpy scalars
+    metadata = {}
+    for field in TICKET_FIELDS:
+        value = ticket.get(field)
+        if value is None:
+            continue
+        if isinstance(value, np.generic):
+            value = value.item()
+        metadata[field] = value if isinstance(value, (int, float, bool)) else str(value)
+    for field in KEY_FIELDS:
+        if field in metadata:
+            metadata[f"key_{field}"] = normalize_key(field, metadata[field])
+    return metadata
+
+
+def ticket_document(metadata: Dict[str, Any]) -> str:
+    # The embedded text: the ticket fields only, the key_* copies would
+    # weigh the lookup keys twice in vector similarity
+    return json.dumps(
+        {field: metadata[field] for field in TICKET_FIELDS if field in metadata}
+    )
+
+
+def ticket_from_record(document: str, metadata: Optional[Dict[str, Any]]) -> Dict:
+    metadata = metadata or {}
+    if any(field in metadata for field in TICKET_FIELDS):
+        return {field: metadata.get(field) for field in TICKET_FIELDS}
+    # Tickets added before typed metadata only have the dict repr
+    return ast.literal_eval(document)
+
 
 class TicketsDB:
-    def __init__(self, collection_name, db_path=DB_PATH, embedder: BaseEmbedder = None):
+    # add() appends the ticket to a write-ahead log and an in-memory buffer;
+    # the buffer goes to Chroma as one batched embed + upsert once flush_size
+    # tickets are pending, every flush_interval seconds, or on close(). Queries
+    # merge the buffer in, so a ticket is visible as soon as add() returns.
+    # After a crash the log is replayed on startup; upserts by id make the
+    # replay idempotent. Results of query() and lookup() are cached until the
+    # next add, flush or delete, or for cache_ttl seconds.
+    # With shared=True the collection is used by several processes (prefork
+    # workers), each with its own log named by worker_id; tickets another
+    # worker still buffers become visible once it flushes.
+    def __init__(
+        self,
+        collection_name,
+        db_path=DB_PATH,
+        embedder: BaseEmbedder = None,
+        flush_size: int = 32,
+        flush_interval: Optional[float] = 1.0,
+        fsync: bool = True,
+        cache_size: int = 256,
+        cache_ttl: Optional[float] = 60.0,
+        index: Optional[str] = None,
+        shared: bool = False,
+        worker_id: Optional[str] = None,
+    ):
         self.embedder = embedder
-        self.client = chromadb.PersistentClient(path=db_path)
-        self.collection = self.client.get_or_create_collection(
-            name=collection_name, embedding_function=self.embedder.get_embeddings
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self.shared = shared
+        # "chroma" (default), "numpy" or "ivf", see vector_index.open_index
+        self.collection = open_index(
+            index or env.get("TICKETS_INDEX") or "chroma",
+            db_path,
+            collection_name,
+            self.embedder,
+            shared=shared,
+        )
+
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.wal_path = os.path.join(
+            db_path,
+            (
+                f"{collection_name}.{worker_id}.wal"
+                if worker_id is not None
+                else f"{collection_name}.wal"
+            ),
         )
+        # Guards the buffer and the log file; _flush_lock lets one flush run
+        # at a time without blocking add() while it embeds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self.n_flushes = 0
+        self.n_flushed = 0
+        self.cache = QueryCache(max_items=cache_size, ttl=cache_ttl)
 
+        self._replay()
+
+        self._running = True
+        self._flusher = None
+        if flush_interval is not None:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, args=(flush_interval,), daemon=True
+            )
+            self._flusher.start()
+
+    def _replay(self) -> None:
+        if not os.path.exists(self.wal_path):
+            return
+        with open(self.wal_path, encoding="utf-8") as f:
+            for line in f:
+                # A torn last line was never acknowledged to the caller
+                if line.endswith("\n"):
+                    self._pending.append(json.loads(line))
+        self.flush()
+
+    def adopt_logs(self, active_ids: Iterable[str] = ()) -> int:
+        # Replays the logs of other workers that are gone (all but
+        # active_ids), e.g. after a crash or with fewer workers than before
+        paths = [os.path.join(self.db_path, f"{self.collection_name}.wal")] + glob.glob(
+            os.path.join(self.db_path, f"{glob.escape(self.collection_name)}.*.wal")
+        )
+        active = {
+            os.path.join(self.db_path, f"{self.collection_name}.{id}.wal")
+            for id in active_ids
+        }
+        records = []
+        adopted = []
+        for path in paths:
+            if path == self.wal_path or path in active or not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as f:
+                records += [json.loads(line) for line in f if line.endswith("\n")]
+            adopted.append(path)
+        if not adopted:
+            return 0
+
+        with self._lock:
+            # Logged here first, so the tickets survive a crash in between
+            self._write_wal(records, "a")
+            self._pending += records
+            self.cache.invalidate()
+        for path in adopted:
+            os.remove(path)
+        self.flush()
+        return len(records)
+
+    def _refresh(self) -> None:
+        # Cached results may miss tickets other workers have flushed since
+        if self.shared and self.collection.refresh():
+            self.cache.invalidate()
+
+    def _write_wal(self, records: List[Dict[str, Any]], mode: str) -> None:
+        # "a" appends; "w" replaces the log atomically, so a crash mid-rewrite
+        # leaves the previous log with every acknowledged ticket
+        path = self.wal_path if mode == "a" else f"{self.wal_path}.tmp"
+        with open(path, mode, encoding="utf-8") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        if mode != "a":
+            os.replace(path, self.wal_path)
+
+    @telemetry.traced("tickets_db.add")
     def add(self, text, metadata={}):
-        metadata["timestamp"] = str(datetime.datetime.now())
+        # Imported tickets keep the time they were booked
+        metadata = dict(metadata)
+        metadata.setdefault("timestamp", str(datetime.datetime.now()))
+        record = {"id": str(uuid.uuid4()), "document": text, "metadata": metadata}
+
+        with self._lock:
+            self._write_wal([record], "a")
+            self._pending.append(record)
+            # After the append, so a query that missed the ticket can't be
+            # cached under the new generation
+            self.cache.invalidate()
+            full = len(self._pending) >= self.flush_size
+
+        if full:
+            self.flush()
 
-        self.collection.add(
-            documents=[text], metadatas=[metadata], ids=[str(uuid.uuid4())]
+    @telemetry.traced("tickets_db.add_ticket")
+    def add_ticket(self, ticket: Dict[str, Any]) -> None:
+        # The text is still embedded for free-form questions, the typed fields
+        # serve exact lookups
+        metadata = ticket_metadata(ticket)
+        self.add(ticket_document(metadata), metadata)
+
+    @telemetry.traced("tickets_db.lookup")
+    def lookup(self, keys: Dict[str, Any], n_results: int) -> List[Dict[str, Any]]:
+        # Tickets matching any of the given KEY_FIELDS exactly, newest first.
+        # A metadata filter on Chroma plus a scan of the buffer, so the
+        # embedder is not run.
+        conditions = [
+            {f"key_{field}": normalize_key(field, value)}
+            for field, value in keys.items()
+            if field in KEY_FIELDS and value is not None
+        ]
+        if not conditions:
+            return []
+
+        self._refresh()
+        key = ("lookup", tuple(sorted(map(str, conditions))), n_results)
+        generation = self.cache.generation
+        hit, tickets = self.cache.get(key)
+        if hit:
+            return tickets
+
+        with self._lock:
+            pending = list(self._pending)
+        records = {
+            record["id"]: (record["document"], record["metadata"])
+            for record in pending
+            if any(
+                record["metadata"].get(key) == value
+                for condition in conditions
+                for key, value in condition.items()
+            )
+        }
+
+        found = self.collection.get(
+            where=conditions[0] if len(conditions) == 1 else {"$or": conditions},
+            include=["documents", "metadatas"],
+        )
+        for id, document, metadata in zip(
+            found["ids"], found["documents"], found["metadatas"]
+        ):
+            records.setdefault(id, (document, metadata))
+
+        records = sorted(
+            records.values(),
+            key=lambda record: record[1].get("timestamp", ""),
+            reverse=True,
         )
+        tickets = [
+            ticket_from_record(document, metadata)
+            for document, metadata in records[:n_results]
+        ]
+        self.cache.put(key, generation, tickets)
+        return tickets
 
+    def _embed_pending(self, records: List[Dict[str, Any]]) -> None:
+        # Embeddings are computed once per ticket, by a query or a flush
+        missing = [record for record in records if "embedding" not in record]
+        if missing:
+            embeddings = self.embedder.get_embeddings(
+                [record["document"] for record in missing]
+            )
+            for record, embedding in zip(missing, embeddings):
+                record["embedding"] = embedding
+
+    @telemetry.traced("tickets_db.flush")
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return 0
+
+            self._embed_pending(batch)
+            self.collection.upsert(
+                ids=[record["id"] for record in batch],
+                embeddings=[record["embedding"] for record in batch],
+                documents=[record["document"] for record in batch],
+                metadatas=[record["metadata"] for record in batch],
+            )
+
+            with self._lock:
+                # Only add() touches the buffer meanwhile, and it appends
+                self._pending = self._pending[len(batch) :]
+                self._write_wal(
+                    [
+                        {key: record[key] for key in ["id", "document", "metadata"]}
+                        for record in self._pending
+                    ],
+                    "w",
+                )
+                # Flushed tickets now get Chroma's distances instead of the
+                # buffer's, which may differ in the last bits
+                self.cache.invalidate()
+            self.n_flushes += 1
+            self.n_flushed += len(batch)
+            return len(batch)
+
+    @telemetry.traced("tickets_db.import_records")
+    def import_records(self, records: List[Dict[str, Any]]) -> None:
+        # Already embedded records (bulk imports) go straight to the
+        # collection, without the log: the importer checkpoints instead
+        self.collection.upsert(
+            ids=[record["id"] for record in records],
+            embeddings=[record["embedding"] for record in records],
+            documents=[record["document"] for record in records],
+            metadatas=[record["metadata"] for record in records],
+        )
+        self.cache.invalidate()
+
+    def _flush_periodically(self, interval: float) -> None:
+        while self._running:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # Tickets stay buffered and logged, the next flush retries
+                print(f"TicketsDB flush failed: {e}")
+
+    def close(self) -> None:
+        self._running = False
+        self.flush()
+
+    @telemetry.traced("tickets_db.delete")
     def delete(self, id):
+        # Flushed first, so the ticket is deleted even if it was still buffered
+        self.flush()
         self.collection.delete(id)
+        self.cache.invalidate()
 
+    @telemetry.traced("tickets_db.query")
     def query(self, query, n_results, return_text=True):
-        query = self.collection.query(
-            query_texts=query,
-            n_results=n_results,
-        )
+        # Queries are embedded in normalized form (as the embedding cache
+        # does anyway), so texts differing only in whitespace share an entry
+        query_texts = [
+            normalize_text(text)
+            for text in ([query] if isinstance(query, str) else query)
+        ]
+        self._refresh()
+        key = ("query", tuple(query_texts), n_results, return_text)
+        generation = self.cache.generation
+        hit, result = self.cache.get(key)
+        if not hit:
+            result = self._query(query_texts, n_results, return_text)
+            self.cache.put(key, generation, result)
+        return result
+
+    def _query(self, query_texts, n_results, return_text):
+        query_embeddings = self.embedder.get_embeddings(query_texts)
+
+        with self._lock:
+            pending = list(self._pending)
+        self._embed_pending(pending)
+
+        if self.collection.count() > 0:
+            query = self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+            )
+        else:
+            query = {
+                "ids": [[] for _ in query_texts],
+                "distances": [[] for _ in query_texts],
+                "metadatas": [[] for _ in query_texts],
+                "embeddings": None,
+                "documents": [[] for _ in query_texts],
+            }
+
+        if pending:
+            # Merge buffered tickets by the same squared L2 distance Chroma
+            # uses. A ticket being flushed right now may be in both.
+            flushed = set(id for ids in query["ids"] for id in ids)
+            pending = [record for record in pending if record["id"] not in flushed]
+        if pending:
+            vectors = np.array([record["embedding"] for record in pending])
+            for i, query_embedding in enumerate(query_embeddings):
+                distances = np.sum((vectors - np.array(query_embedding)) ** 2, axis=1)
+                candidates = list(
+                    zip(
+                        query["distances"][i],
+                        query["ids"][i],
+                        query["documents"][i],
+                        query["metadatas"][i],
+                    )
+                ) + [
+                    (
+                        float(distance),
+                        record["id"],
+                        record["document"],
+                        record["metadata"],
+                    )
+                    for distance, record in zip(distances, pending)
+                ]
+                candidates.sort(key=lambda candidate: candidate[0])
+                top = candidates[:n_results]
+                for j, key in enumerate(["distances", "ids", "documents", "metadatas"]):
+                    query[key][i] = [candidate[j] for candidate in top]
 
         if return_text:
             return query["documents"][0]
         else:
             return query
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "flushes": self.n_flushes,
+            "flushed": self.n_flushed,
+            "cache": self.cache.stats(),
+        }
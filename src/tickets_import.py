@@ -0,0 +1,325 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from functools import partial
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from dateutil.parser import parse
+from session import TICKET_FIELDS
+from tickets_db import TicketsDB, ticket_document, ticket_metadata
+
+DEFAULT_MODEL = "princeton-nlp/sup-simcse-roberta-large"
+
+
+def read_rows(path: str) -> Iterator[Dict[str, Any]]:
+    # Streams the records of a .csv or .jsonl file, never the whole file
+    if path.endswith(".csv"):
+        with open(path, encoding="utf-8", newline="") as f:
+            yield from csv.DictReader(f)
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_timestamp(value: Any) -> Optional[str]:
+    # In the format of the timestamps add() writes, local time without zone
+    if value is None or value == "":
+        return None
+    try:
+        timestamp = parse(str(value))
+    except (ValueError, OverflowError):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return str(timestamp)
+
+
+def typed_value(field: str, value: Any) -> Any:
+    # CSV gives strings; numbers are stored as numbers, as add_ticket does
+    if value == "":
+        return None
+    if field in ("ticket_id", "price") and isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+    return value
+
+
+def to_record(
+    row: Dict[str, Any], row_id: str, timestamp_field: str
+) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    # (record, None), or (None, why the row was rejected)
+    fields = row.get("metadata", row)
+    timestamp = parse_timestamp(fields.get(timestamp_field))
+    if timestamp is None:
+        return None, f"no valid {timestamp_field!r}"
+    metadata = ticket_metadata(
+        {field: typed_value(field, fields.get(field)) for field in TICKET_FIELDS}
+    )
+    if not metadata:
+        return None, "no ticket fields"
+    # The same document add_ticket embeds, with the original booking time
+    return {
+        "id": str(row.get("id") or row_id),
+        "document": ticket_document(metadata),
+        "metadata": dict(metadata, timestamp=timestamp),
+    }, None
+
+
+# The embedder of a pool process, loaded once by the initializer
+_worker_embedder = None
+
+
+def _init_worker(embedder_factory: Callable[[], Any]) -> None:
+    global _worker_embedder
+    _worker_embedder = embedder_factory()
+
+
+def _embed_in_worker(texts: List[str]) -> List[List[float]]:
+    return _worker_embedder.get_embeddings(texts)
+
+
+def _load_embedder(model: str, n_threads: int) -> Any:
+    import torch
+    from embedder import HFEmbedder
+
+    torch.set_num_threads(n_threads)
+    # No cache: every imported ticket is embedded once
+    return HFEmbedder(model=model, cache_size=0)
+
+
+def embedder_factory(
+    model: Optional[str], workers: int = 1, n_threads: Optional[int] = None
+) -> Callable[[], Any]:
+    if model is None:
+        from stubs import StubEmbedder
+
+        return StubEmbedder
+    # The cores are split between the workers, each runs its own model
+    n_threads = n_threads or max(1, (os.cpu_count() or 1) // max(workers, 1))
+    return partial(_load_embedder, model, n_threads)
+
+
+class PoolEmbedder:
+    # The pool seen as an embedder, for TicketsDB's own needs (replaying
+    # its log on open)
+    def __init__(self, executor: Executor, embed: Callable) -> None:
+        self.executor = executor
+        self.embed = embed
+
+    def get_embeddings(self, texts: Any) -> List[List[float]]:
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        return self.executor.submit(self.embed, texts).result()
+
+
+def read_checkpoint(path: str, source: str) -> Dict[str, Any]:
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint["source"] == source:
+            return checkpoint
+        print(f"Checkpoint {path} is for {checkpoint['source']}, starting over")
+    return {"source": source, "rows": 0, "imported": 0, "rejected": 0, "seconds": 0.0}
+
+
+def write_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    # Replaced atomically, an interrupted write leaves the previous one
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def import_tickets(
+    source: str,
+    tickets_db: TicketsDB,
+    executor: Executor,
+    embed: Callable[[List[str]], List[List[float]]],
+    checkpoint_path: str,
+    batch_size: int = 64,
+    chunk_size: int = 4096,
+    max_pending: int = 8,
+    timestamp_field: str = "timestamp",
+) -> Dict[str, Any]:
+    # Batches of batch_size rows are embedded on the executor, at most
+    # max_pending at a time, and inserted in order, chunk_size records per
+    # upsert. The checkpoint counts the source rows behind the last insert;
+    # ids are derived from the row number (or the row's "id"), so rows
+    # re-read after an interruption are upserted over themselves.
+    source = os.path.abspath(source)
+    checkpoint = read_checkpoint(checkpoint_path, source)
+    rows = enumerate(read_rows(source))
+    # Already imported, skipped without parsing the rest
+    for _ in islice(rows, checkpoint["rows"]):
+        pass
+
+    pending: deque = deque()
+    chunk: List[Dict[str, Any]] = []
+    rejected: List[Dict[str, Any]] = []
+    chunk_rows = checkpoint["rows"]
+    imported_before = checkpoint["imported"]
+    start = chunk_start = time.perf_counter()
+
+    def insert_chunk() -> None:
+        nonlocal chunk_start
+        if chunk:
+            tickets_db.import_records(chunk)
+        if rejected:
+            with open(f"{checkpoint_path}.rejected.jsonl", "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(row) + "\n" for row in rejected))
+        checkpoint["rows"] = chunk_rows
+        checkpoint["imported"] += len(chunk)
+        checkpoint["rejected"] += len(rejected)
+        checkpoint["seconds"] += time.perf_counter() - chunk_start
+        chunk_start = time.perf_counter()
+        write_checkpoint(checkpoint_path, checkpoint)
+        chunk.clear()
+        rejected.clear()
+
+        imported = checkpoint["imported"] - imported_before
+        print(
+            f"{checkpoint['rows']} rows, {checkpoint['imported']} imported, "
+            f"{checkpoint['rejected']} rejected, "
+            f"{imported / (time.perf_counter() - start):.1f} docs/sec"
+        )
+
+    def take_batch() -> None:
+        nonlocal chunk_rows
+        records, batch_rejected, last_row, future = pending.popleft()
+        for record, embedding in zip(records, future.result()):
+            record["embedding"] = embedding
+        chunk.extend(records)
+        rejected.extend(batch_rejected)
+        chunk_rows = last_row + 1
+        if len(chunk) >= chunk_size:
+            insert_chunk()
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        records, batch_rejected = [], []
+        for i, row in batch:
+            record, reason = to_record(row, f"{source}:{i}", timestamp_field)
+            if record is not None:
+                records.append(record)
+            else:
+                batch_rejected.append({"row": i, "reason": reason, "data": row})
+        if records:
+            future = executor.submit(embed, [record["document"] for record in records])
+        else:
+            future = Future()
+            future.set_result([])
+        pending.append((records, batch_rejected, batch[-1][0], future))
+        while len(pending) >= max_pending:
+            take_batch()
+    while pending:
+        take_batch()
+    insert_chunk()
+
+    elapsed = time.perf_counter() - start
+    imported = checkpoint["imported"] - imported_before
+    return dict(
+        checkpoint,
+        run_imported=imported,
+        run_seconds=elapsed,
+        docs_per_sec=imported / elapsed if elapsed else 0.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk import of booked tickets from .csv or .jsonl into TicketsDB"
+    )
+    parser.add_argument("source", help="tickets, one per row, with TICKET_FIELDS")
+    parser.add_argument("--collection", default="total-memory")
+    parser.add_argument("--index", default=None, help="see TicketsDB")
+    parser.add_argument("--timestamp-field", default="timestamp")
+    parser.add_argument("--workers", type=int, default=4, help="0 embeds in-process")
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch threads per worker"
+    )
+    parser.add_argument("--batch-size", type=int, default=64, help="texts per pass")
+    parser.add_argument(
+        "--chunk-size", type=int, default=4096, help="records per collection upsert"
+    )
+    parser.add_argument(
+        "--checkpoint", default=None, help="default: <source>.import.json"
+    )
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="HF embedder model")
+    parser.add_argument(
+        "--stub-embedder", action="store_true", help="fake vectors, for dry runs"
+    )
+    parser.add_argument("--output", default=None, help="save the summary as JSON")
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or f"{args.source}.import.json"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    factory = embedder_factory(
+        None if args.stub_embedder else args.model, args.workers, args.threads
+    )
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers, initializer=_init_worker, initargs=(factory,)
+        )
+        embed = _embed_in_worker
+    else:
+        # One thread embeds while the main one parses and inserts
+        executor = ThreadPoolExecutor(max_workers=1)
+        embed = factory().get_embeddings
+
+    tickets_db = TicketsDB(
+        args.collection,
+        embedder=PoolEmbedder(executor, embed),
+        flush_interval=None,
+        index=args.index,
+    )
+    try:
+        summary = import_tickets(
+            args.source,
+            tickets_db,
+            executor,
+            embed,
+            checkpoint_path,
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            max_pending=2 * max(args.workers, 1),
+            timestamp_field=args.timestamp_field,
+        )
+    except KeyboardInterrupt:
+        print(f"Interrupted, rerun to resume from {checkpoint_path}")
+        sys.exit(1)
+    finally:
+        tickets_db.close()
+        executor.shutdown(cancel_futures=True)
+
+    print(
+        f"Imported {summary['run_imported']} tickets in {summary['run_seconds']:.1f} s, "
+        f"{summary['docs_per_sec']:.1f} docs/sec ({summary['imported']} in total, "
+        f"{summary['rejected']} rejected)"
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
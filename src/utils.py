@@ -1,9 +1,58 @@
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import parse
-from bert_ner import BERTNER
-from functools import wraps
-from termcolor import colored
+from models import registry
+from telemetry import telemetry
+from typing import Any, Dict, Iterable, Optional
+
+# The lookahead lets the engine skip non-digits without trying \b first
+DATE_REGEX = re.compile(
+    r"(?=\d)\b(\d{4}[-./]\d{1,2}[-./]\d{1,2}|\d{1,2}[-./]\d{1,2}[-./]\d{4})\b"
+)
+EMAIL_REGEX = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b")
+DOCUMENT_NUMBER_REGEX = re.compile(r"(\d\s*\d\s*\d\s*\d)\s*(\d{6})")
+PRICE_CEILING_REGEX = re.compile(
+    r"\b(?:under|below|cheaper than|less than|up to|at most|no more than|max)"
+    r"\s*\$?\s*(\d+)\b"
+    # "up to 3 bags", "under 25 years old" count something else
+    r"(?!\s*(?:bags?|kg|kilos?|years?|y\.?o\b|hours?|minutes?|stops?|people"
+    r"|persons?|passengers?|adults?|kids?|children|seats?|tickets?|days?|weeks?))",
+    re.IGNORECASE,
+)
+
+CLASSES_OF_SERVICE = ["economy", "business", "first"]
+MALE_SYNONYMS = [
+    "male",
+    "man",
+    "guy",
+    "gentleman",
+    "he-man",
+    "masculine",
+    "manful",
+    "manlike",
+    "virile",
+    "androcentric",
+    "androcratic",
+    "androgenous",
+    "staminate",
+    "anthropoidal",
+]
+FEMALE_SYNONYMS = [
+    "female",
+    "woman",
+    "lady",
+    "ladylike",
+    "she-woman",
+    "feminine",
+    "womanful",
+    "womanlike",
+    "girl",
+    "dame",
+    "feminine",
+    "distaff",
+    "heroine",
+    "broad",
+]
 
 
 def extract_date(text, valid_dates):
@@ -19,30 +68,35 @@ def extract_date(text, valid_dates):
 
 
 def extract_birth_date(text):
-    if not re.search(
-        r"\b(\d{4}[-./]\d{1,2}[-./]\d{1,2}|\d{1,2}[-./]\d{1,2}[-./]\d{4})\b", text
-    ):
+    if not DATE_REGEX.search(text):
         return None
 
+    return _parse_birth_date(text)
+
+
+@telemetry.traced("extract.parse_date")
+def _parse_birth_date(text):
     try:
         dt = parse(text, fuzzy=True)
         if (datetime.now() - dt).days >= 18 * 365:
             return str(dt.date())
         else:
             return None
-    except ValueError:
+    except (ValueError, OverflowError, TypeError):
+        # TypeError: fuzzy parsing picked up a timezone
         return None
 
 
+@telemetry.traced("extract.email")
 def extract_email(text):
-    email_regex = r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b"
-    matches = re.findall(email_regex, text)
-    return matches[0] if matches else None
+    match = EMAIL_REGEX.search(text)
+    return match.group(0) if match else None
 
 
+@telemetry.traced("extract.numbers")
 def extract_numbers(text):
     # Ищем группу из 4 цифр, возможно разделенных пробелами, затем ищем 6 цифр
-    match = re.search(r"(\d\s*\d\s*\d\s*\d)\s*(\d{6})", text)
+    match = DOCUMENT_NUMBER_REGEX.search(text)
     if match:
         numbers = "".join(match.group(1).split()) + " " + match.group(2)
         return numbers
@@ -51,58 +105,162 @@ def extract_numbers(text):
 
 
 def extract_classes_of_service(text):
-    classes_of_service = ["economy", "business", "first"]
-
-    if any(word in text.lower() for word in classes_of_service):
+    if any(word in text.lower() for word in CLASSES_OF_SERVICE):
         return next(
-            service for service in classes_of_service if service in text.lower()
+            service for service in CLASSES_OF_SERVICE if service in text.lower()
         )
     else:
         return None
 
 
 def extract_gender(text):
-    male_synonyms = [
-        "male",
-        "man",
-        "guy",
-        "gentleman",
-        "he-man",
-        "masculine",
-        "manful",
-        "manlike",
-        "virile",
-        "androcentric",
-        "androcratic",
-        "androgenous",
-        "staminate",
-        "anthropoidal",
-    ]
-    female_synonyms = [
-        "female",
-        "woman",
-        "lady",
-        "ladylike",
-        "she-woman",
-        "feminine",
-        "womanful",
-        "womanlike",
-        "girl",
-        "dame",
-        "feminine",
-        "distaff",
-        "heroine",
-        "broad",
-    ]
-
-    if any(word in text.lower() for word in male_synonyms):
+    if any(word in text.lower() for word in MALE_SYNONYMS):
         return "male"
-    elif any(word in text.lower() for word in female_synonyms):
+    elif any(word in text.lower() for word in FEMALE_SYNONYMS):
         return "female"
     else:
         return None
 
 
+def _trie_pattern(words: Iterable[str]) -> str:
+    # Alternation factored by common prefixes ("man(?:ful|like)?"), so the
+    # regex engine rejects most positions after a single character
+    trie: Dict[str, dict] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, dict]) -> str:
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        if len(branches) == 1 and "" not in node:
+            return branches[0]
+        pattern = f"(?:{'|'.join(branches)})"
+        return pattern + "?" if "" in node else pattern
+
+    return build(trie)
+
+
+class SlotExtractor:
+    # Extracts gender, class_of_service, email, document_number and birth_date
+    # together, lowercasing the message once. Each gender's synonyms are one
+    # prefix-factored alternation: a search finds any of them as a substring,
+    # like the any() loops of extract_gender, in a single pass over the text.
+    # A single scan reporting every (overlapping) keyword of both genders and
+    # the classes measured slower than these two searches.
+    def __init__(self) -> None:
+        self.male_regex = re.compile(_trie_pattern(MALE_SYNONYMS))
+        self.female_regex = re.compile(_trie_pattern(FEMALE_SYNONYMS))
+
+    def extract(
+        self, text: str, fields: Optional[Iterable[str]] = None
+    ) -> Dict[str, Optional[str]]:
+        # `fields` only matters for birth_date, whose fuzzy date parsing is the
+        # one expensive step; everything else costs a few regex scans
+        lowered = text.lower()
+
+        gender = None
+        if self.male_regex.search(lowered):
+            gender = "male"
+        elif self.female_regex.search(lowered):
+            gender = "female"
+
+        class_of_service = None
+        for service in CLASSES_OF_SERVICE:
+            if service in lowered:
+                class_of_service = service
+                break
+
+        email = EMAIL_REGEX.search(text) if "@" in text else None
+        document_number = DOCUMENT_NUMBER_REGEX.search(text)
+
+        birth_date = None
+        if (fields is None or "birth_date" in fields) and DATE_REGEX.search(text):
+            birth_date = _parse_birth_date(text)
+
+        return {
+            "gender": gender,
+            "class_of_service": class_of_service,
+            "email": email.group(0) if email else None,
+            "document_number": (
+                "".join(document_number.group(1).split())
+                + " "
+                + document_number.group(2)
+                if document_number
+                else None
+            ),
+            "birth_date": birth_date,
+        }
+
+
+slot_extractor = SlotExtractor()
+
+
+@telemetry.traced("extract.slots")
+def extract_slots(
+    text: str, fields: Optional[Iterable[str]] = None
+) -> Dict[str, Optional[str]]:
+    return slot_extractor.extract(text, fields)
+
+
+@telemetry.traced("extract.flight_filters")
+def extract_flight_filters(text: str) -> Dict[str, Any]:
+    # search_flights arguments mentioned in the message: a price ceiling, a
+    # one-day or one-week departure window and "cheap" for sorting by price
+    filters: Dict[str, Any] = {}
+
+    price = PRICE_CEILING_REGEX.search(text)
+    if price:
+        filters["max_price"] = int(price.group(1))
+
+    lowered = text.lower()
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    date = DATE_REGEX.search(text)
+    # Dates old enough to be a birth date are left to extract_slots, they
+    # would leave no flights
+    if date and _parse_birth_date(date.group(0)) is None:
+        try:
+            start = parse(date.group(0))
+            filters["departure_from"] = start
+            filters["departure_to"] = start + timedelta(days=1)
+        except (ValueError, OverflowError):
+            pass
+    elif "tomorrow" in lowered:
+        filters["departure_from"] = today + timedelta(days=1)
+        filters["departure_to"] = today + timedelta(days=2)
+    elif "next week" in lowered:
+        start = today + timedelta(days=7 - today.weekday())
+        filters["departure_from"] = start
+        filters["departure_to"] = start + timedelta(days=7)
+
+    if "cheap" in lowered:
+        filters["sort_by"] = "price"
+    return filters
+
+
+def describe_flight_filters(filters: Dict[str, Any]) -> str:
+    # "a price up to 300 and departure on 2024-05-05", for the user
+    parts = []
+    if "max_price" in filters:
+        parts.append(f"a price up to {filters['max_price']}")
+    if "departure_from" in filters:
+        start, end = filters["departure_from"], filters["departure_to"]
+        if end - start == timedelta(days=1):
+            parts.append(f"departure on {start:%Y-%m-%d}")
+        else:
+            last = end - timedelta(days=1)
+            parts.append(f"departure between {start:%Y-%m-%d} and {last:%Y-%m-%d}")
+    return " and ".join(parts)
+
+
+@telemetry.traced("extract.city")
 def extract_city(text, cities):
     for city in cities:
         if city in text:
@@ -110,11 +268,10 @@ def extract_city(text, cities):
     return None
 
 
-bert_ner = BERTNER()
-
-
+@telemetry.traced("extract.name")
 def extract_name(text):
-    entities = bert_ner(text)
+    # BERT is loaded on the first call, not when utils is imported
+    entities = registry.get("bert_ner")(text)
     names = []
     name_tokens = []
     for entity in entities:
@@ -132,6 +289,7 @@ def extract_name(text):
         return None
 
 
+@telemetry.traced("extract.value")
 def extract_value(text, values):
     if not values or not text:
         return None
@@ -140,16 +298,3 @@ def extract_value(text, values):
         if re.search(r"(?:^|\s)" + re.escape(str(price)) + r"(?:\s|$)", text):
             return price
     return None
-
-
-def logging(enabled=True, message="", color="yellow"):
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            if enabled:
-                print(f"LOG: {colored(message, color = color)}")
-            return func(*args, **kwargs)
-
-        return wrapper
-
-    return decorator
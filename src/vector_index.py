@@ -0,0 +1,493 @@
+import contextlib
+import itertools
+import json
+import os
+import threading
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional, Set
+from file_lock import FileLock
+
+
+def _reserve(buffer: np.ndarray, n_used: int, n_needed: int) -> np.ndarray:
+    # The buffer, or a copy with its capacity doubled once it runs out, so
+    # appends copy each element a constant number of times instead of the
+    # whole array per append
+    if n_needed <= len(buffer):
+        return buffer
+    grown = np.empty(max(n_needed, 2 * len(buffer), 64), dtype=buffer.dtype)
+    grown[:n_used] = buffer[:n_used]
+    return grown
+
+
+class NumpyIndex:
+    # Drop-in for the part of the Chroma collection API TicketsDB uses
+    # (count/upsert/get/query/delete), kept in one directory:
+    #   vectors.f32   - append-only float32 matrix, memory-mapped for search
+    #   records.jsonl - one line per upsert (its row) or delete
+    # Vectors are written before their records, so an interrupted write
+    # never leaves a record without data. Search is an exact matrix product
+    # by default; with n_lists > 0 it is an IVF index that scans only the
+    # n_probe clusters closest to the query. Distances are squared L2, the
+    # same as Chroma's default "l2" space, so thresholds carry over.
+    # With shared=True several processes (prefork workers) can use the same
+    # directory: writes take a file lock, and every call first reads the
+    # records the other processes appended.
+    def __init__(
+        self,
+        path: str,
+        n_lists: int = 0,
+        n_probe: int = 8,
+        fsync: bool = True,
+        shared: bool = False,
+    ) -> None:
+        self.path = path
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.records_path = os.path.join(path, "records.jsonl")
+        self.meta_path = os.path.join(path, "meta.json")
+        self.ivf_path = os.path.join(path, f"ivf-{n_lists}.npz")
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.fsync = fsync
+
+        self.dim: Optional[int] = None
+        self.ids: List[Optional[str]] = []
+        self.documents: List[Optional[str]] = []
+        self.metadatas: List[Optional[Dict[str, Any]]] = []
+        self.rows: Dict[str, int] = {}
+        # Per row, with spare capacity past len(self.ids)
+        self._norms_buffer = np.zeros(0, dtype=np.float32)
+        self._live_buffer = np.zeros(0, dtype=bool)
+        self._vectors: Optional[np.memmap] = None
+        # metadata key -> value -> ids, built the first time a key is filtered on
+        self._values: Dict[str, Dict[Any, Set[str]]] = {}
+
+        self._centroids: Optional[np.ndarray] = None
+        # Rows of each IVF list, _list_sizes[j] of them used in _lists[j]
+        self._lists: List[np.ndarray] = []
+        self._list_sizes: List[int] = []
+        self._trained_rows = 0
+
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._file_lock = FileLock(os.path.join(path, "lock")) if shared else None
+        # Bytes of records.jsonl applied so far
+        self._records_offset = 0
+        with self._exclusive():
+            if os.path.exists(self.meta_path):
+                self._load()
+
+    @property
+    def _norms(self) -> np.ndarray:
+        return self._norms_buffer[: len(self.ids)]
+
+    @property
+    def _live(self) -> np.ndarray:
+        return self._live_buffer[: len(self.ids)]
+
+    def _exclusive(self) -> Any:
+        if self._file_lock is None:
+            return contextlib.nullcontext()
+        return self._file_lock
+
+    def _load(self) -> None:
+        with open(self.meta_path, encoding="utf-8") as f:
+            self.dim = json.load(f)["dim"]
+        row_bytes = self.dim * 4
+        for path in [self.vectors_path, self.records_path]:
+            open(path, "ab").close()
+
+        upserts, deletes = [], []
+        with open(self.records_path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+                data = data[: data.rfind(b"\n") + 1]
+        n_rows = os.path.getsize(self.vectors_path) // row_bytes
+        for line in data.decode("utf-8").splitlines():
+            record = json.loads(line)
+            if "delete" in record:
+                deletes.append((len(upserts), record["delete"]))
+            elif len(upserts) < n_rows:
+                upserts.append(record)
+        with open(self.vectors_path, "rb+") as f:
+            f.truncate(len(upserts) * row_bytes)
+        self._records_offset = len(data)
+
+        self._remap()
+        self._append_rows(upserts, np.asarray(self._vectors), index=False)
+        self._restore_lists()
+        # Replay deletes against the rows that existed when they were logged
+        for n_seen, id in deletes:
+            row = self.rows.get(id)
+            if row is not None and row < n_seen:
+                self._drop(row)
+
+    def _remap(self, n_rows: Optional[int] = None) -> None:
+        if n_rows is None:
+            n_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        if not n_rows:
+            # An empty file can't be mapped
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+            return
+        self._vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim)
+        )
+
+    def _drop(self, row: int) -> None:
+        id = self.ids[row]
+        for key, values in self._values.items():
+            value = self.metadatas[row].get(key)
+            if value in values:
+                values[value].discard(id)
+        del self.rows[id]
+        self.ids[row] = self.documents[row] = self.metadatas[row] = None
+        self._live[row] = False
+
+    def _append_rows(
+        self, records: List[Dict[str, Any]], vectors: np.ndarray, index: bool = True
+    ) -> None:
+        start = len(self.ids)
+        end = start + len(records)
+        self._norms_buffer = _reserve(self._norms_buffer, start, end)
+        self._norms_buffer[start:end] = np.sum(vectors**2, axis=1)
+        self._live_buffer = _reserve(self._live_buffer, start, end)
+        self._live_buffer[start:end] = True
+        for offset, record in enumerate(records):
+            old = self.rows.get(record["id"])
+            if old is not None:
+                self._drop(old)
+            self.ids.append(record["id"])
+            self.documents.append(record["document"])
+            self.metadatas.append(record["metadata"])
+            self.rows[record["id"]] = start + offset
+            for key, values in self._values.items():
+                if key in record["metadata"]:
+                    values.setdefault(record["metadata"][key], set()).add(record["id"])
+
+        if index:
+            self._update_lists(start, vectors)
+
+    def refresh(self) -> bool:
+        # Applies records appended by other processes, True if there were any
+        if self._file_lock is None or not os.path.exists(self.records_path):
+            return False
+        with self._lock:
+            if os.path.getsize(self.records_path) == self._records_offset:
+                return False
+            if self.dim is None:
+                with open(self.meta_path, encoding="utf-8") as f:
+                    self.dim = json.load(f)["dim"]
+            with open(self.records_path, "rb") as f:
+                f.seek(self._records_offset)
+                data = f.read()
+            # A line still being written is read next time
+            data = data[: data.rfind(b"\n") + 1]
+            if not data:
+                return False
+            self._records_offset += len(data)
+
+            records = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+            # Only rows with a record are mapped: another writer may be between
+            # writing its vectors and its records
+            self._remap(len(self.ids) + sum("delete" not in r for r in records))
+            # In log order, so deletes see the rows that existed before them
+            for deletes, group in itertools.groupby(
+                records, key=lambda record: "delete" in record
+            ):
+                group = list(group)
+                if deletes:
+                    for record in group:
+                        if record["delete"] in self.rows:
+                            self._drop(self.rows[record["delete"]])
+                else:
+                    start = len(self.ids)
+                    self._append_rows(
+                        group, np.asarray(self._vectors[start : start + len(group)])
+                    )
+            return True
+
+    def _drop_torn_tail(self) -> None:
+        # Called with the file lock held, when nobody else is writing: bytes
+        # past the applied records and their vectors were torn by a crash
+        if self._file_lock is None or self.dim is None:
+            return
+        with open(self.records_path, "rb+") as f:
+            f.truncate(self._records_offset)
+        with open(self.vectors_path, "rb+") as f:
+            f.truncate(len(self.ids) * self.dim * 4)
+
+    def _write(self, path: str, data: bytes) -> None:
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def count(self) -> int:
+        self.refresh()
+        return len(self.rows)
+
+    def upsert(
+        self,
+        ids: List[str],
+        embeddings: List[List[float]],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        records = [
+            {"id": id, "document": document, "metadata": metadata}
+            for id, document, metadata in zip(ids, documents, metadatas)
+        ]
+        data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with self._lock, self._exclusive():
+            self.refresh()
+            self._drop_torn_tail()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            self._write(self.vectors_path, np.ascontiguousarray(vectors).tobytes())
+            self._write(self.records_path, data)
+            self._records_offset += len(data)
+            self._remap()
+            self._append_rows(records, vectors)
+
+    def _matches(self, where: Dict[str, Any]) -> Set[str]:
+        if "$or" in where:
+            return set().union(*(self._matches(clause) for clause in where["$or"]))
+        if "$and" in where:
+            return set.intersection(
+                *(self._matches(clause) for clause in where["$and"])
+            )
+
+        matched = None
+        for key, value in where.items():
+            if isinstance(value, dict):
+                value = value["$eq"]
+            if key not in self._values:
+                values: Dict[Any, Set[str]] = {}
+                for id, metadata in zip(self.ids, self.metadatas):
+                    if id is not None and key in metadata:
+                        values.setdefault(metadata[key], set()).add(id)
+                self._values[key] = values
+            ids = self._values[key].get(value, set())
+            matched = set(ids) if matched is None else matched & ids
+        return matched or set()
+
+    def _select(
+        self, ids: Optional[Iterable[str]], where: Optional[Dict[str, Any]]
+    ) -> List[int]:
+        if ids is None:
+            if where:
+                return sorted(self.rows[id] for id in self._matches(where))
+            return [self.rows[id] for id in self.ids if id is not None]
+
+        ids = [ids] if isinstance(ids, str) else ids
+        matched = self._matches(where) if where else None
+        return [
+            self.rows[id]
+            for id in ids
+            if id in self.rows and (matched is None or id in matched)
+        ]
+
+    def get(
+        self,
+        ids: Optional[Iterable[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        include: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        self.refresh()
+        with self._lock:
+            rows = self._select(ids, where)[:limit]
+            return {
+                "ids": [self.ids[row] for row in rows],
+                "documents": [self.documents[row] for row in rows],
+                "metadatas": [self.metadatas[row] for row in rows],
+                "embeddings": None,
+            }
+
+    def delete(
+        self,
+        ids: Optional[Iterable[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        with self._lock, self._exclusive():
+            self.refresh()
+            self._drop_torn_tail()
+            rows = self._select(ids, where)
+            if not rows:
+                return
+            data = "".join(
+                json.dumps({"delete": self.ids[row]}) + "\n" for row in rows
+            ).encode("utf-8")
+            self._write(self.records_path, data)
+            self._records_offset += len(data)
+            for row in rows:
+                self._drop(row)
+
+    def _train(self) -> None:
+        # k-means on a sample of the live rows, then every row is assigned
+        rng = np.random.default_rng(0)
+        live = np.flatnonzero(self._live)
+        sample = self._vectors[
+            np.sort(rng.choice(live, min(len(live), 256 * self.n_lists), replace=False))
+        ]
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)]
+        for _ in range(10):
+            assignments = self._nearest(centroids, sample)
+            for j in range(self.n_lists):
+                members = sample[assignments == j]
+                if len(members):
+                    centroids[j] = members.mean(axis=0)
+
+        self._centroids = centroids
+        self._clear_lists()
+        self._trained_rows = len(self.ids)
+        assignments = self._assign(0, self._vectors)
+
+        # Saved so that opening the index doesn't train again
+        temp_path = f"{self.ivf_path}.tmp.npz"
+        np.savez(temp_path, centroids=centroids, assignments=assignments)
+        os.replace(temp_path, self.ivf_path)
+
+    def _restore_lists(self) -> None:
+        if not self.n_lists:
+            return
+        assignments = None
+        if os.path.exists(self.ivf_path):
+            with np.load(self.ivf_path) as saved:
+                centroids, assignments = saved["centroids"], saved["assignments"]
+        if assignments is None or not (
+            len(assignments) <= len(self.ids) < 2 * len(assignments)
+        ):
+            self._update_lists(0, self._vectors)
+            return
+
+        self._centroids = centroids
+        self._clear_lists()
+        self._trained_rows = len(assignments)
+        self._extend_lists(0, assignments)
+        # Rows added since the last training
+        self._assign(len(assignments), self._vectors[len(assignments) :])
+
+    def _nearest(self, centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        centroid_norms = np.sum(centroids**2, axis=1)
+        for start in range(0, len(vectors), 65536):
+            chunk = np.asarray(vectors[start : start + 65536])
+            assignments[start : start + len(chunk)] = np.argmin(
+                centroid_norms - 2 * chunk @ centroids.T, axis=1
+            )
+        return assignments
+
+    def _update_lists(self, start: int, vectors: np.ndarray) -> None:
+        if not self.n_lists:
+            return
+        if self._centroids is None and len(self.ids) < 39 * self.n_lists:
+            # Too few rows to train on yet, searched exactly meanwhile
+            return
+        if self._centroids is None or len(self.ids) >= 2 * self._trained_rows:
+            # Retrained as the data doubles
+            self._train()
+            return
+        self._assign(start, vectors)
+
+    def _assign(self, start: int, vectors: np.ndarray) -> np.ndarray:
+        assignments = self._nearest(self._centroids, vectors)
+        self._extend_lists(start, assignments)
+        return assignments
+
+    def _clear_lists(self) -> None:
+        self._lists = [np.zeros(0, dtype=np.int64) for _ in range(self.n_lists)]
+        self._list_sizes = [0] * self.n_lists
+
+    def _extend_lists(self, start: int, assignments: np.ndarray) -> None:
+        order = start + np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=self.n_lists)
+        for j, rows in enumerate(np.split(order, np.cumsum(counts)[:-1])):
+            if len(rows):
+                size = self._list_sizes[j]
+                self._lists[j] = _reserve(self._lists[j], size, size + len(rows))
+                self._lists[j][size : size + len(rows)] = rows
+                self._list_sizes[j] = size + len(rows)
+
+    def _candidates(self, query: np.ndarray) -> Optional[np.ndarray]:
+        if self._centroids is None:
+            return None
+        probes = np.argsort(np.sum((self._centroids - query) ** 2, axis=1))
+        return np.sort(
+            np.concatenate(
+                [self._lists[j][: self._list_sizes[j]] for j in probes[: self.n_probe]]
+            )
+        )
+
+    def query(
+        self,
+        query_embeddings: List[List[float]],
+        n_results: int = 10,
+        include: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        result = {
+            "ids": [],
+            "distances": [],
+            "metadatas": [],
+            "embeddings": None,
+            "documents": [],
+        }
+        self.refresh()
+        with self._lock:
+            for query in queries:
+                rows = self._candidates(query)
+                if rows is None:
+                    vectors, norms, live = self._vectors, self._norms, self._live
+                else:
+                    vectors = self._vectors[rows]
+                    norms, live = self._norms[rows], self._live[rows]
+
+                distances = norms - 2 * (vectors @ query) + np.dot(query, query)
+                distances[~live] = np.inf
+                k = min(n_results, int(np.count_nonzero(live)))
+                top = np.zeros(0, dtype=np.int64)
+                if k:
+                    top = np.argpartition(distances, k - 1)[:k]
+                    top = top[np.argsort(distances[top], kind="stable")]
+                top_rows = top if rows is None else rows[top]
+
+                result["ids"].append([self.ids[row] for row in top_rows])
+                result["distances"].append(
+                    [float(max(distance, 0.0)) for distance in distances[top]]
+                )
+                result["metadatas"].append([self.metadatas[row] for row in top_rows])
+                result["documents"].append([self.documents[row] for row in top_rows])
+        return result
+
+
+def open_index(
+    kind: str,
+    db_path: str,
+    collection_name: str,
+    embedder: Any = None,
+    shared: bool = False,
+) -> Any:
+    # "chroma": the Chroma collection; "numpy": exact NumpyIndex; "ivf":
+    # approximate NumpyIndex. shared: used by several processes at once,
+    # which the Chroma client does not support.
+    if kind == "chroma":
+        if shared:
+            raise ValueError("A Chroma collection can't be shared between processes")
+        import chromadb
+
+        client = chromadb.PersistentClient(path=db_path)
+        return client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=embedder.get_embeddings if embedder else None,
+        )
+    path = os.path.join(db_path, f"{collection_name}.index")
+    if kind == "numpy":
+        return NumpyIndex(path, shared=shared)
+    if kind == "ivf":
+        return NumpyIndex(path, n_lists=256, n_probe=16, shared=shared)
+    raise ValueError(f"Unknown index kind: {kind!r}")